@@ -7,14 +7,15 @@
 
 import argparse
 import csv
+import hashlib
+import json
+from lib.analysis_utils import *
 from lib.audio_utils import *
 from lib.collection_utils import *
 from lib.io_utils import *
 from lib.math_utils import *
 from lib.processing_utils import *
 import librosa
-from multiprocessing import Pool
-from multiprocessing.dummy import Pool as ThreadPool
 import os
 from os.path import join
 import numpy as np
@@ -31,7 +32,11 @@ parser.add_argument('-max', dest="MAX_DUR", default=1000, type=int, help="Maximu
 parser.add_argument('-delta', dest="ONSET_DELTA", default=0.07, type=float, help="Onset delta; must be larger than 0")
 parser.add_argument('-out', dest="OUTPUT_FILE", default="tmp/samples.csv", help="CSV output file")
 parser.add_argument('-overwrite', dest="OVERWRITE", action="store_true", help="Overwrite existing data?")
-parser.add_argument('-threads', dest="THREADS", default=4, type=int, help="Number of concurrent threads, -1 for all available")
+parser.add_argument('-manifest', dest="MANIFEST_FILE", default="", help="File that records which media files are done; defaults to the output file plus .manifest.jsonl")
+parser.add_argument('-threads', dest="THREADS", default=4, type=int, help="Number of concurrent workers, -1 for all available")
+parser.add_argument('-threaded', dest="THREADED", action="store_true", help="Use threads instead of processes?")
+parser.add_argument('-store', dest="STORE_DIRECTORY", default="tmp/analysis/", help="Directory for storing per-file analysis")
+parser.add_argument('-precompute', dest="PRECOMPUTE", action="store_true", help="Also compute feature vectors and fingerprints so later scripts can read them from the store?")
 
 # arguments for managing large media sets
 parser.add_argument('-features', dest="FEATURES", action="store_true", help="Retrieve features?")
@@ -51,6 +56,10 @@ ONSET_DELTA = args.ONSET_DELTA
 OUTPUT_FILE = args.OUTPUT_FILE
 OVERWRITE = args.OVERWRITE
 MULTIFILE_OUTPUT = ("%s" in OUTPUT_FILE)
+MANIFEST_FILE = args.MANIFEST_FILE if len(args.MANIFEST_FILE) > 0 else OUTPUT_FILE.replace("%s", "all") + ".manifest.jsonl"
+
+STORE_DIRECTORY = args.STORE_DIRECTORY
+PRECOMPUTE = args.PRECOMPUTE
 
 FEATURES = args.FEATURES
 COUNT = args.COUNT
@@ -84,23 +93,21 @@ if samplesPerFile > 0:
 # Make sure output dirs exist
 makeDirectories(OUTPUT_FILE)
 
-# Get existing data
-rows = []
-if os.path.isfile(OUTPUT_FILE) and not OVERWRITE and not MULTIFILE_OUTPUT:
-    fieldNames, rows = readCsv(OUTPUT_FILE)
-rowCount = len(rows)
-
 # files = files[:1]
 
 def getSamples(fn, sampleCount=-1):
     print("Retrieving samples for %s..." % fn)
-    sampleData, y, sr = getAudioSamples(fn, min_dur=MIN_DUR, max_dur=MAX_DUR, fft=FFT, hop_length=HOP_LEN, delta=ONSET_DELTA)
+    features = ["features"] if FEATURES else []
+    if PRECOMPUTE:
+        features += ["vectors", "fingerprints"]
+    sampleData = analyzeFile(fn, STORE_DIRECTORY, features=features, minDur=MIN_DUR, maxDur=MAX_DUR, delta=ONSET_DELTA, fft=FFT, hopLength=HOP_LEN)
+    # vectors and fingerprints stay in the store; they don't go into the csv
+    for sample in sampleData:
+        sample.pop("featureVector", None)
+        sample.pop("fingerprint", None)
     print("Found %s samples in %s." % (len(sampleData), fn))
 
     if len(sampleData) > 0:
-        # optionally retrieve features
-        if FEATURES:
-            sampleData = getFeaturesFromSamples(fn, sampleData, y=y, sr=sr)
         # optionally, filter results
         if len(FILTER) > 0:
             sampleData = filterByQueryString(sampleData, FILTER)
@@ -119,40 +126,108 @@ if FEATURES:
 totalCount = 0
 progress = 0
 
-def processFile(f):
-    global totalCount
-    global fileCount
-    global rowCount
-    global progress
-    global rows
-    global samplesPerFile
+def processFile(fn):
+    return (fn, getSamples(fn, samplesPerFile))
 
-    fn = f["filename"]
-    basename = os.path.basename(fn)
-    outputFilename = OUTPUT_FILE if not MULTIFILE_OUTPUT else OUTPUT_FILE % basename
+# the options that change which samples a file gets; files analyzed with other options are done again. Values worked out
+# from the input (like the samples per file that -count gives) are left out, so adding files doesn't redo the others
+params = {"samples": SAMPLES, "count": COUNT, "minDur": MIN_DUR, "maxDur": MAX_DUR, "delta": ONSET_DELTA, "fft": FFT, "hopLength": HOP_LEN,
+    "features": FEATURES, "precompute": PRECOMPUTE, "filter": FILTER, "sort": SORT}
+paramsKey = hashlib.md5(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
 
-    if MULTIFILE_OUTPUT and not OVERWRITE and os.path.isfile(outputFilename):
-        print("Already found samples for %s. Skipping." % outputFilename)
+def getManifestEntry(fn, count):
+    return {"filename": fn, "source": getAnalysisSource(fn), "params": paramsKey, "count": count}
 
-    # Check if we already have this data
-    elif not MULTIFILE_OUTPUT and not OVERWRITE and rowCount > 0 and len([row for row in rows if row["filename"]==basename]) > 0:
-        totalCount += len([row for row in rows if row["filename"]==fn])
-        print("Already found samples for %s. Skipping." % basename)
+def isDone(entry):
+    return entry["params"] == paramsKey and entry["source"] == getAnalysisSource(entry["filename"])
 
-    else:
-        result = getSamples(fn, samplesPerFile)
-        # Progressively save samples per audio file
-        append = (progress > 0 and not MULTIFILE_OUTPUT)
-        writeCsv(outputFilename, result, headings=headings, append=append)
-        totalCount += len(result)
+# the manifest has a line for each file whose samples are in the output; the line is written after the samples,
+# so a file that was cut off by a crash isn't in it
+manifest = {}
+hasManifest = os.path.isfile(MANIFEST_FILE) and not OVERWRITE
+for entry in (readJSONLines(MANIFEST_FILE) if hasManifest else []):
+    manifest[entry["filename"]] = entry
+manifest = dict([(fn, entry) for fn, entry in manifest.items() if isDone(entry)])
 
+# Get existing data
+rows = []
+if os.path.isfile(OUTPUT_FILE) and not OVERWRITE and not MULTIFILE_OUTPUT:
+    # the last row may have been cut off by a crash, so csv values are kept as they are rather than parsed
+    fieldNames, rows = readCsv(OUTPUT_FILE, doParseNumbers=isTableFile(OUTPUT_FILE))
+
+if not hasManifest and not OVERWRITE:
+    # output written before there was a manifest is kept as it is, and files that have samples in it count as done; rows only
+    # have the file's basename, so files with the same basename share its samples: the first one gets them and the rest get none
+    rowCounts = dict(getCounts(rows, "filename"))
+    for f in files:
+        fn = f["filename"]
+        basename = os.path.basename(fn)
+        if basename in rowCounts:
+            manifest[fn] = getManifestEntry(fn, rowCounts[basename])
+            rowCounts[basename] = 0
+        elif MULTIFILE_OUTPUT and os.path.isfile(OUTPUT_FILE % basename):
+            manifest[fn] = getManifestEntry(fn, len(readCsv(OUTPUT_FILE % basename, verbose=False)[1]))
+            rowCounts[basename] = 0
+    if len(manifest) > 0:
+        print("Found samples for %s files in existing output; adding them to %s" % (len(manifest), MANIFEST_FILE))
+
+elif not MULTIFILE_OUTPUT:
+    # only keep samples of files that are done and have all their samples in the output; rows only have the file's basename,
+    # so files with the same basename are kept or done again together
+    rowCounts = dict(getCounts(rows, "filename"))
+    doneCounts = {}
+    for fn, entry in manifest.items():
+        basename = os.path.basename(fn)
+        doneCounts[basename] = doneCounts.get(basename, 0) + entry["count"]
+    manifest = dict([(fn, entry) for fn, entry in manifest.items() if rowCounts.get(os.path.basename(fn), 0) == doneCounts[os.path.basename(fn)]])
+    validRows = [row for row in rows if doneCounts.get(row["filename"], -1) == rowCounts[row["filename"]]]
+    if len(validRows) < len(rows):
+        print("Removing %s samples of changed or unfinished files from %s..." % (len(rows)-len(validRows), OUTPUT_FILE))
+        tmpFilename = appendToBasename(OUTPUT_FILE, ".%s.tmp" % os.getpid())
+        writeCsv(tmpFilename, validRows, headings=fieldNames)
+        os.replace(tmpFilename, OUTPUT_FILE)
+    rows = validRows
+
+else:
+    manifest = dict([(fn, entry) for fn, entry in manifest.items() if os.path.isfile(OUTPUT_FILE % os.path.basename(fn))])
+makeDirectories(MANIFEST_FILE)
+writeJSONLines(MANIFEST_FILE, list(manifest.values()))
+
+# Check which files we already have data for
+pending = []
+for f in files:
+    fn = f["filename"]
+    if fn in manifest:
+        totalCount += manifest[fn]["count"]
+        progress += 1
+    else:
+        pending.append(fn)
+if progress > 0:
+    print("Already found samples for %s files. Skipping." % progress)
+
+print("Getting samples for %s files..." % len(pending))
+# files are analyzed in worker processes; samples are saved here as each file finishes
+append = (len(rows) > 0)
+# tables can't be appended to, so a single table output is written (and its files marked as done) once all files are analyzed
+writeOnce = isTableFile(OUTPUT_FILE) and not MULTIFILE_OUTPUT
+entries = []
+for fn, result in mapItems(processFile, pending, workers=getThreadCount(args.THREADS), useProcesses=(not args.THREADED)):
+    outputFilename = OUTPUT_FILE if not MULTIFILE_OUTPUT else OUTPUT_FILE % os.path.basename(fn)
+    entry = getManifestEntry(fn, len(result))
+    if writeOnce:
+        rows += result
+        entries.append(entry)
+    else:
+        # Progressively save samples per audio file, then mark the file as done
+        writeCsv(outputFilename, result, headings=headings, append=(append and not MULTIFILE_OUTPUT))
+        append = True
+        appendJSONLine(MANIFEST_FILE, entry)
+    totalCount += len(result)
     progress += 1
     printProgress(progress, fileCount)
 
-print("Getting file samples...")
-pool = ThreadPool(getThreadCount(args.THREADS))
-results = pool.map(processFile, files)
-pool.close()
-pool.join()
+if writeOnce and len(entries) > 0:
+    writeCsv(OUTPUT_FILE, rows, headings=headings)
+    writeJSONLines(MANIFEST_FILE, list(manifest.values()) + entries)
 
 print("%s samples in total." % totalCount)
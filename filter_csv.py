@@ -10,6 +10,7 @@ import sys
 from lib.collection_utils import *
 from lib.io_utils import *
 from lib.math_utils import *
+from lib.table_utils import *
 
 # input
 parser = argparse.ArgumentParser()
@@ -24,25 +25,27 @@ a = parser.parse_args()
 OUTPUT_FILE = a.OUTPUT_FILE if len(a.OUTPUT_FILE) > 0 else a.INPUT_FILE
 
 # Read files
-fieldNames, rows = readCsv(a.INPUT_FILE)
-rowCount = len(rows)
+table = loadTable(a.INPUT_FILE)
+fieldNames = table.fieldnames
+indices = table.filter("")
+rowCount = len(indices)
 
 if len(a.FILTER) > 0:
-    rows = filterByQueryString(rows, a.FILTER)
-    rowCount = len(rows)
+    indices = table.filter(a.FILTER)
+    rowCount = len(indices)
     print("%s rows after filtering" % rowCount)
 
 if len(a.SORT) > 0:
-    rows = sortByQueryString(rows, a.SORT)
-    rowCount = len(rows)
+    indices = table.sort(a.SORT, indices)
+    rowCount = len(indices)
     print("%s rows after sorting" % rowCount)
 
 if a.LIMIT > 0 and rowCount > a.LIMIT:
-    rows = rows[:a.LIMIT]
-    rowCount = len(rows)
+    indices = indices[:a.LIMIT]
+    rowCount = len(indices)
     print("%s rows after limiting" % rowCount)
 
 if a.PROBE:
     sys.exit()
 
-writeCsv(OUTPUT_FILE, rows, headings=fieldNames)
+writeCsv(OUTPUT_FILE, table.getRows(indices), headings=fieldNames)
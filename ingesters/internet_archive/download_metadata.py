@@ -72,12 +72,17 @@ else:
 
 writeCsv(OUTPUT_FILE, rows, RETURN_KEYS)
 
+startPage = page
 while page < pages:
     page += 1
     data = getJSONFromURL(url + "&page=%s" % page)
     docs = data["response"]["docs"]
-    writeCsv(OUTPUT_FILE, docs, RETURN_KEYS, append=True)
+    # tables can't be appended to, so they're written once all pages are in
+    if not isTableFile(OUTPUT_FILE):
+        writeCsv(OUTPUT_FILE, docs, RETURN_KEYS, append=True)
     rows += docs
+if isTableFile(OUTPUT_FILE) and page > startPage:
+    writeCsv(OUTPUT_FILE, rows, RETURN_KEYS)
 
 # Also download derivative data
 if FORMAT:
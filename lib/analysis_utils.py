@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# Decodes a media file once and derives everything the ingest scripts need (onsets, power/pitch/clarity, feature vectors, fingerprints)
+# from one spectrogram of the whole file. Results are kept per media file in a columnar .npz sidecar, so later scripts read them
+# instead of decoding the file again
+
+import hashlib
+import json
+from lib.audio_utils import *
+from lib.io_utils import *
+from lib.math_utils import *
+import librosa
+import numpy as np
+import os
+
+ANALYSIS_FEATURES = ["features", "vectors", "fingerprints"]
+FEATURE_COLUMNS = [("power", np.float64), ("hz", np.float64), ("clarity", np.float64), ("note", "U8"), ("octave", np.int32), ("harmonics", np.int32)]
+
+def analyzeFile(fn, storeDir="tmp/analysis/", samples=None, features=[], minDur=80, maxDur=1000, delta=0.07, fft=2048, hopLength=512, cellW=32, cellH=32, useLog=False, overwrite=False):
+    """Returns a list of sample dicts for the file with the requested features ("features", "vectors", "fingerprints");
+    samples are detected from onsets unless a list of samples with start and dur is passed in"""
+    params = {
+        "stft": {"fft": fft, "hopLength": hopLength},
+        # onsets only matter if we're detecting samples
+        "onsets": {"minDur": minDur, "maxDur": maxDur, "delta": delta} if samples is None else None,
+        "fingerprints": {"cellW": cellW, "cellH": cellH, "useLog": useLog}
+    }
+    storeFn = getAnalysisFilename(fn, storeDir)
+    columns = None if overwrite else loadAnalysis(storeFn, fn, params)
+    hasOnsets = columns is not None and columns["hasOnsets"]
+    if columns is None:
+        columns = getEmptyAnalysis(0, cellW, cellH)
+    if params["onsets"] is None:
+        params["onsets"] = columns["onsetParams"] if "onsetParams" in columns else None
+
+    # figure out what we still need to compute
+    keys = getAnalysisKeys(columns)
+    if samples is None:
+        sampleKeys = [k for k, i in keys.items() if columns["isOnset"][i]] if hasOnsets else None
+    else:
+        sampleKeys = [(roundInt(s["start"]), roundInt(s["dur"])) for s in samples]
+    missing = sampleKeys is None or any(k not in keys for k in sampleKeys)
+    if not missing:
+        rows = [keys[k] for k in sampleKeys]
+        missing = any(not columns["has_"+f][i] for i in rows for f in features)
+
+    if missing:
+        audiofn = getAudioFile(fn)
+        print("Analyzing %s..." % audiofn)
+        y, sr = loadAudioData(audiofn)
+        duration = int(getDurationFromAudioData(y, sr) * 1000)
+        # the whole-file stft is only computed if onsets, feature vectors or fingerprints need it
+        S = None
+
+        # detect samples from onsets
+        if sampleKeys is None:
+            S = getWholeStft(y, fft, hopLength)
+            detected = []
+            if duration > 0 and S.shape[1] > 0:
+                onsets = getSuperFluxOnsets(S, sr, fft=fft, hop_length=hopLength, delta=delta)
+                detected = getSamplesFromOnsets(onsets, duration, os.path.basename(fn), sr, hop_length=hopLength, min_dur=minDur, max_dur=maxDur)
+            sampleKeys = [(s["start"], s["dur"]) for s in detected]
+            hasOnsets = True
+            # samples detected earlier with the same keys are onsets again
+            for k in sampleKeys:
+                if k in keys:
+                    columns["isOnset"][keys[k]] = True
+
+        # add rows for new samples
+        newKeys = [k for k in sampleKeys if k not in keys]
+        if len(newKeys) > 0:
+            newColumns = getEmptyAnalysis(len(newKeys), cellW, cellH)
+            newColumns["start"][:] = [k[0] for k in newKeys]
+            newColumns["dur"][:] = [k[1] for k in newKeys]
+            newColumns["isOnset"][:] = (samples is None)
+            columns = concatAnalysis(columns, newColumns)
+            keys = getAnalysisKeys(columns)
+
+        # compute missing features
+        rows = [keys[k] for k in sampleKeys]
+        if "features" in features:
+            featureRows = [i for i in rows if not columns["has_features"][i]]
+            featureSamples = [{"start": int(columns["start"][i]), "dur": int(columns["dur"][i])} for i in featureRows]
+            for i, sfeatures in zip(featureRows, getFeaturesFromAudioData(y, sr, featureSamples, fft=fft, hop_length=hopLength)):
+                for key, dtype in FEATURE_COLUMNS:
+                    if key in sfeatures:
+                        columns[key][i] = sfeatures[key]
+                columns["has_features"][i] = True
+        sampleCount = len(rows)
+        stftFeatures = [f for f in ("vectors", "fingerprints") if f in features]
+        if S is None and any(not columns["has_"+f][i] for i in rows for f in stftFeatures):
+            S = getWholeStft(y, fft, hopLength)
+        for j, i in enumerate(rows):
+            start = columns["start"][i]
+            dur = columns["dur"][i]
+            if "vectors" in features and not columns["has_vectors"][i]:
+                columns["featureVector"][i] = getFeatureVectorFromStft(S, sr, start, dur, hopLength)
+                columns["has_vectors"][i] = True
+            if "fingerprints" in features and not columns["has_fingerprints"][i]:
+                columns["fingerprint"][i] = getFingerprintFromStft(S, sr, start, dur, hopLength, cellW, cellH, useLog)
+                columns["has_fingerprints"][i] = True
+            printProgress(j+1, sampleCount)
+
+        columns["hasOnsets"] = hasOnsets
+        saveAnalysis(storeFn, fn, params, columns)
+
+    return analysisToSamples(columns, [keys[k] for k in sampleKeys], os.path.basename(fn), features)
+
+def analysisToSamples(columns, rows, basename, features):
+    samples = []
+    for i in rows:
+        sample = {"filename": basename, "start": int(columns["start"][i]), "dur": int(columns["dur"][i])}
+        if "features" in features:
+            for key, dtype in FEATURE_COLUMNS:
+                value = columns[key][i]
+                sample[key] = str(value) if dtype == "U8" else value.item()
+        if "vectors" in features:
+            sample["featureVector"] = columns["featureVector"][i]
+        if "fingerprints" in features:
+            sample["fingerprint"] = columns["fingerprint"][i]
+        samples.append(sample)
+    return samples
+
+def concatAnalysis(columns, newColumns):
+    merged = columns.copy()
+    for key in newColumns:
+        if key != "hasOnsets":
+            merged[key] = np.concatenate((columns[key], newColumns[key]))
+    return merged
+
+def getAnalysisFilename(fn, storeDir):
+    # media with the same name in different directories get their own store
+    pathHash = hashlib.md5(os.path.abspath(fn).encode("utf-8")).hexdigest()[:12]
+    return storeDir + os.path.basename(fn) + "." + pathHash + ".analysis.npz"
+
+def getAnalysisKeys(columns):
+    return dict([((int(start), int(dur)), i) for i, (start, dur) in enumerate(zip(columns["start"], columns["dur"]))])
+
+def getAnalysisSource(fn):
+    stat = os.stat(fn) if os.path.isfile(fn) else None
+    return {"size": stat.st_size, "mtime": stat.st_mtime} if stat is not None else {}
+
+def getEmptyAnalysis(count, cellW, cellH):
+    columns = {
+        "hasOnsets": False,
+        "start": np.zeros(count, dtype=np.int64),
+        "dur": np.zeros(count, dtype=np.int64),
+        "isOnset": np.zeros(count, dtype=bool),
+        "featureVector": np.zeros((count, 39), dtype=np.float32),
+        "fingerprint": np.zeros((count, cellH, cellW), dtype=np.float32)
+    }
+    for key, dtype in FEATURE_COLUMNS:
+        columns[key] = np.full(count, "-", dtype=dtype) if dtype == "U8" else np.full(count, -1, dtype=dtype)
+    for feature in ANALYSIS_FEATURES:
+        columns["has_"+feature] = np.zeros(count, dtype=bool)
+    return columns
+
+# Taken from: https://github.com/ml4a/ml4a-guides/blob/master/notebooks/audio-tsne.ipynb
+def getFeatureVectorFromStft(S, sr, start, dur, hop_length=512):
+    # take at most one second
+    dur = min(dur, 1000)
+    S = getStftRange(S, sr, start, dur, hop_length)
+    if S.shape[1] < 1:
+        return np.zeros(39, dtype=np.float32)
+
+    mels = librosa.feature.melspectrogram(S=S**2, sr=sr, n_mels=128)
+    log_S = librosa.amplitude_to_db(mels, ref=np.max)
+    mfcc = librosa.feature.mfcc(S=log_S, n_mfcc=13)
+    delta_mfcc = librosa.feature.delta(mfcc, mode='nearest')
+    delta2_mfcc = librosa.feature.delta(mfcc, order=2, mode='nearest')
+    feature_vector = np.concatenate((np.mean(mfcc,1), np.mean(delta_mfcc,1), np.mean(delta2_mfcc,1)))
+    feature_vector = (feature_vector-np.mean(feature_vector))/np.std(feature_vector)
+    return np.nan_to_num(feature_vector)
+
+# Adapted from: https://github.com/kylemcdonald/AudioNotebooks/blob/master/Samples%20to%20Fingerprints.ipynb
+def getFingerprintFromStft(S, sr, start, dur, hop_length=512, cellW=32, cellH=32, useLog=False):
+    # take at most one second
+    dur = min(dur, 1000)
+    amp = getStftRange(S, sr, start, dur, hop_length)
+
+    reduce_rows = 10 # how many frequency bands to average into one
+    # average blocks of frequency bands; we only keep the lowest cellH blocks
+    rows = min(amp.shape[0], cellH * reduce_rows)
+    amp = amp[:rows]
+    if rows % reduce_rows > 0:
+        amp = np.pad(amp, ((0, reduce_rows - rows % reduce_rows), (0, 0)), 'constant')
+    amp = amp.reshape(-1, reduce_rows, amp.shape[1]).mean(axis=1)
+    if amp.shape[1] < cellW:
+        amp = np.pad(amp, ((0, 0), (0, cellW-amp.shape[1])), 'constant')
+    amp = amp[:cellH, :cellW]
+    if useLog:
+        amp = librosa.amplitude_to_db(amp**2)
+    amp -= amp.min()
+    if amp.max() > 0:
+        amp /= amp.max()
+    amp = np.flipud(amp) # for visualization, put low frequencies on bottom
+    return amp
+
+def getStftRange(S, sr, start, dur, hop_length=512):
+    # the columns of a whole-file stft that cover the sample, i.e. what the stft of just the sample would have
+    i0 = int(round(start / 1000.0 * sr))
+    i1 = int(round((start+dur) / 1000.0 * sr))
+    j0 = min(int(round(1.0 * i0 / hop_length)), S.shape[1])
+    j1 = min(j0 + 1 + max(0, i1 - i0) // hop_length, S.shape[1])
+    return S[:, j0:j1]
+
+def getWholeStft(y, fft=2048, hopLength=512):
+    return np.abs(librosa.stft(y, n_fft=fft, hop_length=hopLength)) if len(y) > 0 else np.zeros((1 + fft//2, 0))
+
+def loadAnalysis(storeFn, fn, params):
+    if not os.path.isfile(storeFn):
+        return None
+    with np.load(storeFn) as data:
+        meta = json.loads(str(data["meta"]))
+        # the analysis is stale if the media file or the stft parameters changed
+        if meta["params"]["stft"] != params["stft"] or meta["source"] != getAnalysisSource(getAudioFile(fn)):
+            return None
+        columns = dict([(key, data[key]) for key in data.files if key != "meta"])
+    columns["hasOnsets"] = bool(columns["hasOnsets"])
+    columns["onsetParams"] = meta["params"]["onsets"]
+    # samples were detected with different settings, so detect them again
+    if params["onsets"] is not None and params["onsets"] != meta["params"]["onsets"]:
+        columns["hasOnsets"] = False
+        columns["isOnset"][:] = False
+    # fingerprints have a different size or scale, so compute them again
+    if params["fingerprints"] != meta["params"]["fingerprints"]:
+        fingerprints = params["fingerprints"]
+        columns["has_fingerprints"][:] = False
+        columns["fingerprint"] = np.zeros((len(columns["start"]), fingerprints["cellH"], fingerprints["cellW"]), dtype=np.float32)
+    return columns
+
+def saveAnalysis(storeFn, fn, params, columns):
+    makeDirectories(storeFn)
+    meta = {"params": params, "source": getAnalysisSource(getAudioFile(fn))}
+    columns = dict([(key, value) for key, value in columns.items() if key != "onsetParams"])
+    # write to a temporary file first so an interrupted write doesn't leave a broken store
+    tmpFn = storeFn + ".tmp.npz"
+    np.savez(tmpFn, meta=np.array(json.dumps(meta)), **columns)
+    os.replace(tmpFn, storeFn)
@@ -1,11 +1,49 @@
 from lib.audio_utils import *
+from lib.cache_utils import *
 from lib.collection_utils import *
+import hashlib
 from lib.io_utils import *
 from lib.math_utils import *
+from lib.processing_utils import *
+import json
+import math
+import numpy as np
 import os
 from pydub import AudioSegment
 import sys
 
+# everything getAudioClip and applyAudioProperties read from an instruction, i.e. what the processed audio depends on
+SEGMENT_PROPERTIES = ["start", "dur", "matchDb", "maxMatchDb", "useMaxDBFS", "maxDb", "reverse", "db", "pan", "fadeIn", "fadeOut", "stretch", "stretchTo", "reverb", "distortion", "highpass", "lowpass"]
+
+segmentCaches = {}
+
+class TrackWindows:
+    # a float (frames, channels) track buffer that only allocates the fixed-length windows that audio is added to
+    def __init__(self, frameCount, channels, windowFrames):
+        self.shape = (frameCount, channels)
+        self.windowFrames = windowFrames
+        self.windows = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def add(self, frameStart, data):
+        frameCount, channels = self.shape
+        frameEnd = frameStart + len(data)
+        for w in range(frameStart // self.windowFrames, (frameEnd - 1) // self.windowFrames + 1):
+            w0 = w * self.windowFrames
+            if w not in self.windows:
+                self.windows[w] = np.zeros((min(self.windowFrames, frameCount - w0), channels), dtype=np.float32)
+            i0 = max(frameStart, w0)
+            i1 = min(frameEnd, w0 + self.windowFrames)
+            self.windows[w][i0-w0:i1-w0] += data[i0-frameStart:i1-frameStart]
+
+    def mixInto(self, trackData):
+        for w, window in self.windows.items():
+            w0 = w * self.windowFrames
+            trackData[w0:w0+len(window)] += window
+        return trackData
+
 def getAudioSequenceDuration(sequence):
     if len(sequence) <= 0:
         return 0
@@ -13,94 +51,313 @@ def getAudioSequenceDuration(sequence):
     lastAudioClip = sequence[-1]
     return lastAudioClip["ms"] + lastAudioClip["dur"]
 
+def getMixData(audio, channels, sampleRate=48000):
+    # processed audio as the float (frames, channels) data that is added into a track
+    if audio.channels != channels:
+        audio = audio.set_channels(channels)
+    if audio.frame_rate != sampleRate:
+        audio = audio.set_frame_rate(sampleRate)
+    return audioToNpArr(audio)
+
+def getSegmentCache(cacheDir="tmp/segments/", cacheBytes=2*1024**3, cacheMemoryBytes=512*1024**2):
+    # one cache per set of arguments and process, so tracks rendered by the same worker share its index of the cache directory
+    if cacheMemoryBytes <= 0 and not cacheDir:
+        return None
+    key = (cacheDir, cacheBytes, cacheMemoryBytes)
+    if key not in segmentCaches:
+        segmentCaches[key] = ArrayCache(cacheDir, cacheBytes, cacheMemoryBytes)
+    return segmentCaches[key]
+
+def getSegmentCacheKey(instruction, sfx, fxPad, sampleRate, channels, sources):
+    # sources caches the size and modified time of each source file so each file is only checked once
+    filename = instruction["filename"]
+    if filename not in sources:
+        audiofilename = getAudioFile(filename)
+        stat = os.stat(audiofilename) if os.path.isfile(audiofilename) else None
+        sources[filename] = [os.path.abspath(audiofilename), stat.st_size, stat.st_mtime] if stat is not None else [filename]
+    props = dict([(key, instruction[key]) for key in SEGMENT_PROPERTIES if key in instruction])
+    value = json.dumps([sources[filename], props, sfx, fxPad if sfx else 0, sampleRate, channels], sort_keys=True, default=str)
+    return hashlib.md5(value.encode("utf-8")).hexdigest()
+
+def getSegments(filename, clips, sampleWidth=4, sampleRate=48000, channels=2):
+    # load audio file
+    # compositions are often mixed again with different clips of the same files, so decoded files are cached too
+    audio = getAudio(filename, sampleWidth, sampleRate, channels, cacheDir=DECODED_AUDIO_CACHE_DIR)
+    audioDurationMs = len(audio)
+
+    # make segments from clips
+    segments = []
+    for clipStart, clipDur in clips:
+        clip = getAudioClip(audio, clipStart, clipDur, audioDurationMs)
+        if clip is None:
+            continue
+        segments.append({
+            "id": (clipStart, clipDur),
+            "start": clipStart,
+            "dur": clipDur,
+            "audio": clip
+        })
+    return segments
+
 def makeTrack(duration, instructions, segments, sfx=True, sampleWidth=4, sampleRate=48000, channels=2, fxPad=3000):
     # build audio
-    baseAudio = AudioSegment.silent(duration=duration, frame_rate=sampleRate)
-    baseAudio = baseAudio.set_channels(channels)
-    baseAudio = baseAudio.set_sample_width(sampleWidth)
-    instructionCount = len(instructions)
-    for index, i in enumerate(instructions):
-        segment = [s for s in segments if s["id"]==(i["start"], i["dur"])].pop()
-        audio = segment["audio"]
-        audio = applyAudioProperties(audio, i, sfx, fxPad)
-        # convert sample width
-        if audio.sample_width != sampleWidth:
-            # print("Warning: sample width changed to %s from %s" % (sampleWidth, audio.sample_width))
-            audio = audio.set_sample_width(sampleWidth)
-        baseAudio = baseAudio.overlay(audio, position=i["ms"])
-        sys.stdout.write('\r')
-        sys.stdout.write("%s%%" % round(1.0*(index+1)/instructionCount*100,1))
-        sys.stdout.flush()
-    return baseAudio
-
-def mixAudio(instructions, duration, outfilename, sfx=True, sampleWidth=4, sampleRate=48000, channels=2, fxPad=3000, masterDb=0.0, outputTracks=False, tracksDir="output/tracks/%s.wav"):
+    trackData = np.zeros((msToFrame(duration, sampleRate), channels), dtype=np.float32)
+    mixTrack(trackData, instructions, segments, sfx=sfx, sampleRate=sampleRate, fxPad=fxPad)
+    return npArrToAudio(trackData, sampleWidth, sampleRate)
+
+def mixAudio(instructions, duration, outfilename, sfx=True, sampleWidth=4, sampleRate=48000, channels=2, fxPad=3000, masterDb=0.0, outputTracks=False, tracksDir="output/tracks/%s.wav", cacheDir="tmp/segments/", cacheBytes=2*1024**3, cacheMemoryBytes=512*1024**2, workers=1, windowMs=60000, stream=False):
+    if stream:
+        if outputTracks:
+            print("Warning: tracks are not written when streaming the mix")
+        return mixAudioStream(instructions, duration, outfilename, sfx, sampleWidth, sampleRate, channels, fxPad, masterDb, cacheDir, cacheBytes, cacheMemoryBytes)
+
     # remove instructions with no volume
     instructions = [i for i in instructions if "volume" not in i or i["volume"] > 0]
-    audioFiles = list(set([i["filename"] for i in instructions]))
-    audioFiles = [{"filename": f} for f in audioFiles]
     instructionCount = len(instructions)
-    trackCount = len(audioFiles)
 
     # calculate db
     for i, step in enumerate(instructions):
         if "volume" in step:
             instructions[i]["db"] = volumeToDb(step["volume"])
 
-    # create base audio
-    baseAudio = AudioSegment.silent(duration=duration, frame_rate=sampleRate)
-    baseAudio = baseAudio.set_channels(channels)
-    baseAudio = baseAudio.set_sample_width(sampleWidth)
-
-    # Load sounds
-    print("Adding tracks...")
-    for i, af in enumerate(audioFiles):
-        filename = af["filename"]
-        audioFiles[i]["index"] = i
-
-        # load audio file
-        audio = getAudio(filename, sampleWidth, sampleRate, channels)
-        audioDurationMs = len(audio)
-
-        # look through instructions to find unique clips
-        clips = [(ii["start"], ii["dur"]) for ii in instructions if ii["filename"]==filename]
-        clips = list(set(clips))
-
-        # make segments from clips
-        segments = []
-        for clipStart, clipDur in clips:
-            clip = getAudioClip(audio, clipStart, clipDur, audioDurationMs)
-            if clip is None:
-                continue
-            segments.append({
-                "id": (clipStart, clipDur),
-                "start": clipStart,
-                "dur": clipDur,
-                "audio": clip
-            })
-
-        # make the track
-        trackInstructions = [ii for ii in instructions if ii["filename"]==af["filename"]]
-        print("Making track %s of %s with %s segments and %s instructions..." % (i+1, trackCount, len(segments), len(trackInstructions)))
-        trackAudio = makeTrack(duration, trackInstructions, segments, sfx=sfx, sampleWidth=sampleWidth, sampleRate=sampleRate, channels=channels, fxPad=fxPad)
-        baseAudio = baseAudio.overlay(trackAudio)
-        if outputTracks:
-            trackfilename = tracksDir % getBasename(filename)
-            format = trackfilename.split(".")[-1]
-            # adjust master volume
-            if masterDb != 0.0:
-                trackAudio = trackAudio.apply_gain(masterDb)
-            trackAudio.export(trackfilename, format=format)
-            print("Wrote to %s" % trackfilename)
-        print("Track %s of %s complete." % (i+1, trackCount))
+    # index instructions by file in one pass
+    fileInstructions = {}
+    for step in instructions:
+        fileInstructions.setdefault(step["filename"], []).append(step)
+    trackCount = len(fileInstructions)
+
+    # create base audio; tracks are summed as floats and only clipped once when writing
+    frameCount = msToFrame(duration, sampleRate)
+    baseData = np.zeros((frameCount, channels), dtype=np.float32)
+    masterGain = np.float32(dbToAmplitude(masterDb))
+
+    # each track is rendered on its own (in parallel if there's more than one worker) into windows of windowMs,
+    # so a track only holds memory for the parts of the mix it plays in
+    tracks = []
+    for filename, trackInstructions in fileInstructions.items():
+        tracks.append({
+            "filename": filename,
+            "instructions": trackInstructions,
+            "frameCount": frameCount,
+            "channels": channels,
+            "sampleWidth": sampleWidth,
+            "sampleRate": sampleRate,
+            "sfx": sfx,
+            "fxPad": fxPad,
+            "windowFrames": max(1, msToFrame(windowMs, sampleRate)),
+            "trackfilename": (tracksDir % getBasename(filename)) if outputTracks else None,
+            "masterGain": masterGain,
+            # processed clips are reused between identical instructions and, if there's a cache directory, between runs
+            "cacheArgs": (cacheDir, cacheBytes, int(cacheMemoryBytes / max(1, workers))),
+            "verbose": (workers <= 1)
+        })
+
+    print("Adding %s tracks..." % trackCount)
+    hits = misses = 0
+    for i, result in enumerate(mapItems(renderTrack, tracks, workers=workers)):
+        # sum the tracks into the base audio as they finish, so only the tracks being rendered are held in memory
+        result["windows"].mixInto(baseData)
+        hits += result["hits"]
+        misses += result["misses"]
+        if result["trackfilename"] is not None:
+            print("Wrote to %s" % result["trackfilename"])
+        print("Track %s of %s complete (%s)." % (i+1, trackCount, result["filename"]))
+
+    if hits + misses > 0:
+        print("Processed clip cache: %s hits, %s misses" % (hits, misses))
+    # each worker only sees part of what the others wrote to the cache directory, so it's brought back under its limit here
+    if workers > 1 and cacheDir:
+        ArrayCache(cacheDir, cacheBytes, 0).evict()
 
     print("Writing to file...")
     format = outfilename.split(".")[-1]
     # adjust master volume
     if masterDb != 0.0:
-        baseAudio = baseAudio.apply_gain(masterDb)
+        baseData *= masterGain
+    baseAudio = npArrToAudio(baseData, sampleWidth, sampleRate)
     f = baseAudio.export(outfilename, format=format)
     print("Wrote to %s" % outfilename)
 
+def mixAudioData(trackData, instruction, data, sampleRate=48000):
+    # add float (frames, channels) data into the track buffer at the instruction's position; data outside of the track is cut off
+    frameCount = len(trackData)
+    frameStart = msToFrame(instruction["ms"], sampleRate)
+    if frameStart < 0:
+        data = data[-frameStart:]
+        frameStart = 0
+    frameEnd = min(frameStart + len(data), frameCount)
+    if frameEnd > frameStart:
+        if isinstance(trackData, TrackWindows):
+            trackData.add(frameStart, data[:frameEnd-frameStart])
+        else:
+            trackData[frameStart:frameEnd] += data[:frameEnd-frameStart]
+    return trackData
+
+def mixAudioStream(instructions, duration, outfilename, sfx=True, sampleWidth=4, sampleRate=48000, channels=2, fxPad=3000, masterDb=0.0, cacheDir="tmp/segments/", cacheBytes=2*1024**3, cacheMemoryBytes=512*1024**2, windowMs=30000):
+    # mixes instructions in start time order into fixed-size windows that are written to the output file as soon as no more
+    # instructions can start in them, so memory depends on the window size and the longest play rather than the mix duration
+    instructions = [i for i in instructions if "volume" not in i or i["volume"] > 0]
+    for i, step in enumerate(instructions):
+        if "volume" in step:
+            instructions[i]["db"] = volumeToDb(step["volume"])
+    instructions = sorted(instructions, key=lambda i: i["ms"])
+    instructionCount = len(instructions)
+
+    # each file is decoded once, when it's first played, and its segments are dropped after its last play
+    fileClips = {}
+    lastPlays = {}
+    for index, step in enumerate(instructions):
+        fileClips.setdefault(step["filename"], set()).add((step["start"], step["dur"]))
+        lastPlays[step["filename"]] = index
+    fileSegments = {}
+    def loadSegments(filename):
+        if filename not in fileSegments:
+            fileSegments[filename] = getSegments(filename, list(fileClips[filename]), sampleWidth, sampleRate, channels)
+        return fileSegments[filename]
+
+    frameCount = msToFrame(duration, sampleRate)
+    windowFrames = max(1, msToFrame(windowMs, sampleRate))
+    windowCount = int(math.ceil(1.0 * frameCount / windowFrames))
+    windows = TrackWindows(frameCount, channels, windowFrames)
+    masterGain = np.float32(dbToAmplitude(masterDb))
+    cache = getSegmentCache(cacheDir, cacheBytes, cacheMemoryBytes)
+    # the cache can outlive this mix, so only this mix's hits and misses are counted
+    hits0 = cache.hits if cache is not None else 0
+    misses0 = cache.misses if cache is not None else 0
+
+    writer = AudioStreamWriter(outfilename, sampleWidth, sampleRate, channels)
+    index = 0
+    for w in range(windowCount):
+        # mix everything that starts in this window; later windows keep the tails of plays that cross the window's end
+        windowEnd = (w + 1) * windowFrames
+        batchStart = index
+        while index < instructionCount and msToFrame(instructions[index]["ms"], sampleRate) < windowEnd:
+            index += 1
+        fileInstructions = {}
+        for step in instructions[batchStart:index]:
+            fileInstructions.setdefault(step["filename"], []).append(step)
+        for filename, trackInstructions in fileInstructions.items():
+            segments = (lambda: loadSegments(filename)) if cache is not None else loadSegments(filename)
+            mixTrack(windows, trackInstructions, segments, sfx=sfx, sampleRate=sampleRate, fxPad=fxPad, cache=cache, verbose=False)
+            if lastPlays[filename] < index:
+                fileSegments.pop(filename, None)
+
+        data = windows.windows.pop(w, None)
+        if data is None:
+            data = np.zeros((min(windowFrames, frameCount - w * windowFrames), channels), dtype=np.float32)
+        # adjust master volume
+        if masterDb != 0.0:
+            data *= masterGain
+        writer.write(data)
+        printProgress(w+1, windowCount)
+
+    writer.close()
+    print("")
+    if cache is not None:
+        print("Processed clip cache: %s hits, %s misses" % (cache.hits - hits0, cache.misses - misses0))
+    print("Wrote to %s" % outfilename)
+
+def mixTrack(trackData, instructions, segments, sfx=True, sampleRate=48000, fxPad=3000, fxBatchSize=64, cache=None, verbose=True):
+    # add each instruction's processed audio into the float (frames, channels) buffer in place; with a cache, segments can be a
+    # function that returns them, which is only called once some instruction's processed audio isn't in the cache
+    channels = trackData.shape[1]
+    instructionCount = len(instructions)
+    sources = {}
+    segmentsById = None
+    for batchStart in range(0, instructionCount, fxBatchSize):
+        batch = instructions[batchStart:batchStart+fxBatchSize]
+        # without a cache every instruction is processed on its own
+        keys = [getSegmentCacheKey(i, sfx, fxPad, sampleRate, channels, sources) for i in batch] if cache is not None else list(range(len(batch)))
+        datas = {}
+        audios = {}
+        for key, i in zip(keys, batch):
+            if key in datas or key in audios:
+                continue
+            if cache is not None:
+                data = cache.get(key)
+                if data is not None:
+                    datas[key] = data
+                    continue
+            if segmentsById is None:
+                if callable(segments):
+                    segments = segments()
+                segmentsById = dict([(s["id"], s) for s in segments])
+            segment = segmentsById[(i["start"], i["dur"])]
+            audios[key] = applyAudioProperties(segment["audio"], i, sfx, fxPad, fx=False)
+
+        # clips in the batch with the same effects and format go through the effects chain together
+        if sfx:
+            fxGroups = {}
+            for key, i in zip(keys, batch):
+                if key not in audios:
+                    continue
+                effects = getAudioFx(i)
+                if len(effects) > 0:
+                    audio = audios[key]
+                    groupKey = (tuple(effects), audio.channels, audio.sample_width, audio.frame_rate)
+                    if key not in fxGroups.setdefault(groupKey, []):
+                        fxGroups[groupKey].append(key)
+            for groupKey, groupKeys in fxGroups.items():
+                fxAudios = addFxToSounds([audios[key] for key in groupKeys], list(groupKey[0]), pad=fxPad)
+                for key, audio in zip(groupKeys, fxAudios):
+                    audios[key] = audio
+
+        for key, audio in audios.items():
+            datas[key] = getMixData(audio, channels, sampleRate)
+            if cache is not None:
+                datas[key] = cache.put(key, datas[key])
+
+        for j, i in enumerate(batch):
+            mixAudioData(trackData, i, datas[keys[j]], sampleRate)
+            if verbose:
+                index = batchStart + j
+                sys.stdout.write('\r')
+                sys.stdout.write("%s%%" % round(1.0*(index+1)/instructionCount*100,1))
+                sys.stdout.flush()
+    return trackData
+
+def renderTrack(track):
+    # renders one file's instructions into a TrackWindows buffer; runs in a worker process when mixing in parallel
+    filename = track["filename"]
+    trackInstructions = track["instructions"]
+    sampleWidth = track["sampleWidth"]
+    sampleRate = track["sampleRate"]
+    channels = track["channels"]
+    cache = getSegmentCache(*track["cacheArgs"])
+    # the cache is shared by every track rendered in this process, so only this track's hits and misses are counted
+    hits0 = cache.hits if cache is not None else 0
+    misses0 = cache.misses if cache is not None else 0
+
+    # find unique clips; the file is only decoded if some of its processed clips aren't in the cache
+    clips = list(set([(ii["start"], ii["dur"]) for ii in trackInstructions]))
+    segments = lambda: getSegments(filename, clips, sampleWidth, sampleRate, channels)
+    if cache is None:
+        segments = segments()
+
+    if track["verbose"]:
+        print("Making track %s with %s segments and %s instructions..." % (filename, len(clips), len(trackInstructions)))
+    windows = TrackWindows(track["frameCount"], channels, track["windowFrames"])
+    mixTrack(windows, trackInstructions, segments, sfx=track["sfx"], sampleRate=sampleRate, fxPad=track["fxPad"], cache=cache, verbose=track["verbose"])
+    if track["verbose"]:
+        print("")
+
+    trackfilename = track["trackfilename"]
+    if trackfilename is not None:
+        trackData = windows.mixInto(np.zeros((track["frameCount"], channels), dtype=np.float32))
+        # adjust master volume
+        trackData *= track["masterGain"]
+        makeDirectories(trackfilename)
+        format = trackfilename.split(".")[-1]
+        npArrToAudio(trackData, sampleWidth, sampleRate).export(trackfilename, format=format)
+
+    return {
+        "filename": filename,
+        "windows": windows,
+        "trackfilename": trackfilename,
+        "hits": cache.hits - hits0 if cache is not None else 0,
+        "misses": cache.misses - misses0 if cache is not None else 0
+    }
+
 def plotAudioSequence(seq):
     import matplotlib.pyplot as plt
     import numpy as np
@@ -1,8 +1,11 @@
-import array
 import audioop
+import hashlib
+import json
 import librosa
 import math
+from lib.cache_utils import *
 from lib.collection_utils import *
+from lib.fx_utils import *
 from lib.math_utils import *
 from lib.processing_utils import *
 import numpy as np
@@ -11,59 +14,85 @@ from PIL import Image
 from pprint import pprint
 import pydub
 from pydub import AudioSegment
-from pysndfx import AudioEffectsChain
 import re
 import subprocess
 import sys
+import wave
+
+# decoded audio can be kept as memory-mappable arrays keyed by the source file and the format it was decoded to; it's off by
+# default since most scripts decode each file once, and callers that decode the same files again (like the mixer) pass this
+DECODED_AUDIO_CACHE_DIR = "tmp/decoded/"
+DECODED_AUDIO_CACHE_BYTES = 4*1024**3
+decodedAudioCaches = {}
+
+class AudioStreamWriter:
+    """Writes float (frames, channels) arrays to an audio file as they're mixed; wav files are written directly, anything else is piped through ffmpeg"""
+
+    def __init__(self, filename, sampleWidth=4, sampleRate=48000, channels=2):
+        self.sampleWidth = sampleWidth
+        self.wav = None
+        self.process = None
+        format = filename.split(".")[-1].lower()
+        if format == "wav":
+            self.wav = wave.open(filename, "wb")
+            self.wav.setnchannels(channels)
+            self.wav.setsampwidth(sampleWidth)
+            self.wav.setframerate(sampleRate)
+        else:
+            command = ['ffmpeg','-y',
+                        '-f',{1: 's8', 2: 's16le', 4: 's32le'}[sampleWidth],
+                        '-ar',str(sampleRate),
+                        '-ac',str(channels),
+                        '-i','-',
+                        filename]
+            printCommand(command)
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+        else:
+            self.process.stdin.close()
+            returnCode = self.process.wait()
+            if returnCode != 0:
+                raise subprocess.CalledProcessError(returnCode, "ffmpeg")
+
+    def write(self, arr):
+        data = npArrToPcm(arr, self.sampleWidth)
+        if self.wav is not None:
+            self.wav.writeframes(data)
+        else:
+            self.process.stdin.write(data)
 
 def addFx(sound, effects, pad=3000, fade_in=100, fade_out=100):
+    return addFxToSounds([sound], effects, pad=pad, fade_in=fade_in, fade_out=fade_out)[0]
+
+def addFxToSounds(sounds, effects, pad=3000, fade_in=100, fade_out=100):
+    # sounds must share channels, sample width and frame rate; they go through the effects chain together
+    if len(sounds) < 1:
+        return []
+    sampleWidth = sounds[0].sample_width
+    frameRate = sounds[0].frame_rate
+
     # Add padding
     if pad > 0:
-        sound += AudioSegment.silent(duration=pad, frame_rate=sound.frame_rate)
-
-    # convert pydub sound to np array
-    samples = np.array(sound.get_array_of_samples())
-    samples = samples.astype(np.int16)
-
-    chain = AudioEffectsChain()
-    for effect, value in effects:
-        if effect == "reverb":
-            chain.reverb(reverberance=value)
-        elif effect == "distortion":
-            chain.overdrive(gain=value)
-        elif effect == "highpass":
-            chain.highpass(value)
-        elif effect == "lowpass":
-            chain.lowpass(value)
-        elif effect == "bass":
-            frequency = 100
-            gain = value
-            if isinstance(value, tuple):
-                gain, frequency = value
-            print("%s, %s" % (gain, frequency))
-            chain.highshelf(gain=gain, frequency=frequency)
-        elif effect == "echo":
-            echoStr = "echo 0.8 0.9"
-            amount = value
-            count = 1
-            # check if we have echo count indicated
-            if isinstance(value, tuple):
-                amount, count = value
-            for i in range(count):
-                # amount between 10 (robot) and 1000 (mountains)
-                echoStr += " %s 0.3" % amount
-            chain.custom(echoStr)
-
-    # apply reverb effect
-    fx = (chain)
-    y = fx(samples)
-
-    # convert it back to an array and create a new sound clip
-    newData = array.array(sound.array_type, y)
-    newSound = sound._spawn(newData)
-    dur = len(newSound)
-    newSound = newSound.fade_in(min(fade_in, dur)).fade_out(min(fade_out, dur))
-    return newSound
+        sounds = [sound + AudioSegment.silent(duration=pad, frame_rate=frameRate) for sound in sounds]
+
+    # convert pydub sounds to np arrays and apply the effects
+    clips = applyFxToClips([audioToNpArr(sound) for sound in sounds], frameRate, effects)
+
+    # fade and convert them back to sound clips
+    newSounds = []
+    for clip in clips:
+        frames = len(clip)
+        fadeInFrames = min(msToFrame(fade_in, frameRate), frames)
+        fadeOutFrames = min(msToFrame(fade_out, frameRate), frames)
+        if fadeInFrames > 0:
+            clip[:fadeInFrames] *= np.linspace(0, 1, fadeInFrames, endpoint=False)[:, np.newaxis]
+        if fadeOutFrames > 0:
+            clip[frames-fadeOutFrames:] *= np.linspace(1, 0, fadeOutFrames, endpoint=False)[:, np.newaxis]
+        newSounds.append(npArrToAudio(clip, sampleWidth, frameRate))
+    return newSounds
 
 def analyzeAudio(fn, start=0, dur=250, findSamples=False):
     y, sr = loadAudioData(fn)
@@ -84,7 +113,7 @@ def analyzeAudio(fn, start=0, dur=250, findSamples=False):
     bandwidth = scaleAudioData(librosa.feature.spectral_bandwidth(y=y, sr=sr))
     return np.asarray([centroid, bandwidth])
 
-def applyAudioProperties(audio, props, sfx=True, fxPad=3000):
+def applyAudioProperties(audio, props, sfx=True, fxPad=3000, fx=True):
     p = props
     if "matchDb" in p and p["matchDb"] > -9999:
         maxMatchDb = p["maxMatchDb"] if "maxMatchDb" in p else -1
@@ -108,14 +137,17 @@ def applyAudioProperties(audio, props, sfx=True, fxPad=3000):
         elif "stretchTo" in p and p["stretchTo"] > p["dur"]:
             stretchAmount = 1.0 * p["stretchTo"] / p["dur"]
             audio = stretchSound(audio, stretchAmount)
-        effects = []
-        for effect in ["reverb", "distortion", "highpass", "lowpass"]:
-            if effect in p and p[effect] > 0:
-                effects.append((effect, p[effect]))
+        effects = getAudioFx(p) if fx else []
         if len(effects) > 0:
             audio = addFx(audio, effects, pad=fxPad)
     return audio
 
+def audioToNpArr(audio):
+    # pydub audio to a float32 (frames, channels) array between -1 and 1
+    samples = np.array(audio.get_array_of_samples())
+    samples = samples.reshape(-1, audio.channels).astype(np.float32)
+    return samples / np.float32(1 << (8 * audio.sample_width - 1))
+
 def audioFingerprintsToImage(fingerprints, filename, cols, rows, width, height, bgcolors=None):
     pixels = np.zeros((height, width), dtype=np.uint8)
     bgpixels = None
@@ -147,12 +179,28 @@ def audioFingerprintsToImage(fingerprints, filename, cols, rows, width, height,
     # if dmismatch:
     #     print("Warning: fingerprint dimensions differs from cell dimensions")
 
+def dbToAmplitude(db):
+    return 10.0 ** (db / 20.0)
+
 # Note: sample_width -> bit_depth conversions: 1->8, 2->16, 3->24, 4->32
 # 24/32 bit depth and 48K sample rates are industry standards
-def getAudio(filename, sampleWidth=4, sampleRate=48000, channels=2, verbose=True):
+def getAudioFx(props):
+    effects = []
+    for effect in ["reverb", "distortion", "highpass", "lowpass"]:
+        if effect in props and props[effect] > 0:
+            effects.append((effect, props[effect]))
+    return effects
+
+def getAudio(filename, sampleWidth=4, sampleRate=48000, channels=2, verbose=True, cacheDir=None):
     # A hack: always read files at 16-bit depth because Sox does not support more than that
     sampleWidth = 2
     audiofilename = getAudioFile(filename)
+    cache = getDecodedAudioCache(cacheDir)
+    if cache is not None:
+        key = getDecodedAudioKey(audiofilename, ["pydub", sampleWidth, sampleRate, channels])
+        data = cache.get(key)
+        if data is not None:
+            return AudioSegment(data=data.tobytes(), sample_width=sampleWidth, frame_rate=sampleRate, channels=channels)
     # fformat = audiofilename.split(".")[-1].lower()
     # audio = AudioSegment.from_file(audiofilename, format=fformat)
     try:
@@ -176,6 +224,9 @@ def getAudio(filename, sampleWidth=4, sampleRate=48000, channels=2, verbose=True
         if verbose:
             print("Warning: frame rate changed to %s from %s in %s" % (sampleRate, audio.frame_rate, filename))
         audio = audio.set_frame_rate(sampleRate)
+
+    if cache is not None:
+        cache.put(key, np.frombuffer(audio.raw_data, dtype=np.int16).reshape(-1, channels))
     return audio
 
 def getAudioClip(audio, clipStart, clipDur, audioDurationMs=None, clipFadeIn=10, clipFadeOut=10):
@@ -243,39 +294,28 @@ def getAudioSamples(fn, min_dur=50, max_dur=-1, fft=2048, hop_length=512, backtr
     # https://librosa.github.io/librosa/auto_examples/plot_superflux.html#sphx-glr-auto-examples-plot-superflux-py
     # http://dafx13.nuim.ie/papers/09.dafx2013_submission_12.pdf
     if superFlux:
-        lag = 2
-        n_mels = 138
-        fmin = 27.5
-        fmax = 16000.0
-        max_size = 3
-        S = librosa.feature.melspectrogram(y, sr=sr, n_fft=fft, hop_length=hop_length, fmin=fmin, fmax=fmax, n_mels=n_mels)
-        odf = librosa.onset.onset_strength(S=librosa.power_to_db(S, ref=np.max), sr=sr, hop_length=hop_length, lag=lag, max_size=max_size)
-        onsets = librosa.onset.onset_detect(onset_envelope=odf, sr=sr, hop_length=hop_length, backtrack=backtrack, delta=delta)
+        S = np.abs(librosa.stft(y, n_fft=fft, hop_length=hop_length))
+        onsets = getSuperFluxOnsets(S, sr, fft=fft, hop_length=hop_length, backtrack=backtrack, delta=delta)
 
     # retrieve onsets using default method
     else:
         onsets = librosa.onset.onset_detect(y=y, sr=sr, hop_length=hop_length, backtrack=backtrack, delta=delta)
 
-    times = [int(round(1.0 * hop_length * onset / sr * 1000)) for onset in onsets]
-    # add the end of the audio
-    times.append(duration-1)
-
-    samples = []
-    for i, t in enumerate(times):
-        if i > 0:
-            prev = times[i-1]
-            dur = t - prev
-            if max_dur > 0 and dur > max_dur:
-                dur = max_dur
-            if dur >= min_dur:
-                samples.append({
-                    "filename": basename,
-                    "start": prev,
-                    "dur": dur
-                })
+    samples = getSamplesFromOnsets(onsets, duration, basename, sr, hop_length=hop_length, min_dur=min_dur, max_dur=max_dur)
 
     return (samples, y, sr)
 
+def getSuperFluxOnsets(S, sr, fft=2048, hop_length=512, backtrack=True, delta=0.07):
+    # S is the magnitude spectrogram of the whole file
+    lag = 2
+    n_mels = 138
+    fmin = 27.5
+    fmax = 16000.0
+    max_size = 3
+    mels = librosa.feature.melspectrogram(S=S**2, sr=sr, n_fft=fft, hop_length=hop_length, fmin=fmin, fmax=fmax, n_mels=n_mels)
+    odf = librosa.onset.onset_strength(S=librosa.power_to_db(mels, ref=np.max), sr=sr, hop_length=hop_length, lag=lag, max_size=max_size)
+    return librosa.onset.onset_detect(onset_envelope=odf, sr=sr, hop_length=hop_length, backtrack=backtrack, delta=delta)
+
 def getAudioSimilarity(test, references):
     refCount = len(references)
     if refCount <= 0:
@@ -287,6 +327,20 @@ def getAudioSimilarity(test, references):
         sumValue += refDistance
     return 1.0 * sumValue / refCount
 
+def getDecodedAudioCache(cacheDir=DECODED_AUDIO_CACHE_DIR):
+    # one cache per directory and process; arrays are memory-mapped copy-on-write, so they can be changed without touching the files
+    if not cacheDir:
+        return None
+    if cacheDir not in decodedAudioCaches:
+        decodedAudioCaches[cacheDir] = ArrayCache(cacheDir, DECODED_AUDIO_CACHE_BYTES, 0, mmapMode="c")
+    return decodedAudioCaches[cacheDir]
+
+def getDecodedAudioKey(fn, params):
+    # decoded audio is stale once the source file changes
+    stat = os.stat(fn) if os.path.isfile(fn) else None
+    source = [os.path.abspath(fn), stat.st_size, stat.st_mtime] if stat is not None else [fn]
+    return hashlib.md5(json.dumps([source, params]).encode("utf-8")).hexdigest()
+
 def getDurationFromAudioData(y, sr):
     ylen = len(y)
     return 1.0 * ylen / sr
@@ -321,8 +375,10 @@ def getFeatures(y, sr, start, dur=100, fft=2048, hop_length=512):
     # analyze just the sample
     y = getFrameRange(y, start, start+dur, sr)
 
-    power = getPower(y, fft=fft, hop_length=hop_length)
-    hz, clarity, harmonics = getPitch(y, sr, fft=fft)
+    # the harmonic separation in getPitch uses a 2048/512 stft, so power can share it if it uses the same
+    S = librosa.stft(y, n_fft=2048, hop_length=512)
+    power = getPowerFromStft(S if fft == 2048 and hop_length == 512 else librosa.stft(y, n_fft=fft, hop_length=hop_length))
+    hz, clarity, harmonics = getPitch(y, sr, fft=fft, S=S)
     # rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)[0]
     # flatness = librosa.feature.spectral_flatness(y=y)[0]
 
@@ -349,6 +405,19 @@ def getFeatures(y, sr, start, dur=100, fft=2048, hop_length=512):
         "harmonics": len(harmonics)
     }
 
+def getFeaturesFromAudioData(y, sr, samples, fft=2048, hop_length=512):
+    """Returns features for a list of samples (with start and dur) in the same audio data; samples that occur more than once are only analyzed once"""
+    features = []
+    featureLookup = {}
+    sampleCount = len(samples)
+    for i, sample in enumerate(samples):
+        key = (sample["start"], sample["dur"])
+        if key not in featureLookup:
+            featureLookup[key] = getFeatures(y, sr, sample["start"], sample["dur"], fft=fft, hop_length=hop_length)
+        features.append(featureLookup[key].copy())
+        printProgress(i+1, sampleCount)
+    return features
+
 def getFeaturesFromSamples(filename, samples, y=None, sr=None):
     # load audio
     sampleCount = len(samples)
@@ -362,14 +431,10 @@ def getFeaturesFromSamples(filename, samples, y=None, sr=None):
         y, sr = loadAudioData(fn)
 
     features = []
-    for i, sample in enumerate(samples):
-        sfeatures = sample.copy()
-        sfeatures.update(getFeatures(y, sr, sample["start"], sample["dur"]))
-        features.append(sfeatures)
-
-        sys.stdout.write('\r')
-        sys.stdout.write("%s%%" % round(1.0*(i+1)/sampleCount*100,1))
-        sys.stdout.flush()
+    for sample, sfeatures in zip(samples, getFeaturesFromAudioData(y, sr, samples)):
+        sample = sample.copy()
+        sample.update(sfeatures)
+        features.append(sample)
 
     return features
 
@@ -404,10 +469,16 @@ def getFrameRange(y, ms0, ms1, sr):
     # print("%s%% to %s%%" % (round(1.0*i0/len(y)*100, 5), round(1.0*i1/len(y)*100, 5)))
     return y[i0:i1]
 
-def getPitch(y, sr, fft=2048):
-    y = librosa.effects.harmonic(y, margin=4) # increase margin for higher filtering of noise (probably between 1 and 8)
+def getPitch(y, sr, fft=2048, S=None):
+    # same as librosa.effects.harmonic(y, margin=4), but can reuse an existing 2048/512 stft of y
+    if S is None:
+        S = librosa.stft(y, n_fft=2048, hop_length=512)
+    harmonic, percussive = librosa.decompose.hpss(S, margin=4) # increase margin for higher filtering of noise (probably between 1 and 8)
+    y = librosa.istft(harmonic, dtype=y.dtype, length=len(y))
     y = np.nan_to_num(y)
-    pitches, magnitudes = librosa.core.piptrack(y=y, sr=sr, n_fft=fft)
+    # piptrack and spectral contrast both work on the magnitude of the harmonic part, so only take its stft once
+    Sh = np.abs(librosa.stft(y, n_fft=fft, hop_length=int(fft/4)))
+    pitches, magnitudes = librosa.core.piptrack(S=Sh, sr=sr, n_fft=fft)
 
     # get sum of mags at each time
     magFrames = magnitudes.sum(axis=0) # get the sum of bins at each time frame
@@ -431,7 +502,8 @@ def getPitch(y, sr, fft=2048):
     pitch = pitches[binIndex, t]
 
     try:
-        contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
+        Sc = Sh if fft == 2048 else np.abs(librosa.stft(y, n_fft=2048, hop_length=512))
+        contrast = librosa.feature.spectral_contrast(S=Sc, sr=sr)
         clarity = np.mean(contrast[:, t])
     except librosa.util.exceptions.ParameterError as err:
         print("librosa error: {0}".format(err))
@@ -442,7 +514,10 @@ def getPitch(y, sr, fft=2048):
     return pitch, clarity, harmonics
 
 def getPower(y, fft=2048, hop_length=512):
-    stft = getStft(y, n_fft=fft, hop_length=hop_length)
+    return getPowerFromStft(librosa.stft(y, n_fft=fft, hop_length=hop_length))
+
+def getPowerFromStft(S):
+    stft = getRmsFromStft(S)
     power = round(weightedMean(stft), 2)
     if math.isinf(power):
         power = -1
@@ -494,11 +569,52 @@ def getPowerFromTimecodes(timecodes, method="max"):
             powerData[t["index"]] = power
     return powerData
 
-def getStft(y, n_fft=2048, hop_length=512):
-    return librosa.feature.rmse(S=librosa.stft(y, n_fft=n_fft, hop_length=hop_length))[0]
+def getSamplesFromOnsets(onsets, duration, basename, sr, hop_length=512, min_dur=50, max_dur=-1):
+    times = [int(round(1.0 * hop_length * onset / sr * 1000)) for onset in onsets]
+    # add the end of the audio
+    times.append(duration-1)
 
-def loadAudioData(fn, sr=None):
-    return librosa.load(fn, sr=sr)
+    samples = []
+    for i, t in enumerate(times):
+        if i > 0:
+            prev = times[i-1]
+            dur = t - prev
+            if max_dur > 0 and dur > max_dur:
+                dur = max_dur
+            if dur >= min_dur:
+                samples.append({
+                    "filename": basename,
+                    "start": prev,
+                    "dur": dur
+                })
+    return samples
+
+def getRmsFromStft(S):
+    return librosa.feature.rmse(S=S)[0]
+
+def getStft(y, n_fft=2048, hop_length=512):
+    return getRmsFromStft(librosa.stft(y, n_fft=n_fft, hop_length=hop_length))
+
+def loadAudioData(fn, sr=None, cacheDir=None):
+    cache = getDecodedAudioCache(cacheDir)
+    if cache is None:
+        return librosa.load(fn, sr=sr)
+    # the file's native sample rate is cached alongside its data when sr is None
+    key = getDecodedAudioKey(fn, ["librosa", sr])
+    srKey = getDecodedAudioKey(fn, ["librosa", "sr"])
+    y = cache.get(key)
+    if y is not None:
+        if sr is not None:
+            return (y, sr)
+        cachedSr = cache.get(srKey)
+        if cachedSr is not None:
+            return (y, int(cachedSr[0]))
+    nativeSr = (sr is None)
+    y, sr = librosa.load(fn, sr=sr)
+    cache.put(key, y)
+    if nativeSr:
+        cache.put(srKey, np.array([sr], dtype=np.int64))
+    return (y, sr)
 
 def makeBlankAudio(duration, fn, sampleWidth=4, sampleRate=48000, channels=2):
     baseAudio = AudioSegment.silent(duration=duration, frame_rate=sampleRate)
@@ -531,7 +647,23 @@ def msToFrame(ms, sr):
     return int(round(ms / 1000.0 * sr))
 
 # Adapted from: https://github.com/paulnasca/paulstretch_python/blob/master/paulstretch_newmethod.py
-def paulStretch(samplerate, smp, stretch, windowsize_seconds=0.25, onset_level=10.0):
+def npArrToAudio(arr, sampleWidth=4, sampleRate=48000):
+    # float (frames, channels) array between -1 and 1 to pydub audio; clips anything outside that range
+    frames, channels = arr.shape
+    return AudioSegment(data=npArrToPcm(arr, sampleWidth), sample_width=sampleWidth, frame_rate=sampleRate, channels=channels)
+
+def npArrToPcm(arr, sampleWidth=4):
+    # float (frames, channels) array between -1 and 1 to interleaved little-endian pcm bytes
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[sampleWidth]
+    maxValue = (1 << (8 * sampleWidth - 1)) - 1
+    samples = np.clip(arr.astype(np.float64) * (maxValue + 1), -maxValue-1, maxValue).astype(dtype)
+    return samples.tobytes()
+
+def getPaulStretchPlan(samplerate, smp, stretch, windowsize_seconds=0.25, onset_level=10.0):
+    """Analyzes the input once; returns the spectrum of every input window and which (blend of) input windows each output window uses"""
+    smp=np.array(smp, dtype=np.float64)
+    if smp.ndim<2:
+        smp=smp.reshape(1, -1)
     nchannels=smp.shape[0]
 
     def optimize_windowsize(n):
@@ -563,127 +695,136 @@ def paulStretch(samplerate, smp, stretch, windowsize_seconds=0.25, onset_level=1
     end_size=int(samplerate*0.05)
     if end_size<16:
         end_size=16
-
+    end_size=min(end_size, nsamples)
     smp[:,nsamples-end_size:nsamples]*=np.linspace(1,0,end_size)
 
-
-    #compute the displacement inside the input file
-    start_pos=0.0
-    displace_pos=windowsize*0.5
-
     #create Hann window
     window=0.5-np.cos(np.arange(windowsize,dtype='float')*2.0*np.pi/(windowsize-1))*0.5
 
-    old_windowed_buf=np.zeros((2,windowsize))
     hinv_sqrt2=(1+np.sqrt(0.5))*0.5
     hinv_buf=2.0*(hinv_sqrt2-(1.0-hinv_sqrt2)*np.cos(np.arange(half_windowsize,dtype='float')*2.0*np.pi/half_windowsize))/hinv_sqrt2
 
-    freqs=np.zeros((2,half_windowsize+1))
-    old_freqs=freqs
+    #the input windows are displaced by half a window; the last one is the first that reaches the end of the smp
+    num_windows=max(1, int(np.ceil(1.0*nsamples/half_windowsize)))
+    padded=np.zeros((nchannels, num_windows*half_windowsize+windowsize))
+    padded[:,:nsamples]=smp
+    bufs=np.lib.stride_tricks.sliding_window_view(padded, windowsize, axis=1)[:, 0:num_windows*half_windowsize:half_windowsize]
 
-    num_bins_scaled_freq=32
-    freqs_scaled=np.zeros(num_bins_scaled_freq)
-    old_freqs_scaled=freqs_scaled
+    #get the amplitudes of the frequency components of every window and discard the phases; index 0 is silence before the first window
+    freqs=np.zeros((num_windows+1, nchannels, half_windowsize+1))
+    freqs[1:]=np.abs(np.fft.rfft(bufs*window, axis=-1)).transpose(1, 0, 2)
 
+    #scale down the spectrum to detect onsets
+    num_bins_scaled_freq=32
+    freqs_len=freqs.shape[2]
+    freqs_scaled=np.zeros((num_windows+1, num_bins_scaled_freq))
+    if num_bins_scaled_freq<freqs_len:
+        freqs_len_div=freqs_len//num_bins_scaled_freq
+        new_freqs_len=freqs_len_div*num_bins_scaled_freq
+        freqs_scaled[1:]=np.mean(np.mean(freqs[1:],1)[:,:new_freqs_len].reshape([num_windows,num_bins_scaled_freq,freqs_len_div]),2)
+    onsets=2.0*np.mean(freqs_scaled[1:]-freqs_scaled[:-1],1)/(np.mean(abs(freqs_scaled[:-1]),1)+1e-3)
+    onsets=np.clip(onsets, 0.0, 1.0)
+
+    #walk through the output windows; this only decides which input windows to blend, so it's cheap
     displace_tick=0.0
     displace_tick_increase=1.0/stretch
     if displace_tick_increase>1.0:
         displace_tick_increase=1.0
     extra_onset_time_credit=0.0
     get_next_buf=True
-
-    sdata = np.array([])
+    window_indices=[]
+    displace_ticks=[]
+    index=0
     while True:
         if get_next_buf:
-            old_freqs=freqs
-            old_freqs_scaled=freqs_scaled
-
-            #get the windowed buffer
-            istart_pos=int(np.floor(start_pos))
-            buf=smp[:,istart_pos:istart_pos+windowsize]
-            if buf.shape[1]<windowsize:
-                buf=np.append(buf,np.zeros((2,windowsize-buf.shape[1])),1)
-            buf=buf*window
-
-            #get the amplitudes of the frequency components and discard the phases
-            freqs=abs(np.fft.rfft(buf))
-
-            #scale down the spectrum to detect onsets
-            freqs_len=freqs.shape[1]
-            if num_bins_scaled_freq<freqs_len:
-                freqs_len_div=freqs_len//num_bins_scaled_freq
-                new_freqs_len=freqs_len_div*num_bins_scaled_freq
-                freqs_scaled=np.mean(np.mean(freqs,0)[:new_freqs_len].reshape([num_bins_scaled_freq,freqs_len_div]),1)
-            else:
-                freqs_scaled=np.zeros(num_bins_scaled_freq)
-
-
-            #process onsets
-            m=2.0*np.mean(freqs_scaled-old_freqs_scaled)/(np.mean(abs(old_freqs_scaled))+1e-3)
-            if m<0.0:
-                m=0.0
-            if m>1.0:
-                m=1.0
-            # if plot_onsets:
-            #     onsets.append(m)
-            if m>onset_level:
+            index+=1
+            if onsets[index-1]>onset_level:
                 displace_tick=1.0
                 extra_onset_time_credit+=1.0
+        window_indices.append(index)
+        displace_ticks.append(displace_tick)
+
+        if index>=num_windows:
+            break
 
-        cfreqs=(freqs*displace_tick)+(old_freqs*(1.0-displace_tick))
+        if extra_onset_time_credit<=0.0:
+            displace_tick+=displace_tick_increase
+        else:
+            credit_get=0.5*displace_tick_increase #this must be less than displace_tick_increase
+            extra_onset_time_credit-=credit_get
+            if extra_onset_time_credit<0:
+                extra_onset_time_credit=0.0
+            displace_tick+=displace_tick_increase-credit_get
+
+        get_next_buf=(displace_tick>=1.0)
+        if get_next_buf:
+            displace_tick=displace_tick % 1.0
+
+    return {
+        "channels": nchannels,
+        "windowsize": windowsize,
+        "window": window,
+        "hinv_buf": hinv_buf,
+        "freqs": freqs,
+        "window_indices": np.array(window_indices),
+        "displace_ticks": np.array(displace_ticks),
+        "length": len(window_indices)*half_windowsize
+    }
+
+def paulStretch(samplerate, smp, stretch, windowsize_seconds=0.25, onset_level=10.0):
+    """Returns the stretched smp as a (channels, samples) array between -1 and 1"""
+    plan=getPaulStretchPlan(samplerate, smp, stretch, windowsize_seconds, onset_level)
+    sdata=np.zeros((plan["channels"], plan["length"]))
+    pos=0
+    for output in paulStretchChunks(samplerate, smp, stretch, plan=plan):
+        sdata[:,pos:pos+output.shape[1]]=output
+        pos+=output.shape[1]
+    return sdata
+
+def paulStretchChunks(samplerate, smp, stretch, windowsize_seconds=0.25, onset_level=10.0, batch_size=8, plan=None):
+    """Yields the stretched smp in (channels, samples) chunks of batch_size half windows, so very long stretches don't need to be held in memory"""
+    if plan is None:
+        plan=getPaulStretchPlan(samplerate, smp, stretch, windowsize_seconds, onset_level)
+    nchannels=plan["channels"]
+    windowsize=plan["windowsize"]
+    half_windowsize=int(windowsize/2)
+    window=plan["window"]
+    hinv_buf=plan["hinv_buf"]
+    freqs=plan["freqs"]
+    window_indices=plan["window_indices"]
+    displace_ticks=plan["displace_ticks"][:,np.newaxis,np.newaxis]
+
+    old_windowed_buf=np.zeros((nchannels,windowsize))
+    for i in range(0, len(window_indices), batch_size):
+        indices=window_indices[i:i+batch_size]
+        ticks=displace_ticks[i:i+batch_size]
+        count=len(indices)
+        amps=(freqs[indices]*ticks)+(freqs[indices-1]*(1.0-ticks))
 
         #randomize the phases by multiplication with a random complex number with modulus=1
-        ph=np.random.uniform(0,2*np.pi,(nchannels,cfreqs.shape[1]))*1j
-        cfreqs=cfreqs*np.exp(ph)
+        ph=np.random.uniform(0,2*np.pi,amps.shape)
+        cfreqs=np.empty(amps.shape, dtype=np.complex128)
+        cfreqs.real=amps*np.cos(ph)
+        cfreqs.imag=amps*np.sin(ph)
 
         #do the inverse FFT
-        buf=np.fft.irfft(cfreqs)
+        bufs=np.fft.irfft(cfreqs, axis=-1)
 
         #window again the output buffer
-        buf*=window
+        bufs*=window
 
         #overlap-add the output
-        output=buf[:,0:half_windowsize]+old_windowed_buf[:,half_windowsize:windowsize]
-        old_windowed_buf=buf
+        previous=np.concatenate((old_windowed_buf[np.newaxis], bufs[:-1]))
+        output=bufs[:,:,0:half_windowsize]+previous[:,:,half_windowsize:windowsize]
+        old_windowed_buf=bufs[-1]
 
         #remove the resulted amplitude modulation
         output*=hinv_buf
 
         #clamp the values to -1..1
-        output[output>1.0]=1.0
-        output[output<-1.0]=-1.0
-
-        #write the output to wav file
-        # outfile.writeframes(int16(output.ravel(1)*32767.0).tostring())
-        sdata = np.append(sdata, output.ravel(1), axis=0)
-
-        if get_next_buf:
-            start_pos+=displace_pos
-
-        get_next_buf=False
+        output=np.clip(output, -1.0, 1.0)
 
-        if start_pos>=nsamples:
-            # print ("100 %")
-            break
-        # sys.stdout.write("%d %% \r" % int(100.0*start_pos/nsamples))
-        # sys.stdout.flush()
-
-        if extra_onset_time_credit<=0.0:
-            displace_tick+=displace_tick_increase
-        else:
-            credit_get=0.5*displace_tick_increase #this must be less than displace_tick_increase
-            extra_onset_time_credit-=credit_get
-            if extra_onset_time_credit<0:
-                extra_onset_time_credit=0
-            displace_tick+=displace_tick_increase-credit_get
-
-        if displace_tick>=1.0:
-            displace_tick=displace_tick % 1.0
-            get_next_buf=True
-
-    sdata = sdata * 32767.0
-    sdata = sdata.astype(np.int16)
-    return sdata
+        yield output.transpose(1, 0, 2).reshape(nchannels, count*half_windowsize)
 
 def pitchToNote(hz):
     note = "-"
@@ -702,14 +843,9 @@ def scaleAudioData(arr):
 def stretchSound(sound, amount=2.0, fade_out=0.8):
     channels = sound.channels
     frame_rate = sound.frame_rate
-    samples = np.array(sound.get_array_of_samples())
-    samples = samples.astype(np.int16)
-    samples = samples * (1.0/32768.0)
-    if channels > 1:
-        samples = samples.reshape(channels, roundInt(1.0*len(samples)/channels), order='F')
+    samples = audioToNpArr(sound).T
     newData = paulStretch(frame_rate, samples, amount)
-    newData = array.array(sound.array_type, newData)
-    newSound = sound._spawn(newData)
+    newSound = npArrToAudio(newData.T, sound.sample_width, frame_rate)
     if fade_out > 0:
         fadeMs = int(round(len(newSound) * fade_out))
         newSound = newSound.fade_out(fadeMs)
@@ -1,8 +1,11 @@
 # Reference: https://stackoverflow.com/questions/9619199/best-way-to-preserve-numpy-arrays-on-disk
 
 import bz2
+from collections import OrderedDict
+import json
 from lib.io_utils import *
 from lib.math_utils import *
+import numpy as np
 import os
 import pickle
 
@@ -40,3 +43,284 @@ def saveCacheFile(fn, data, overwrite=False, compressed=True):
     else:
         print("Already exists %s" % fn)
     return True
+
+# Array caches: numpy arrays (processed audio segments, decoded audio) keyed by a hash of everything that went into making
+# them. Recently used arrays are kept in memory, and every array is also written to a .npy file in the cache directory so it
+# can be reused by later runs; both are bounded by total bytes and drop the least recently used arrays first
+
+class ArrayCache:
+    def __init__(self, cacheDir="tmp/segments/", maxBytes=2*1024**3, maxMemoryBytes=512*1024**2, mmapMode=None):
+        # no cacheDir keeps the cache in memory only; with an mmapMode arrays are memory-mapped from their files instead of read
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.maxMemoryBytes = maxMemoryBytes
+        self.mmapMode = mmapMode
+        self.memory = OrderedDict()
+        self.memoryBytes = 0
+        self.files = None
+        self.fileBytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def evict(self, targetBytes=None):
+        # other processes may write to the same directory, so the whole directory is listed again before evicting
+        if not self.cacheDir:
+            return
+        targetBytes = self.maxBytes if targetBytes is None else targetBytes
+        self.files = None
+        files = self.loadFiles()
+        while self.fileBytes > targetBytes and len(files) > 1:
+            evictKey, evictSize = files.popitem(last=False)
+            self.fileBytes -= evictSize
+            try:
+                os.remove(self.getFilename(evictKey))
+            except OSError:
+                pass
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        data = None
+        files = self.loadFiles()
+        if key in files:
+            fn = self.getFilename(key)
+            try:
+                data = np.load(fn, mmap_mode=self.mmapMode)
+                # the file's modified time is its last use, so the next run evicts in the same order
+                os.utime(fn)
+                files.move_to_end(key)
+            # another process may have evicted it
+            except (FileNotFoundError, ValueError):
+                self.fileBytes -= files.pop(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.putMemory(key, data)
+        return data
+
+    def getFilename(self, key):
+        return self.cacheDir + key + ".npy"
+
+    def loadFiles(self):
+        if self.files is not None:
+            return self.files
+        entries = []
+        if self.cacheDir and os.path.isdir(self.cacheDir):
+            for entry in os.scandir(self.cacheDir):
+                if entry.name.endswith(".npy") and not entry.name.endswith(".tmp.npy"):
+                    # another process may evict the file while the directory is listed
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, entry.name[:-len(".npy")], stat.st_size))
+        entries = sorted(entries)
+        self.files = OrderedDict([(key, size) for mtime, key, size in entries])
+        self.fileBytes = sum([size for mtime, key, size in entries])
+        return self.files
+
+    def put(self, key, data):
+        data = np.ascontiguousarray(data)
+        self.putMemory(key, data)
+        if not self.cacheDir or key in self.loadFiles():
+            return data
+        fn = self.getFilename(key)
+        makeDirectories(fn)
+        # write to a temporary file first so an interrupted write never leaves a partial array; other processes can share the directory
+        tmpFn = fn + ".%s.tmp.npy" % os.getpid()
+        np.save(tmpFn, data)
+        os.replace(tmpFn, fn)
+        size = os.path.getsize(fn)
+        self.files[key] = size
+        self.fileBytes += size
+        if self.fileBytes > self.maxBytes:
+            # evicting down to 90% of the limit keeps the directory from being listed again on every put
+            self.evict(self.maxBytes * 0.9)
+        return data
+
+    def putMemory(self, key, data):
+        if self.maxMemoryBytes <= 0:
+            return
+        # arrays are shared between everything that gets them from the cache, so don't let them be modified
+        data.flags.writeable = False
+        if key in self.memory:
+            self.memoryBytes -= self.memory.pop(key).nbytes
+        self.memory[key] = data
+        self.memoryBytes += data.nbytes
+        while self.memoryBytes > self.maxMemoryBytes and len(self.memory) > 0:
+            evictKey, evictData = self.memory.popitem(last=False)
+            self.memoryBytes -= evictData.nbytes
+
+# Frame stores: decoded video frames of a single size kept in a raw uint8 file that is opened with np.memmap,
+# so clips can read frames as views instead of unpickling every frame of a video into memory.
+# Records are only ever appended to the frame file; a json manifest per source video lists its stores (one per frame size)
+# and the timestamp of each committed record in file order
+
+class FrameSequence:
+    # a list-like view of non-contiguous frame records in a store
+    def __init__(self, frames, indices):
+        self.frames = frames
+        self.indices = indices
+
+    def __getitem__(self, i):
+        return self.frames[self.indices[i]]
+
+    def __len__(self):
+        return len(self.indices)
+
+def getFrameSequence(store, times):
+    indices = getFrameStoreIndices(store, times)
+    if len(indices) <= 0:
+        return []
+    i0 = indices[0]
+    i1 = indices[-1] + 1
+    # contiguous records can be sliced directly from the memory map
+    if i1 - i0 == len(indices) and np.all(np.diff(indices) == 1):
+        return store["frames"][i0:i1]
+    return FrameSequence(store["frames"], indices)
+
+def getFrameStoreFilename(manifestFn, key):
+    return manifestFn[:-len(".frames.json")] + "_" + key + ".frames"
+
+# returns the record index of each time, or None if any time is not in the store
+def getFrameStoreIndices(store, times):
+    times = np.array(times, dtype=np.int64)
+    sortedTimes = store["times"]
+    indices = np.searchsorted(sortedTimes, times)
+    indices = np.clip(indices, 0, max(0, len(sortedTimes)-1))
+    if len(times) > 0 and (len(sortedTimes) <= 0 or np.any(sortedTimes[indices] != times)):
+        return None
+    return store["records"][indices]
+
+def getFrameStoreKey(width, height, resizeMode="fill"):
+    return "%sx%s_%s" % (width, height, resizeMode)
+
+def getFrameStoreManifestFilename(cacheDir, fn):
+    return cacheDir + os.path.basename(fn) + ".frames.json"
+
+def getFrameStoreResizeMode(key):
+    return key.split("_", 1)[1]
+
+# round frame sizes up so clips of similar sizes can share the same store
+def getFrameStoreSize(width, height, step=16):
+    width = max(1.0, width)
+    height = max(1.0, height)
+    storeW = max(step, int(ceilToNearest(roundInt(width), step)))
+    storeH = max(1, roundInt(storeW * height / width))
+    return (storeW, storeH)
+
+# a store supersedes another store of the same resize mode and aspect ratio that's no larger than it, since clips scale
+# their frames when they're drawn
+def isFrameStoreSuperseded(key, entry, byKey, byEntry):
+    if getFrameStoreResizeMode(key) != getFrameStoreResizeMode(byKey):
+        return False
+    if byEntry["width"] < entry["width"] or byEntry["height"] < entry["height"]:
+        return False
+    # store heights are rounded to whole pixels, so the aspect ratios can be slightly off
+    return abs(byEntry["width"] * entry["height"] - byEntry["height"] * entry["width"]) <= byEntry["width"]
+
+def loadFrameStore(manifestFn, key, manifest=None, verify=True):
+    if manifest is None:
+        manifest = loadFrameStoreManifest(manifestFn)
+    if key not in manifest:
+        return None
+    entry = manifest[key]
+    fn = getFrameStoreFilename(manifestFn, key)
+    shape = (len(entry["times"]), entry["height"], entry["width"], entry["channels"])
+    frames = np.zeros(shape, dtype=np.uint8)
+    if shape[0] > 0:
+        if not os.path.isfile(fn):
+            return None
+        # the file can be longer than the manifest if a write was interrupted; those records were never committed
+        if verify and os.path.getsize(fn) < np.prod(shape):
+            print("Frame store %s is missing data. Resetting cache data" % fn)
+            return None
+        frames = np.memmap(fn, dtype=np.uint8, mode="r", shape=shape)
+    times = np.array(entry["times"], dtype=np.int64)
+    records = np.argsort(times, kind="stable")
+    return {
+        "key": key,
+        "filename": fn,
+        "width": entry["width"],
+        "height": entry["height"],
+        "channels": entry["channels"],
+        "times": times[records],
+        "records": records,
+        "frames": frames
+    }
+
+def loadFrameStoreManifest(fn):
+    manifest = {}
+    if os.path.isfile(fn):
+        with open(fn, "r") as f:
+            manifest = json.load(f)
+    return manifest
+
+def removeFrameStore(manifestFn, key, manifest):
+    fn = getFrameStoreFilename(manifestFn, key)
+    manifest.pop(key, None)
+    saveFrameStoreManifest(manifestFn, manifest)
+    if os.path.isfile(fn):
+        os.remove(fn)
+    print("Removed frame store %s" % fn)
+
+def saveFrameStoreManifest(fn, manifest):
+    # write to a temporary file first so an interrupted write never leaves a partial manifest
+    tmpFn = fn + ".tmp"
+    with open(tmpFn, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmpFn, fn)
+
+# Appends a frame for each time, which must not be in the store yet. Only the appended records and the manifest are written,
+# and the manifest is committed every batchSize frames. frameFunction(i) is called exactly once per time, in order
+def updateFrameStore(manifestFn, key, times, width, height, frameFunction, channels=3, manifest=None, cache=True, batchSize=500):
+    times = [int(t) for t in times]
+    count = len(times)
+
+    if not cache:
+        frames = np.zeros((count, height, width, channels), dtype=np.uint8)
+        for i in range(count):
+            frames[i] = frameFunction(i)
+        times = np.array(times, dtype=np.int64)
+        records = np.argsort(times, kind="stable")
+        return {"key": key, "filename": None, "width": width, "height": height, "channels": channels, "times": times[records], "records": records, "frames": frames}
+
+    if manifest is None:
+        manifest = loadFrameStoreManifest(manifestFn)
+    if loadFrameStore(manifestFn, key, manifest) is None:
+        manifest[key] = {"width": width, "height": height, "channels": channels, "times": []}
+    entry = manifest[key]
+    fn = getFrameStoreFilename(manifestFn, key)
+    frameSize = width * height * channels
+    committedCount = len(entry["times"])
+
+    # frames are requested in order so frameFunction can read from a sequential decoder
+    mode = "r+b" if os.path.isfile(fn) else "wb"
+    with open(fn, mode) as f:
+        # drop anything past the last committed record
+        committedSize = committedCount * frameSize
+        if os.path.getsize(fn) > committedSize:
+            f.truncate(committedSize)
+        f.seek(committedSize)
+        for i, t in enumerate(times):
+            frame = np.ascontiguousarray(frameFunction(i), dtype=np.uint8)
+            if frame.size != frameSize:
+                print("Warning: frame at %s has shape %s, expected %s" % (t, frame.shape, (height, width, channels)))
+                frame = np.resize(frame, (height, width, channels))
+            f.write(frame.tobytes())
+            entry["times"].append(t)
+            if (i+1) % batchSize == 0:
+                f.flush()
+                os.fsync(f.fileno())
+                saveFrameStoreManifest(manifestFn, manifest)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if count > 0:
+        print("Appended %s frames to %s" % (count, fn))
+
+    saveFrameStoreManifest(manifestFn, manifest)
+    return loadFrameStore(manifestFn, key, manifest, verify=False)
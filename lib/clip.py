@@ -1,3 +1,4 @@
+from bisect import bisect_right
 from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
 
@@ -29,6 +30,8 @@ class Vector:
         self.pos = [0.0, 0.0, 0.0]
         self.size = [100.0, 100.0]
         self.keyframes = []
+        self.keyframeIndex = None
+        self.keyframeCursors = {}
 
         # for caching
         self.cache = defaults["cache"]
@@ -68,6 +71,7 @@ class Vector:
             keyframe.update({"name": "pos", "dimension": 1})
 
         self.keyframes.append(keyframe)
+        self.keyframeIndex = None
         if sortFrames:
             self.sortFrames()
 
@@ -83,6 +87,18 @@ class Vector:
     def getHeight(self, ms=None, parent=None, customProps=None):
         return self.getSizeDimension(1, ms, parent, customProps)
 
+    def getKeyframes(self, name, dimension=None):
+        # keyframes for this property and their times, sorted by time
+        if self.keyframeIndex is None:
+            self.keyframes = sorted(self.keyframes, key=lambda k: k["ms"])
+            self.keyframeIndex = {}
+            self.keyframeCursors = {}
+        key = (name, dimension)
+        if key not in self.keyframeIndex:
+            keyframes = [k for k in self.keyframes if k["name"]==name and (k["dimension"]==dimension or k["dimension"] is None or dimension is None)]
+            self.keyframeIndex[key] = ([k["ms"] for k in keyframes], keyframes)
+        return self.keyframeIndex[key]
+
     def getPos(self, ms=None):
         return (self.getX(ms), self.getY(ms))
 
@@ -134,29 +150,28 @@ class Vector:
             return value
 
         # retrieve keyframes for this property
-        keyframes = [k for k in self.keyframes if k["name"]==name and (k["dimension"]==dimension or k["dimension"] is None or dimension is None)]
+        times, keyframes = self.getKeyframes(name, dimension)
         kcount = len(keyframes)
 
-        # assuming keyframes are sorted
-        for i, kf in enumerate(keyframes):
+        if kcount > 0:
+            # index of the first keyframe after ms; check the last segment first since ms usually increases frame by frame
+            key = (name, dimension)
+            i = self.keyframeCursors.get(key, 0)
+            if not ((i <= 0 or times[i-1] <= ms) and (i >= kcount or ms < times[i])):
+                i = bisect_right(times, ms)
+                self.keyframeCursors[key] = i
+
             # we're after the last frame, just take the last frame's value
-            if i >= kcount-1 and ms >= kf["ms"]:
-                value = kf["value"]
-                break
-            # we just passed the current ms
-            elif kf["ms"] > ms:
-
-                # we're before the first keyframe, just take the first keyframe value
-                if i <= 0:
-                    value = kf["value"]
-                    break
-
-                # lerp between the current and previous keyframe
+            if i >= kcount:
+                value = keyframes[-1]["value"]
+            # we're before the first keyframe, just take the first keyframe value
+            elif i <= 0:
+                value = keyframes[0]["value"]
+            # lerp between the current and previous keyframe
+            else:
                 kf0 = keyframes[i-1]
-                fromValue = kf0["value"]
-                toValue = kf["value"]
-                value = lerpEase((fromValue, toValue), norm(ms, (kf0["ms"], kf["ms"])), kf["easing"])
-                break
+                kf = keyframes[i]
+                value = lerpEase((kf0["value"], kf["value"]), norm(ms, (kf0["ms"], kf["ms"])), kf["easing"])
 
         if self.cache:
             self.cacheProps[nameKey] = value
@@ -288,6 +303,8 @@ class Vector:
 
     def sortFrames(self):
         self.keyframes = sorted(self.keyframes, key=lambda k: k["ms"])
+        self.keyframeIndex = {}
+        self.keyframeCursors = {}
 
     def toDict(self, ms):
         return {
@@ -489,6 +506,176 @@ class Clip:
             arr[i] = value
         return arr
 
+class ClipTimeline:
+    """Keyframes, plays, and static properties of a list of clips packed into arrays, so that every clip's state at a given time can be calculated in one pass instead of clip by clip"""
+
+    channels = [("pos", 0), ("pos", 1), ("size", 0), ("size", 1), ("scale", 0), ("scale", 1), ("translate", 0), ("translate", 1), ("alpha", None), ("rotation", None), ("blur", None), ("brightness", None)]
+
+    def __init__(self, clips):
+        clipCount = len(clips)
+        self.clipCount = clipCount
+        self.indices = np.array([c.props["index"] for c in clips], dtype=np.int32)
+        self.start = np.array([c.start for c in clips], dtype=np.float64)
+        self.dur = np.array([c.dur for c in clips], dtype=np.float64)
+        self.initialOffset = np.array([c.initialOffset for c in clips], dtype=np.float64)
+        self.zindex = np.array([c.props["zindex"] if "zindex" in c.props else c.props["index"]+1 for c in clips], dtype=np.float64)
+        self.origin = np.array([[c.vector.origin[0], c.vector.origin[1]] for c in clips], dtype=np.float64)
+        self.transformOrigin = np.array([[c.vector.transformOrigin[0], c.vector.transformOrigin[1]] for c in clips], dtype=np.float64)
+
+        self.easings = ["linear"]
+        self.channelData = {}
+        allMs = []
+        for name, dimension in self.channels:
+            base = np.zeros(clipCount, dtype=np.float64)
+            counts = np.zeros(clipCount, dtype=np.int64)
+            kms = []
+            kvalues = []
+            keasings = []
+            for i, clip in enumerate(clips):
+                value = getattr(clip.vector, name)
+                base[i] = value if dimension is None else value[dimension]
+                _, keyframes = clip.vector.getKeyframes(name, dimension)
+                counts[i] = len(keyframes)
+                for k in keyframes:
+                    if k["easing"] not in self.easings:
+                        self.easings.append(k["easing"])
+                    kms.append(k["ms"])
+                    kvalues.append(k["value"])
+                    keasings.append(self.easings.index(k["easing"]))
+            offsets = np.zeros(clipCount, dtype=np.int64)
+            if clipCount > 1:
+                offsets[1:] = np.cumsum(counts)[:-1]
+            kms = np.array(kms, dtype=np.float64)
+            allMs.append(kms)
+            self.channelData[(name, dimension)] = {
+                "base": base,
+                "counts": counts,
+                "offsets": offsets,
+                "clipIndices": np.repeat(np.arange(clipCount), counts),
+                "ms": kms,
+                "values": np.array(kvalues, dtype=np.float64),
+                "easings": np.array(keasings, dtype=np.int32)
+            }
+
+        # plays, packed the same way
+        playCounts = np.array([len(c.plays) for c in clips], dtype=np.int64)
+        self.playClips = np.flatnonzero(playCounts > 0)
+        self.playOffsets = np.zeros(len(self.playClips), dtype=np.int64)
+        if len(self.playClips) > 1:
+            self.playOffsets[1:] = np.cumsum(playCounts[self.playClips])[:-1]
+        plays = [(p[0], p[1]) for c in clips for p in c.plays]
+        self.playStarts = np.array([p[0] for p in plays], dtype=np.float64)
+        self.playEnds = np.array([p[1] for p in plays], dtype=np.float64)
+        self.playMids = (self.playStarts + self.playEnds) * 0.5
+        self.playLocalIndices = np.arange(len(plays)) - np.repeat(self.playOffsets, playCounts[self.playClips])
+        self.firstPlayStarts = np.array([c.plays[0][0] for c in clips if len(c.plays) > 0], dtype=np.float64)
+        self.lastPlayEnds = np.array([c.plays[-1][1] for c in clips if len(c.plays) > 0], dtype=np.float64)
+
+        # keyframe times are offset per clip so that a single searchsorted finds each clip's bracketing keyframes
+        allMs = np.concatenate(allMs) if len(allMs) > 0 else np.zeros(0)
+        self.minMs = np.min(allMs) if len(allMs) > 0 else 0.0
+        self.maxMs = np.max(allMs) if len(allMs) > 0 else 0.0
+        self.span = self.maxMs - self.minMs + 3.0
+        for key in self.channelData:
+            data = self.channelData[key]
+            data["keys"] = data["clipIndices"] * self.span + (data["ms"] - self.minMs)
+
+    def getClipTimes(self, ms):
+        # ms is a column of times (m, 1); mirrors Clip.getClipTime
+        start = np.repeat(self.initialOffset[np.newaxis,:], len(ms), axis=0)
+        if len(self.playClips) > 0:
+            large = np.iinfo(np.int64).max
+            isPlaying = (self.playStarts <= ms) & (ms <= self.playEnds)
+            playingIndex = np.minimum.reduceat(np.where(isPlaying, self.playLocalIndices, large), self.playOffsets, axis=1)
+            distances = np.abs(ms - self.playMids)
+            minDistances = np.minimum.reduceat(distances, self.playOffsets, axis=1)
+            playClipIndices = np.repeat(np.arange(len(self.playClips)), np.diff(np.append(self.playOffsets, len(self.playStarts))))
+            closestIndex = np.minimum.reduceat(np.where(distances <= minDistances[:,playClipIndices], self.playLocalIndices, large), self.playOffsets, axis=1)
+            isPlaying = playingIndex < large
+            playIndex = np.where(isPlaying, playingIndex, closestIndex) + self.playOffsets
+            playStart = self.playStarts[playIndex]
+            # if we are before the first play or after the last one, set to initial offset
+            isOutside = (ms < self.firstPlayStarts) | (ms > self.lastPlayEnds)
+            playStart = np.where(~isPlaying & isOutside, self.initialOffset[self.playClips], playStart)
+            start[:,self.playClips] = playStart
+
+        # play forward and backward
+        remainder = np.mod(ms - start, np.trunc(self.dur*2))
+        remainder = np.where(remainder > self.dur, self.dur - (remainder - self.dur) - 1, remainder)
+        remainder = np.clip(remainder, 0, self.dur-1)
+        return np.round(self.start + remainder)
+
+    def getPropValues(self, name, dimension, ms):
+        # ms is a column of times (m, 1); mirrors Vector.getPropValue
+        data = self.channelData[(name, dimension)]
+        values = np.repeat(data["base"][np.newaxis,:], len(ms), axis=0)
+        if len(data["ms"]) <= 0:
+            return values
+        clips = np.flatnonzero(data["counts"] > 0)
+        counts = data["counts"][clips]
+        offsets = data["offsets"][clips]
+        queryMs = np.clip(ms, self.minMs-1.0, self.maxMs+1.0)
+        i1 = np.searchsorted(data["keys"], clips * self.span + (queryMs - self.minMs), side="right")
+        local = i1 - offsets
+        i0 = np.maximum(i1-1, offsets)
+        i1 = np.minimum(i1, offsets+counts-1)
+        fromMs = data["ms"][i0]
+        toMs = data["ms"][i1]
+        fromValue = data["values"][i0]
+        toValue = data["values"][i1]
+        isBetween = (local > 0) & (local < counts)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            amount = np.where(isBetween, (ms - fromMs) / (toMs - fromMs), 0.0)
+        easings = data["easings"][i1]
+        for easingId in np.unique(easings[isBetween]):
+            if easingId <= 0:
+                continue
+            mask = isBetween & (easings == easingId)
+            amount[mask] = easeNpArr(amount[mask], self.easings[easingId])
+        value = np.where(isBetween, (toValue-fromValue) * amount + fromValue, np.where(local <= 0, toValue, fromValue))
+        values[:,clips] = value
+        return values
+
+    def toNpArr(self, ms, containerW=None, containerH=None, precision=3, parent=None):
+        """Returns the (clipCount, propertyCount) array that clipsToNpArr would, or (msCount, clipCount, propertyCount) if ms is a list of times"""
+        isBatch = not np.isscalar(ms)
+        ms = np.array(ms, dtype=np.float64).reshape(-1, 1)
+        precisionMultiplier = int(10 ** precision)
+
+        t = self.getClipTimes(ms)
+        props = {
+            "t": t,
+            "tn": np.clip((t - self.start) / self.dur, 0.0, 1.0),
+            "zindex": np.repeat(self.zindex[np.newaxis,:], len(ms), axis=0)
+        }
+        for i, (pkey, skey) in enumerate([("x", "width"), ("y", "height")]):
+            d = self.getPropValues("pos", i, ms)
+            length = self.getPropValues("size", i, ms)
+            d -= length * self.origin[:,i]
+            tlength = length * self.getPropValues("scale", i, ms)
+            d -= (tlength - length) * self.transformOrigin[:,i]
+            d += self.getPropValues("translate", i, ms)
+            if parent is not None:
+                d = parent["size"][i] * (1.0 * d / parent["baseSize"][i]) + parent["pos"][i]
+                tlength *= parent["scale"][i]
+            props[pkey] = d
+            props[skey] = tlength
+        for pkey in ["alpha", "rotation", "blur", "brightness"]:
+            props[pkey] = self.getPropValues(pkey, None, ms)
+
+        # update properties if not visible
+        if containerW is not None and containerH is not None:
+            isVisible = (props["x"]+props["width"] > 0) & (props["y"]+props["height"] > 0) & (props["x"] < containerW) & (props["y"] < containerH) & (props["alpha"] > 0)
+            for pkey in ["x", "y", "width", "height", "alpha"]:
+                props[pkey] = np.where(isVisible, props[pkey], 0)
+
+        arr = np.zeros((len(ms), self.clipCount, Clip.npPropertyCount()), dtype=np.int32)
+        for i, p in enumerate(Clip.npProperties):
+            pkey, ptype = p
+            values = props[pkey] * precisionMultiplier if ptype == "f" else props[pkey]
+            arr[:, self.indices, i] = np.round(values)
+        return arr if isBatch else arr[0]
+
 def allClipStatesEqual(clips, key, value):
     areEqual = True
     for clip in clips:
@@ -512,6 +699,10 @@ def clipToDict(p):
 def clipsToNpArr(clips, ms=None, containerW=None, containerH=None, precision=3, customClipToArrFunction=None, globalArgs={}):
     # startTime = logTime()
     parentProps = clips[0].vector.parent.toDict(ms) if len(clips) > 0 and clips[0].vector.parent is not None else None
+    # use the compiled timeline if we have one
+    timeline = getValue(globalArgs, "timeline", None)
+    if customClipToArrFunction is None and timeline is not None and ms is not None:
+        return timeline.toNpArr(ms, containerW, containerH, precision, parentProps)
     clipCount = len(clips)
     propertyCount = Clip.npPropertyCount()
     arr = np.zeros((clipCount, propertyCount), dtype=np.int32)
@@ -555,6 +746,18 @@ def clipsToSequence(clips):
             audioSequence.append(p)
     return audioSequence
 
+def compileClipTimeline(clips):
+    """Packs the clips into a ClipTimeline; returns None if the clips use anything the timeline doesn't support, so callers fall back to clipsToNpArr's per-clip path"""
+    if len(clips) <= 0:
+        return None
+    # clipsToNpArr applies the first clip's parent to all clips
+    if clips[0].vector.parent is None and any(c.vector.parent is not None for c in clips):
+        return None
+    for clip in clips:
+        if not all(isNumber(k["value"]) for k in clip.vector.keyframes):
+            return None
+    return ClipTimeline(clips)
+
 def filterClips(clips, filters):
     clipProps = []
     for i, clip in enumerate(clips):
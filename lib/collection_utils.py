@@ -1,4 +1,5 @@
 
+import bisect
 import collections
 import itertools
 from operator import itemgetter
@@ -77,6 +78,22 @@ def getCounts(arr, key):
 def getDuplicates(arr):
     return [item for item, count in collections.Counter(arr).items() if count > 1]
 
+def groupItems(arr, groupBy):
+    # groups items by a key in a single pass, keeping the order items and keys first appear in;
+    # each group also has the items' indices in arr so results can be put back in place
+    groups = []
+    lookup = {}
+    for i, item in enumerate(arr):
+        key = item[groupBy]
+        if key not in lookup:
+            lookup[key] = len(groups)
+            groups.append({groupBy: key, "items": [], "indices": [], "count": 0})
+        group = groups[lookup[key]]
+        group["items"].append(item)
+        group["indices"].append(i)
+        group["count"] += 1
+    return groups
+
 def groupList(arr, groupBy, sort=False, desc=True):
     groups = []
     arr = sorted(arr, key=itemgetter(groupBy))
@@ -93,6 +110,22 @@ def groupList(arr, groupBy, sort=False, desc=True):
         groups = sorted(groups, key=lambda k: k["count"], reverse=reversed)
     return groups
 
+def getIntervalIndex(arr, groupBy="filename", startKey="start", durKey="dur"):
+    # items grouped by key and sorted by start, so queryIntervalIndex can find items by time range with a binary search
+    groups = {}
+    for i, item in enumerate(arr):
+        groups.setdefault(item[groupBy], []).append((item[startKey], i))
+    for key, entries in groups.items():
+        entries.sort()
+        durs = [arr[i][durKey] for start, i in entries]
+        groups[key] = {
+            "starts": [start for start, i in entries],
+            "ends": [start + dur for (start, i), dur in zip(entries, durs)],
+            "indices": [i for start, i in entries],
+            "maxDur": max(durs)
+        }
+    return {"items": arr, "groups": groups}
+
 def listToHumanString(arr):
     arr = [str(value).strip() for value in arr]
     arrLen = len(arr);
@@ -169,6 +202,26 @@ def prependAll(arr, prepends):
 
     return arr
 
+def queryIntervalIndex(intervalIndex, key, start, end, mode="within"):
+    # returns the items in a group that are within [start, end] ("within"), that start in [start, end) ("starts"),
+    # or that overlap (start, end) ("overlaps"), in the order they are in the indexed list
+    if key not in intervalIndex["groups"]:
+        return []
+    group = intervalIndex["groups"][key]
+    starts = group["starts"]
+    ends = group["ends"]
+    # only items that start after start minus the longest duration can overlap the range
+    i0 = bisect.bisect_left(starts, start - group["maxDur"] if mode == "overlaps" else start)
+    i1 = bisect.bisect_right(starts, end) if mode == "within" else bisect.bisect_left(starts, end)
+    if mode == "within":
+        matches = [group["indices"][i] for i in range(i0, i1) if ends[i] <= end]
+    elif mode == "overlaps":
+        matches = [group["indices"][i] for i in range(i0, i1) if ends[i] > start]
+    else:
+        matches = group["indices"][i0:i1]
+    items = intervalIndex["items"]
+    return [items[i] for i in sorted(matches)]
+
 def sortBy(arr, sorters, targetLen=None):
     if isinstance(sorters, tuple):
         sorters = [sorters]
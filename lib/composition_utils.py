@@ -316,11 +316,24 @@ def processComposition(a, clips, videoDurationMs, sampler=None, stepTime=False,
         videoFrames = [videoFrames[a.OUTPUT_SINGLE_FRAME-1]]
         print("Procesing single frame: %s" % videoFrames[0]["filename"])
 
+    # pipe frames straight into ffmpeg instead of saving frame images; only when rendering the whole video, so single frames
+    # and partial frame ranges are still saved as images that later renders can pick up from
+    streamFrames = a.STREAM_FRAMES and a.OUTPUT_SINGLE_FRAME < 1 and frameStart <= 1 and frameEnd >= totalFrames
+    if a.STREAM_FRAMES and not streamFrames:
+        print("Saving frame images instead of streaming, since only part of the video is rendered")
+    if streamFrames:
+        for i, frame in enumerate(videoFrames):
+            videoFrames[i]["filename"] = None
+
     rebuildAudio = (not a.VIDEO_ONLY and (not os.path.isfile(a.AUDIO_OUTPUT_FILE) or a.OVERWRITE))
-    rebuildVideo = (not a.AUDIO_ONLY and (len(videoFrames) > 0 and not os.path.isfile(videoFrames[-1]["filename"]) or a.OVERWRITE))
+    if streamFrames:
+        rebuildVideo = (not a.AUDIO_ONLY and (not os.path.isfile(a.OUTPUT_FILE) or a.OVERWRITE))
+    else:
+        rebuildVideo = (not a.AUDIO_ONLY and (len(videoFrames) > 0 and not os.path.isfile(videoFrames[-1]["filename"]) or a.OVERWRITE))
+    quality = "medium" if a.DEBUG else "high"
 
     if rebuildAudio:
-        mixAudio(audioSequence, durationMs, a.AUDIO_OUTPUT_FILE, masterDb=a.MASTER_DB)
+        mixAudio(audioSequence, durationMs, a.AUDIO_OUTPUT_FILE, masterDb=a.MASTER_DB, workers=getThreadCount(a.PROCESSES), stream=a.AUDIO_STREAM)
         stepTime = logTime(stepTime, "Mix audio")
 
     if rebuildVideo:
@@ -333,20 +346,32 @@ def processComposition(a, clips, videoDurationMs, sampler=None, stepTime=False,
             "baseImage": baseImage,
             "container": container,
             "recalculateClipSizes": a.RECALC_CLIP_SIZE,
-            "vthreads": a.VIDEO_THREADS
+            "vthreads": a.VIDEO_THREADS,
+            "renderer": a.RENDERER
         }
+        # only the default clip-to-array path reads the compiled timeline
+        if customClipToArrFunction is None or customClipToArrCalcFunction == "default":
+            globalArgs["timeline"] = compileClipTimeline(clips)
         clipsPixelData = None
         if not renderOnTheFly:
             clipsPixelData = loadVideoPixelDataFromFrames(videoFrames, clips, a.WIDTH, a.HEIGHT, a.FPS, a.CACHE_DIR, a.CACHE_KEY, a.VERIFY_CACHE, cache=True, debug=a.DEBUG, precision=a.PRECISION, customClipToArrFunction=customClipToArrFunction, customClipToArrCalcFunction=customClipToArrCalcFunction, globalArgs=globalArgs)
         stepTime = logTime(stepTime, "Loaded pixel data")
-        if a.OVERWRITE:
+        if a.OVERWRITE and not streamFrames:
             removeFiles(a.OUTPUT_FRAME % "*")
-        processFrames(videoFrames, clips, clipsPixelData, threads=a.THREADS, precision=a.PRECISION, customClipToArrFunction=customClipToArrFunction, postProcessingFunction=postProcessingFunction, preProcessingFunction=preProcessingFunction, globalArgs=globalArgs)
-
-    if not a.AUDIO_ONLY and a.OUTPUT_SINGLE_FRAME < 1 and frameStart <= 1:
+        if streamFrames:
+            # audio was mixed above, so it can be muxed in the same pass
+            audioFile = a.AUDIO_OUTPUT_FILE if not a.VIDEO_ONLY and os.path.isfile(a.AUDIO_OUTPUT_FILE) else False
+            globalArgs["frameWriter"] = FrameStreamWriter(a.OUTPUT_FILE, a.FPS, a.WIDTH, a.HEIGHT, firstFrame=videoFrames[0]["frame"], audioFile=audioFile, quality=quality)
+        processFrames(videoFrames, clips, clipsPixelData, threads=a.THREADS, precision=a.PRECISION, customClipToArrFunction=customClipToArrFunction, postProcessingFunction=postProcessingFunction, preProcessingFunction=preProcessingFunction, globalArgs=globalArgs, processes=a.PROCESSES)
+        if streamFrames:
+            globalArgs["frameWriter"].close()
+
+    if not a.AUDIO_ONLY and a.OUTPUT_SINGLE_FRAME < 1 and frameStart <= 1 and not streamFrames:
         audioFile = a.AUDIO_OUTPUT_FILE if not a.VIDEO_ONLY and os.path.isfile(a.AUDIO_OUTPUT_FILE) else False
-        quality = "medium" if a.DEBUG else "high"
-        compileFrames(a.OUTPUT_FRAME, a.FPS, a.OUTPUT_FILE, getZeroPadding(totalFrames), audioFile=audioFile, quality=quality)
+        if a.SEGMENT_FRAMES > 0:
+            compileFrameSegments(a.OUTPUT_FRAME, a.FPS, a.OUTPUT_FILE, totalFrames, segmentFrames=a.SEGMENT_FRAMES, audioFile=audioFile, quality=quality, threads=max(a.THREADS, a.PROCESSES))
+        else:
+            compileFrames(a.OUTPUT_FRAME, a.FPS, a.OUTPUT_FILE, getZeroPadding(totalFrames), audioFile=audioFile, quality=quality)
 
     logTime(startTime, "Total execution time")
 
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# A NumPy port of the makeImage kernel in lib/gpu_utils.py for machines without an OpenCL platform.
+# Takes the same packed properties (offset, x, y, w, h, tw, th, alpha, zindex, brightness) and flat pixel data,
+# and renders each clip as a single vectorized operation; arithmetic is kept in float32 to match the kernel
+
+import math
+import numpy as np
+
+def clipsToImageCPU(width, height, flatPixelData, properties, colorDimensions, precision, baseImage=None):
+    count, pcount = properties.shape
+
+    # blank image if no clip data
+    if count <= 0 and baseImage is None:
+        return np.zeros((height, width, 3), dtype=np.uint8)
+    # base image if exists
+    elif count <= 0:
+        return np.array(baseImage, dtype=np.uint8)
+
+    precisionMultiplier = np.float32(int(10 ** precision))
+    zvalues = np.zeros((height, width, 2), dtype=np.int32)
+    result = np.zeros((height, width, 3), dtype=np.uint8) if baseImage is None else np.array(baseImage, dtype=np.uint8).reshape(height, width, 3)
+    props = properties.astype(np.float32)
+
+    for i in range(count):
+        drawClipCPU(result, zvalues, flatPixelData, props[i], properties[i], colorDimensions, precisionMultiplier)
+
+    return result
+
+def blendColorsCPU(color1, color2, amount):
+    invAmount = np.float32(1.0) - amount
+    return roundColorCPU(color1 * amount + color2 * invAmount)
+
+def drawClipCPU(result, zvalues, flatPixelData, fprops, iprops, colorDimensions, precisionMultiplier):
+    canvasH, canvasW, _ = result.shape
+    one = np.float32(1.0)
+    offset = int(iprops[0])
+    xF = fprops[1] / precisionMultiplier
+    yF = fprops[2] / precisionMultiplier
+    x = int(math.floor(xF))
+    y = int(math.floor(yF))
+    remainderX = xF - np.float32(x)
+    remainderY = yF - np.float32(y)
+    w = int(iprops[3])
+    h = int(iprops[4])
+    twF = fprops[5] / precisionMultiplier
+    thF = fprops[6] / precisionMultiplier
+    remainderW = (remainderX+twF) - np.floor(remainderX+twF)
+    remainderH = (remainderY+thF) - np.floor(remainderY+thF)
+    tw = int(math.ceil(remainderX+twF))
+    th = int(math.ceil(remainderY+thF))
+    falpha = fprops[7] / precisionMultiplier
+    zindex = int(iprops[8])
+    fbrightness = fprops[9] / precisionMultiplier
+
+    # only the part of the clip that lands on the canvas
+    col0 = max(0, -x)
+    col1 = min(tw, canvasW - x)
+    row0 = max(0, -y)
+    row1 = min(th, canvasH - y)
+    if col0 >= col1 or row0 >= row1 or w <= 0 or h <= 0:
+        return
+
+    cols = np.arange(col0, col1, dtype=np.float32)
+    rows = np.arange(row0, row1, dtype=np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        srcNX = (cols - remainderX) / (remainderX+twF-one - remainderX)
+        srcNY = (rows - remainderY) / (remainderY+thF-one - remainderY)
+    srcXF = srcNX * np.float32(w-1)
+    srcYF = srcNY * np.float32(h-1)
+    srcXF[srcNX < 0.0] = -remainderX
+    srcYF[srcNY < 0.0] = -remainderY
+    srcXF[srcNX > 1.0] = np.float32(w-1) + (one-remainderW)
+    srcYF[srcNY > 1.0] = np.float32(h-1) + (one-remainderH)
+
+    srcColor = getPixelsF(flatPixelData, srcXF, srcYF, h, w, colorDimensions, offset)
+    if fbrightness < 1.0:
+        srcColor[:,:,:3] = roundColorCPU(srcColor[:,:,:3] * fbrightness)
+
+    dstY0 = row0 + y
+    dstY1 = row1 + y
+    dstX0 = col0 + x
+    dstX1 = col1 + x
+    destRGB = result[dstY0:dstY1, dstX0:dstX1]
+    destZ = zvalues[dstY0:dstY1, dstX0:dstX1]
+    destZValue = destZ[:,:,0]
+    destZAlpha = destZ[:,:,1].copy()
+    # the kernel compares the buffer index (not the z-value) to zero, so only the canvas origin is treated as empty
+    if dstY0 == 0 and dstX0 == 0:
+        destZAlpha[0, 0] = 255
+
+    dalpha = destZAlpha.astype(np.float32) / np.float32(255.0)
+    salpha = srcColor[:,:,3] / np.float32(255.0)
+    talpha = salpha * falpha
+    mask = (talpha > 0.0) & ((zindex > destZValue) | (dalpha < 1.0))
+    if not np.any(mask):
+        return
+
+    # there's already a pixel there; place it behind it using its alpha
+    behind = zindex < destZValue
+    talpha = np.where(behind, (one - dalpha) * talpha, talpha)
+
+    destColor = np.concatenate((destRGB.astype(np.float32), destZAlpha[:,:,np.newaxis].astype(np.float32)), axis=2)
+    blendedColor = blendColorsCPU(srcColor, destColor, talpha[:,:,np.newaxis])
+    destRGB[mask] = blendedColor[mask][:,:3].astype(np.uint8)
+
+    # assign new zindex if it's greater
+    zmask = mask & (zindex > destZValue)
+    destZ[zmask, 1] = blendedColor[zmask][:,3].astype(np.int32)
+    destZ[zmask, 0] = zindex
+
+def getPixels(pdata, xs, ys, h, w, dim, offset):
+    # check bounds; retain rgb color of edge, but make alpha=0
+    visibleX = (xs >= 0) & (xs < w)
+    visibleY = (ys >= 0) & (ys < h)
+    xs = np.clip(xs, 0, w-1)
+    ys = np.clip(ys, 0, h-1)
+    pixels = pdata[offset:offset+h*w*dim].reshape(h, w, dim)
+    colors = np.full((len(ys), len(xs), 4), 255, dtype=np.float32)
+    colors[:,:,:min(dim, 4)] = pixels[ys[:,np.newaxis], xs[np.newaxis,:], :4]
+    colors[~(visibleY[:,np.newaxis] & visibleX[np.newaxis,:]), 3] = 0
+    return colors
+
+def getPixelsF(pdata, xF, yF, h, w, dim, offset):
+    # clips with a target size of exactly one pixel divide by zero when normalizing
+    xF = np.nan_to_num(xF)
+    yF = np.nan_to_num(yF)
+    xF = np.clip(xF, -1.0, np.float32(w+1))
+    yF = np.clip(yF, -1.0, np.float32(h+1))
+
+    x0 = np.floor(xF).astype(np.int32)
+    x1 = np.ceil(xF).astype(np.int32)
+    xLerp = np.float32(1.0) - (xF - x0.astype(np.float32))
+    y0 = np.floor(yF).astype(np.int32)
+    y1 = np.ceil(yF).astype(np.int32)
+    yLerp = np.float32(1.0) - (yF - y0.astype(np.float32))
+    xLerp = xLerp[np.newaxis,:,np.newaxis]
+    yLerp = yLerp[:,np.newaxis,np.newaxis]
+
+    colorTL = getPixels(pdata, x0, y0, h, w, dim, offset)
+    colorTR = getPixels(pdata, x1, y0, h, w, dim, offset)
+    colorBL = getPixels(pdata, x0, y1, h, w, dim, offset)
+    colorBR = getPixels(pdata, x1, y1, h, w, dim, offset)
+
+    colorT = blendColorsCPU(colorTL, colorTR, xLerp)
+    colorB = blendColorsCPU(colorBL, colorBR, xLerp)
+
+    return blendColorsCPU(colorT, colorB, yLerp)
+
+def roundColorCPU(values):
+    # OpenCL round() rounds halfway cases away from zero; colors are never negative
+    return np.floor(values + np.float32(0.5)).astype(np.float32)
@@ -8,6 +8,7 @@ from PIL import Image
 from scipy import stats
 import sys
 
+from lib.collection_utils import *
 from lib.math_utils import *
 from lib.processing_utils import *
 from lib.video_utils import *
@@ -20,18 +21,36 @@ def analyzeAndAdjustVideoFileSamples(p, startKey, durKey, minDur, targetDur, var
     fp = p["filepath"]
     fileIndex = p["fileIndex"]
 
-    video = VideoFileClip(fp, audio=False)
-    videoDur = video.duration
     msStep = frameToMs(1, fps, False)
 
     if verbose:
         print("Reading %s with %s samples" % (fp, len(samples)))
 
+    # collect every frame time of every sample so the whole file can be decoded in one forward pass
+    sampleRanges = []
+    frameTimes = []
     for i, s in enumerate(samples):
         start = s["start"]
         dur = s["dur"] if s["dur"] > targetDur else int(math.ceil(1.0 * targetDur / s["dur"]) * s["dur"])
         variance = pseudoRandom(fileIndex + i, range=(0, varDur), isInt=True)
         end = start + dur + variance
+        sampleRanges.append((start, end))
+        ms = start
+        while ms < end:
+            frameTimes.append(roundInt(ms))
+            ms += msStep
+
+    # get the mean(h, s, v) at each unique frame time
+    uniqueTimes = sorted(set(frameTimes))
+    frameMeans = {}
+    for t, pixels in zip(uniqueTimes, getVideoFrames(fp, uniqueTimes, frameW, frameH, resizeMode="warp", resampleType=Image.NEAREST)):
+        im = Image.fromarray(pixels, mode="RGB").convert('HSV')
+        pixels = np.array(im, dtype=np.uint8)
+        meanHSV = np.mean(pixels, axis=(0,1)) # get the mean of each of the h, s, and v values
+        frameMeans[t] = np.mean(meanHSV) # then get the mean of those three values
+
+    for i, s in enumerate(samples):
+        start, end = sampleRanges[i]
 
         ms = start
         prev = None
@@ -39,11 +58,7 @@ def analyzeAndAdjustVideoFileSamples(p, startKey, durKey, minDur, targetDur, var
         xs = []
         while ms < end:
             t = roundInt(ms)
-            im = getVideoClipImage(video, videoDur, {"width": frameW, "height": frameH}, t, resizeMode="warp", resampleType=Image.NEAREST)
-            im = im.convert('HSV')
-            pixels = np.array(im, dtype=np.uint8)
-            meanHSV = np.mean(pixels, axis=(0,1)) # get the mean of each of the h, s, and v values
-            meanHSV = np.mean(meanHSV) # then get the mean of those three values
+            meanHSV = frameMeans[t]
             if prev is not None:
                 delta = abs(meanHSV-prev)
                 ys.append(delta)
@@ -94,20 +109,15 @@ def analyzeAndAdjustVideoFileSamples(p, startKey, durKey, minDur, targetDur, var
         samples[i][durKey] = roundInt(newEnd-newStart)
         # print("--")
 
-    # close video to free up memory
-    video.reader.close()
-    del video
-
     return samples
 
 def analyzeAndAdjustVideoSamples(samples, startKey, durKey, minDur, targetDur, varDur, frameW, frameH, fps, threads=1, overwrite=False):
-    # find unique filepaths
-    ufilepaths = list(set([s["filepath"] for s in samples]))
+    # group samples by file
     files = [{
-        "samples": [s for s in samples if s["filepath"]==fp],
-        "filepath": fp,
+        "samples": group["items"],
+        "filepath": group["filepath"],
         "fileIndex": i
-    } for i, fp in enumerate(ufilepaths)]
+    } for i, group in enumerate(groupItems(samples, "filepath"))]
     fileCount = len(files)
     print("%s unique files" % fileCount)
 
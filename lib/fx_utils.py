@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# In-process versions of the SoX effects that addFx used through pysndfx: biquad high/low-pass and high shelf, overdrive,
+# echo, and a Freeverb-style reverb. applyFx() takes float arrays between -1 and 1 shaped (frames, channels); the effects
+# themselves work along the last axis, so clips are stacked time-last as (clips, channels, frames) and filtered together
+
+import math
+import numpy as np
+from scipy import signal
+
+# Freeverb tunings at 44.1kHz, as used by SoX's reverb
+REVERB_COMB_LENGTHS = [1116, 1188, 1277, 1356, 1422, 1491, 1557, 1617]
+REVERB_ALLPASS_LENGTHS = [225, 341, 441, 556]
+REVERB_STEREO_ADJUST = 12
+
+def applyFx(data, sampleRate, effects):
+    """Applies a list of (effect, value) tuples to a (frames, channels) array"""
+    return applyFxToClips([data], sampleRate, effects)[0]
+
+def applyFxToClips(clips, sampleRate, effects):
+    """Applies the same list of (effect, value) tuples to a list of (frames, channels) arrays with the same number of channels;
+    clips are padded to the longest one and processed as one (clips, channels, frames) array"""
+    if len(clips) < 1:
+        return []
+    frames = max([len(clip) for clip in clips])
+    channels = clips[0].shape[1]
+    data = np.zeros((len(clips), channels, frames))
+    for i, clip in enumerate(clips):
+        data[i, :, :len(clip)] = clip.T
+
+    for effect, value in effects:
+        if effect == "reverb":
+            data = reverb(data, sampleRate, reverberance=value)
+        elif effect == "distortion":
+            data = overdrive(data, gain=value)
+        elif effect == "highpass":
+            data = biquad(data, *getBiquadCoefficients("highpass", value, sampleRate))
+        elif effect == "lowpass":
+            data = biquad(data, *getBiquadCoefficients("lowpass", value, sampleRate))
+        elif effect == "bass":
+            frequency = 100
+            gain = value
+            if isinstance(value, tuple):
+                gain, frequency = value
+            data = biquad(data, *getBiquadCoefficients("highshelf", frequency, sampleRate, gain=gain))
+        elif effect == "echo":
+            amount = value
+            count = 1
+            # check if we have echo count indicated
+            if isinstance(value, tuple):
+                amount, count = value
+            # amount between 10 (robot) and 1000 (mountains)
+            data = echo(data, sampleRate, [(amount, 0.3)] * count)
+        # like SoX, samples are clipped between effects
+        data = np.clip(data, -1.0, 1.0)
+
+    return [data[i, :, :len(clip)].T for i, clip in enumerate(clips)]
+
+def biquad(data, b, a):
+    return signal.lfilter(b, a, data, axis=-1)
+
+def echo(data, sampleRate, delays, gainIn=0.8, gainOut=0.9):
+    """Feed-forward echo like SoX's echo: delays is a list of (ms, decay); the output is the same length as the input"""
+    result = data * gainIn
+    frames = data.shape[-1]
+    for ms, decay in delays:
+        delay = int(ms * sampleRate / 1000.0)
+        if 0 <= delay < frames:
+            result[..., delay:] += data[..., :frames-delay] * decay
+    return result * gainOut
+
+def getBiquadCoefficients(filterType, frequency, sampleRate, q=0.707, gain=0.0, slope=0.5):
+    """Returns normalized (b, a) from the Audio EQ Cookbook, which is what SoX's highpass, lowpass and treble use"""
+    # keep the frequency below nyquist
+    frequency = min(frequency, sampleRate * 0.49)
+    w0 = 2.0 * math.pi * frequency / sampleRate
+    cosw0 = math.cos(w0)
+    if filterType == "highshelf":
+        A = 10.0 ** (gain / 40.0)
+        alpha = math.sin(w0) / 2.0 * math.sqrt((A + 1.0/A) * (1.0/slope - 1.0) + 2.0)
+        sqrtA2alpha = 2.0 * math.sqrt(A) * alpha
+        b = [A * ((A+1) + (A-1)*cosw0 + sqrtA2alpha), -2.0 * A * ((A-1) + (A+1)*cosw0), A * ((A+1) + (A-1)*cosw0 - sqrtA2alpha)]
+        a = [(A+1) - (A-1)*cosw0 + sqrtA2alpha, 2.0 * ((A-1) - (A+1)*cosw0), (A+1) - (A-1)*cosw0 - sqrtA2alpha]
+    else:
+        alpha = math.sin(w0) / (2.0 * q)
+        if filterType == "highpass":
+            b = [(1.0 + cosw0) / 2.0, -(1.0 + cosw0), (1.0 + cosw0) / 2.0]
+        else:
+            b = [(1.0 - cosw0) / 2.0, 1.0 - cosw0, (1.0 - cosw0) / 2.0]
+        a = [1.0 + alpha, -2.0 * cosw0, 1.0 - alpha]
+    b = np.array(b) / a[0]
+    a = np.array(a) / a[0]
+    return (b, a)
+
+def overdrive(data, gain=20, colour=20):
+    """Soft-clipping overdrive like SoX's overdrive: gain in dB, colour between 0 and 100"""
+    d = data * (10.0 ** (gain / 20.0)) + colour / 200.0
+    d = np.where(d < -1.0, -2.0/3, np.where(d > 1.0, 2.0/3, d - d * d * d * (1.0/3)))
+    # remove the dc offset the colour adds
+    d = signal.lfilter([1.0, -1.0], [1.0, -0.995], d, axis=-1)
+    return data * 0.5 + d * 0.75
+
+def reverb(data, sampleRate, reverberance=50, hfDamping=50, roomScale=100, stereoDepth=100, preDelay=20, wetGain=0):
+    """Freeverb-style reverb with the same parameters (and defaults) as SoX's reverb; data is (..., channels, frames)"""
+    frames = data.shape[-1]
+    channels = data.shape[-2]
+    scale = roomScale / 100.0 * 0.9 + 0.1
+    depth = stereoDepth / 100.0
+    a = -1.0 / math.log(1.0 - 0.3) # minimum feedback
+    b = 100.0 / (math.log(1.0 - 0.98) * a + 1.0) # maximum feedback
+    feedback = 1.0 - math.exp((reverberance - b) / (a * b))
+    damping = hfDamping / 100.0 * 0.3 + 0.2
+    gain = 10.0 ** (wetGain / 20.0) * 0.015
+    delay = int(preDelay / 1000.0 * sampleRate + 0.5)
+
+    # the filters are linear, so reverberating each channel and averaging is the same as reverberating the average;
+    # like SoX, the reverb itself runs in float32
+    mono = np.mean(data, axis=-2)
+    delayed = np.zeros(mono.shape, dtype=np.float32)
+    if delay < frames:
+        delayed[..., delay:] = mono[..., :frames-delay]
+
+    result = np.array(data, dtype=np.float64)
+    for channel in range(channels):
+        # the second channel uses slightly different filter lengths to spread the reverb across the stereo field
+        offset = channel * depth if channels > 1 else 0.0
+        combLengths, allpassLengths = getReverbLengths(sampleRate, scale, offset)
+        wet = np.zeros(mono.shape, dtype=np.float32)
+        for length in combLengths:
+            reverbComb(delayed, wet, length, feedback, damping)
+        for length in reversed(allpassLengths):
+            wet = reverbAllpass(wet, length)
+        result[..., channel, :] += wet * gain
+    return result
+
+def reverbAllpass(data, length):
+    # buf[n] = in[n] + 0.5 * buf[n-length], out[n] = buf[n-length] - in[n]; one block of length samples at a time along the last axis
+    output = np.zeros(data.shape, dtype=data.dtype)
+    previous = np.zeros(data.shape[:-1] + (length,), dtype=data.dtype)
+    for i in range(0, data.shape[-1], length):
+        block = data[..., i:i+length]
+        count = block.shape[-1]
+        output[..., i:i+count] = previous[..., :count] - block
+        previous = block + 0.5 * previous[..., :count]
+    return output
+
+def reverbComb(data, output, length, feedback, damping):
+    # buf[n] = in[n] + feedback * lowpass(buf[n-length]), out[n] = buf[n-length]; one block of length samples at a time
+    # along the last axis, since each block only depends on the one before it; the output is added to output in place
+    b = np.array([1.0 - damping], dtype=data.dtype)
+    a = np.array([1.0, -damping], dtype=data.dtype)
+    previous = np.zeros(data.shape[:-1] + (length,), dtype=data.dtype)
+    zi = np.zeros(data.shape[:-1] + (1,), dtype=data.dtype)
+    for i in range(0, data.shape[-1], length):
+        block = data[..., i:i+length]
+        count = block.shape[-1]
+        output[..., i:i+count] += previous[..., :count]
+        store, zi = signal.lfilter(b, a, previous[..., :count], axis=-1, zi=zi)
+        store *= feedback
+        store += block
+        previous = store
+    return output
+
+def getReverbLengths(sampleRate, scale, offset):
+    r = sampleRate / 44100.0
+    combLengths = []
+    for length in REVERB_COMB_LENGTHS:
+        combLengths.append(max(1, int(scale * r * (length + REVERB_STEREO_ADJUST * offset) + 0.5)))
+        offset = -offset
+    allpassLengths = []
+    for length in REVERB_ALLPASS_LENGTHS:
+        allpassLengths.append(max(1, int(r * (length + REVERB_STEREO_ADJUST * offset) + 0.5)))
+        offset = -offset
+    return (combLengths, allpassLengths)
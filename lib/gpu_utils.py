@@ -3,11 +3,16 @@
 import numpy as np
 import os
 from pprint import pprint
-import pyopencl as cl
 import sys
 
 from lib.clip import *
 
+try:
+    import pyopencl as cl
+except ImportError:
+    cl = None
+    print("Warning: pyopencl module not found, so frames will be rendered on the CPU")
+
 os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
 
 def loadMakeImageProgram(width, height, pcount, colorDimensions, precision):
@@ -292,6 +297,19 @@ def clipsToImageGPULite(width, height, flatPixelData, properties):
     result = result.reshape(height, width, 3)
     return result
 
+def getRenderer(renderer="auto"):
+    if renderer == "auto":
+        renderer = "gpu" if isOpenCLAvailable() else "cpu"
+    return renderer
+
+def isOpenCLAvailable():
+    if cl is None:
+        return False
+    try:
+        return len(cl.get_platforms()) > 0
+    except cl.Error:
+        return False
+
 def loadGPUProgram(srcCode):
     # Get platforms, both CPU and GPU
     plat = cl.get_platforms()
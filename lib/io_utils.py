@@ -5,6 +5,7 @@ import glob
 import json
 from lib.collection_utils import *
 from lib.math_utils import *
+from lib.table_utils import *
 import os
 from pprint import pprint
 import re
@@ -23,6 +24,13 @@ except:
     pass
     # print("reload operation not supported, skipping...")
 
+def appendJSONLine(filename, data):
+    # one object per line; flushed to disk so a line that's been written survives a crash
+    with open(filename, "a", encoding="utf8") as f:
+        f.write(json.dumps(data) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
 def appendToBasename(fn, appendString):
     extLen = len(getFileExt(fn))
     i = len(fn) - extLen
@@ -190,7 +198,10 @@ def parseUnicode(arr):
                     pass
     return arr
 
-def readCsv(filename, headings=False, doParseNumbers=True, skipLines=0, encoding="utf8", readDict=True, verbose=True):
+def readCsv(filename, headings=False, doParseNumbers=True, skipLines=0, encoding="utf8", readDict=True, verbose=True, columns=None):
+    # columns optionally limits which columns are read
+    if isTableFile(filename):
+        return readTable(filename, headings=headings, doParseNumbers=doParseNumbers, readDict=readDict, verbose=verbose, columns=columns)
     rows = []
     fieldnames = []
     canEncode = supportsEncoding()
@@ -207,6 +218,9 @@ def readCsv(filename, headings=False, doParseNumbers=True, skipLines=0, encoding
         else:
             reader = csv.reader(lines, skipinitialspace=True)
         rows = list(reader)
+        if columns is not None and readDict:
+            fieldnames = [name for name in fieldnames if name in columns]
+            rows = [dict([(name, row[name]) for name in fieldnames if name in row]) for row in rows]
         if headings:
             rows = parseHeadings(rows, headings)
         if doParseNumbers:
@@ -224,6 +238,18 @@ def readJSON(filename):
             data = json.load(f)
     return data
 
+def readJSONLines(filename):
+    # lines that don't parse (e.g. one cut off by a crash) are skipped
+    arr = []
+    if os.path.isfile(filename):
+        with open(filename, encoding="utf8") as f:
+            for line in f:
+                try:
+                    arr.append(json.loads(line))
+                except ValueError:
+                    pass
+    return arr
+
 def removeDir(path):
     if os.path.isdir(path):
         shutil.rmtree(path, ignore_errors=True)
@@ -269,6 +295,8 @@ def stringToFilename(string):
     return string
 
 def writeCsv(filename, arr, headings="auto", append=False, encoding="utf8"):
+    if isTableFile(filename):
+        return writeTable(filename, arr, headings=headings, append=append)
     if headings == "auto":
         headings = arr[0].keys() if len(arr) > 0 and type(arr[0]) is dict else None
     mode = 'w' if not append else 'a'
@@ -306,6 +334,14 @@ def writeJSON(filename, data, verbose=True, pretty=False):
         if verbose:
             print("Wrote data to %s" % filename)
 
+def writeJSONLines(filename, arr):
+    # write to a temporary file first so an interrupted write doesn't leave a broken file
+    tmpFn = filename + ".%s.tmp" % os.getpid()
+    with open(tmpFn, "w", encoding="utf8") as f:
+        for data in arr:
+            f.write(json.dumps(data) + "\n")
+    os.replace(tmpFn, filename)
+
 def writeTextFile(filename, text):
     with open(filename, "w", encoding="utf8", errors="replace") as f:
         f.write(text)
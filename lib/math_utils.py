@@ -95,6 +95,56 @@ def ease(n, easingFunction="sin", exp=6, invert=False):
 
     return n if invert is not True else 1.0-n
 
+# same as ease(), but for a numpy array of amounts
+def easeNpArr(n, easingFunction="sin", exp=6, invert=False):
+    n = np.asarray(n, dtype=np.float64)
+
+    if easingFunction.endswith("Invert"):
+        easingFunction = easingFunction[:-6]
+        invert = True
+
+    if "^" in easingFunction:
+        easingFunction, exp = easingFunction.split("^")
+        exp = int(exp)
+
+    if easingFunction == "sin":
+        n = (np.sin((n+1.5)*np.pi)+1.0) / 2.0
+    elif easingFunction == "quadIn":
+        n = n ** 2
+    elif easingFunction == "quadOut":
+        n = n * (2.0 - n)
+    elif easingFunction == "quadInOut":
+        n = np.where(n < 0.5, 2.0 * n * n, -1.0 + (4 - 2.0*n)*n)
+    elif easingFunction == "cubicIn":
+        n = n ** 3
+    elif easingFunction == "cubicOut":
+        n = (n - 1.0)**3 + 1.0
+    elif easingFunction == "cubicInOut":
+        n = np.where(n < 0.5, 4.0 * (n ** 3), (n-1.0)*(2*n-2)*(2*n-2)+1)
+    elif easingFunction == "quartIn":
+        n = n ** 4
+    elif easingFunction == "quartOut":
+        n = 1.0 - (n-1.0)**4
+    elif easingFunction == "quartInOut":
+        n = np.where(n < 0.5, 8.0 * n**4, 1.0 - 8.0 * (n-1.0)**4)
+    elif easingFunction == "quintIn":
+        n = n ** 5
+    elif easingFunction == "quintOut":
+        n = 1.0 + (n - 1.0) ** 5
+    elif easingFunction == "quintInOut":
+        n = np.where(n < 0.5, 16.0 * n**5, 1.0 + 16.0 * (n-1.0)**5)
+    elif easingFunction == "expIn":
+        n = n ** exp
+    elif easingFunction == "expOut":
+        n = 1.0 - (n-1.0)**exp if exp % 2 <= 0 else 1.0 + (n-1.0)**exp
+    elif easingFunction == "expInOut":
+        if exp % 2 <= 0:
+            n = np.where(n < 0.5, 2**(exp-1) * n**exp, 1.0 - 2**(exp-1) * (n-1.0)**exp)
+        else:
+            n = np.where(n < 0.5, 2**(exp-1) * n**exp, 1.0 + 2**(exp-1) * (n-1.0)**exp)
+
+    return n if invert is not True else 1.0-n
+
 def easeSinInOut(n):
     return (math.sin((n+1.5)*math.pi)+1.0) / 2.0
 
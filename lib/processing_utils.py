@@ -1,4 +1,5 @@
 import multiprocessing
+from multiprocessing.dummy import Pool as ThreadPool
 import sys
 
 def getThreadCount(target=-1):
@@ -6,6 +7,30 @@ def getThreadCount(target=-1):
     threads = min(target, cpuCount) if target > 0 else cpuCount
     return threads
 
+def mapItems(fn, items, workers=1, useProcesses=True, chunkSize=1, maxTasksPerChild=None, ordered=False):
+    """Yields fn(item) for each item as workers finish them, so results can be written out without holding them all;
+    uses forked processes (fn and its arguments need to be picklable) unless useProcesses is False or fork isn't available"""
+    items = list(items)
+    workers = min(workers, len(items))
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    if useProcesses and "fork" in multiprocessing.get_all_start_methods():
+        # recycling workers keeps memory from creeping up over long runs of large files
+        pool = multiprocessing.get_context("fork").Pool(workers, maxtasksperchild=maxTasksPerChild)
+    else:
+        pool = ThreadPool(workers)
+    try:
+        results = pool.imap(fn, items, chunkSize) if ordered else pool.imap_unordered(fn, items, chunkSize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
 def printCommand(command):
     pcommand = command[:]
     for i, p in enumerate(pcommand):
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+# Typed columnar tables: the same rows readCsv and writeCsv work with, stored as one raw numpy array per column so a table
+# can be loaded (or memory-mapped) a column at a time instead of parsing every cell. Strings are dictionary-encoded as int32
+# codes into an array of unique values. A table is a single file: column data, then a json footer with the schema, then
+# the footer's length and TABLE_MAGIC. readCsv and writeCsv use this format for filenames ending in TABLE_EXT
+
+import json
+from lib.collection_utils import *
+from lib.math_utils import *
+import numpy as np
+import os
+
+TABLE_EXT = ".cols"
+TABLE_RANGE_MODES = ["<", "<=", ">", ">="]
+TABLE_MAGIC = b"MTCOLS01"
+TABLE_ALIGN = 64
+
+class Table:
+    """Columns of a table held in memory for querying with the filter and sort strings filterByQueryString and sortByQueryString
+    take; filters and sorts are vectorized over the columns, and each column's sorted order is computed once and reused"""
+
+    def __init__(self, fieldnames, columns):
+        # numeric columns are arrays; everything else is int codes into a list of unique values as readCsv returns them
+        self.fieldnames = fieldnames
+        self.columns = columns
+        self.rowCount = len(columns[fieldnames[0]]["data"]) if len(fieldnames) > 0 else 0
+        self.orders = {}
+        self.ranks = {}
+        self.uniques = {}
+
+    def filter(self, filters, indices=None):
+        """Returns the indices of rows that match a filter string or list of (key, value[, mode]) filters, like filterWhere"""
+        if not isinstance(filters, list):
+            filters = parseFilterString(filters) if isinstance(filters, str) else [filters]
+        mask = np.ones(self.rowCount, dtype=bool)
+        for f in filters:
+            mode = "="
+            if len(f) == 2:
+                key, value = f
+            else:
+                key, value, mode = f
+            # like filterWhere, rows without the key always match
+            if key not in self.columns:
+                continue
+            mask &= self.getMask(key, parseNumber(value), mode)
+        if indices is None:
+            return np.flatnonzero(mask)
+        indices = np.array(indices, dtype=np.int64)
+        return indices[mask[indices]]
+
+    def getMask(self, key, value, mode):
+        column = self.columns[key]
+        isNumber = isinstance(value, (int, float)) and not isinstance(value, bool)
+        if column["kind"] in ("int", "float") and isNumber:
+            data = column["data"]
+            if mode in TABLE_RANGE_MODES:
+                # range filters are a slice of the column's sorted order
+                order = self.getOrder(key)
+                sortedData = data[order]
+                validCount = len(sortedData) - int(np.count_nonzero(np.isnan(sortedData))) if column["kind"] == "float" else len(sortedData)
+                sortedData = sortedData[:validCount]
+                if mode == "<":
+                    selected = order[:np.searchsorted(sortedData, value, side="left")]
+                elif mode == "<=":
+                    selected = order[:np.searchsorted(sortedData, value, side="right")]
+                elif mode == ">":
+                    selected = order[np.searchsorted(sortedData, value, side="right"):validCount]
+                else:
+                    selected = order[np.searchsorted(sortedData, value, side="left"):validCount]
+                mask = np.zeros(self.rowCount, dtype=bool)
+                mask[selected] = True
+                return mask
+            if mode == "!=":
+                return data != value
+            if mode == "=":
+                return data == value
+        # anything else is compared like filterWhere does, once per unique value
+        uniques, codes = self.getUniques(key)
+        matches = np.array([matchesFilter(u, value, mode) for u in uniques], dtype=bool)
+        return matches[codes]
+
+    def getOrder(self, key, desc=False):
+        # stable order of all rows by a column; rows with equal values keep their original order
+        if (key, desc) not in self.orders:
+            rank = self.getRank(key)
+            if desc:
+                self.orders[(key, desc)] = np.lexsort((np.arange(self.rowCount), -rank))
+            else:
+                self.orders[(key, desc)] = np.argsort(rank, kind="stable")
+        return self.orders[(key, desc)]
+
+    def getRank(self, key):
+        # dense rank of each row's value in the column, i.e. equal values have equal ranks
+        if key not in self.ranks:
+            uniques, codes = self.getUniques(key)
+            uniqueOrder = sorted(range(len(uniques)), key=lambda i: uniques[i])
+            uniqueRanks = np.zeros(len(uniques), dtype=np.int64)
+            rank = 0
+            for j, i in enumerate(uniqueOrder):
+                if j > 0 and uniques[i] != uniques[uniqueOrder[j-1]]:
+                    rank += 1
+                uniqueRanks[i] = rank
+            self.ranks[key] = uniqueRanks[codes] if len(uniques) > 0 else np.zeros(self.rowCount, dtype=np.int64)
+        return self.ranks[key]
+
+    def getRows(self, indices=None, fieldnames=None):
+        """Returns the rows at indices as dicts"""
+        indices = np.arange(self.rowCount) if indices is None else np.array(indices, dtype=np.int64)
+        fieldnames = self.fieldnames if fieldnames is None else [name for name in fieldnames if name in self.columns]
+        lists = []
+        for name in fieldnames:
+            column = self.columns[name]
+            if column["kind"] in ("int", "float"):
+                lists.append(column["data"][indices].tolist())
+            else:
+                values = column["values"]
+                lists.append([values[c] for c in column["data"][indices].tolist()])
+        return [dict(zip(fieldnames, values)) for values in zip(*lists)]
+
+    def getUniques(self, key):
+        # a column's unique values and each row's index into them
+        column = self.columns[key]
+        if column["kind"] not in ("int", "float"):
+            return (column["values"], column["data"])
+        if key not in self.uniques:
+            uniques, codes = np.unique(column["data"], return_inverse=True)
+            self.uniques[key] = (uniques.tolist(), codes.reshape(-1))
+        return self.uniques[key]
+
+    def query(self, filters="", sorters="", limit=None):
+        """Returns the indices of rows matching filters, sorted by sorters and cut off at limit"""
+        indices = self.filter(filters)
+        return self.sort(sorters, indices, limit)
+
+    def sort(self, sorters, indices=None, targetLen=None):
+        """Returns indices sorted by a sort string or list of (key, direction[, trim]) sorters, like sortBy; like sortBy,
+        each sorter re-sorts the result of the one before it"""
+        if not isinstance(sorters, list):
+            sorters = parseSortString(sorters) if isinstance(sorters, str) else [sorters]
+        indices = np.arange(self.rowCount) if indices is None else np.array(indices, dtype=np.int64)
+        # rows still in their original order can be picked out of the column's cached order
+        isOriginalOrder = len(indices) < 2 or bool(np.all(np.diff(indices) > 0))
+        for s in sorters:
+            trim = 1.0
+            if len(s) > 2:
+                key, direction, trim = s
+                trim = float(trim)
+            else:
+                key, direction = s
+            desc = (direction == "desc")
+            if key not in self.columns:
+                raise KeyError(key)
+            if isOriginalOrder:
+                selected = np.zeros(self.rowCount, dtype=bool)
+                selected[indices] = True
+                order = self.getOrder(key, desc)
+                indices = order[selected[order]]
+                isOriginalOrder = False
+            else:
+                rank = self.getRank(key)[indices]
+                positions = np.arange(len(indices))
+                indices = indices[np.lexsort((positions, -rank)) if desc else np.argsort(rank, kind="stable")]
+
+            if 0.0 < trim < 1.0:
+                count = int(round(len(indices) * trim))
+                if targetLen is not None:
+                    count = max(count, targetLen)
+                indices = indices[:count]
+
+        if targetLen is not None and len(indices) > targetLen:
+            indices = indices[:targetLen]
+        return indices
+
+def columnToList(column, parse=True):
+    # the values of one column as readCsv would return them: with parse=False everything is the text that was written
+    kind = column["kind"]
+    if kind in ("int", "float"):
+        values = column["data"].tolist()
+        return values if parse else [str(v) for v in values]
+    uniques = column["values"].tolist()
+    if kind == "text" and parse:
+        uniques = [parseNumber(v) for v in uniques]
+    return [uniques[c] for c in column["data"].tolist()]
+
+def getTableColumn(values):
+    # returns the values as a typed column; anything that isn't all ints or all floats is stored as the text writeCsv would write
+    if len(values) > 0 and all([isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) for v in values]):
+        try:
+            return {"kind": "int", "data": np.array(values, dtype=np.int64)}
+        except OverflowError:
+            pass
+    elif len(values) > 0 and all([isinstance(v, float) for v in values]):
+        return {"kind": "float", "data": np.array(values, dtype=np.float64)}
+
+    index = {}
+    codes = [index.setdefault(valueToText(v), len(index)) for v in values]
+    uniques = list(index.keys())
+    # text that readCsv would parse into numbers is parsed again when it's read; other text is returned as is
+    kind = "str" if all([isinstance(parseNumber(v), str) for v in uniques]) else "text"
+    return {
+        "kind": kind,
+        "data": np.array(codes, dtype=np.int32),
+        "values": np.array(uniques, dtype="U%s" % max([1] + [len(v) for v in uniques]))
+    }
+
+def getTable(rows, fieldnames=None):
+    """Returns a Table of a list of dicts, e.g. rows from readCsv"""
+    if fieldnames is None:
+        fieldnames = list(rows[0].keys()) if len(rows) > 0 else []
+    columns = {}
+    for name in fieldnames:
+        values = [row[name] if name in row else "" for row in rows]
+        if len(values) > 0 and all([isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) for v in values]):
+            columns[name] = {"kind": "int", "data": np.array(values, dtype=np.int64)}
+        elif len(values) > 0 and all([isinstance(v, float) for v in values]):
+            columns[name] = {"kind": "float", "data": np.array(values, dtype=np.float64)}
+        else:
+            index = {}
+            uniques = []
+            codes = []
+            for v in values:
+                # lists can't be hashed, so they're indexed by their text
+                k = valueToText(v) if isinstance(v, list) else v
+                if k not in index:
+                    index[k] = len(uniques)
+                    uniques.append(v)
+                codes.append(index[k])
+            columns[name] = {"kind": "values", "data": np.array(codes, dtype=np.int64), "values": uniques}
+    return Table(fieldnames, columns)
+
+def isTableFile(fn):
+    return fn.endswith(TABLE_EXT)
+
+def loadTable(filename, columns=None, keyExceptions=['id', 'identifier']):
+    """Returns a Table of a .cols file (memory-mapped) or a csv, with the same values readCsv would return"""
+    if not isTableFile(filename):
+        from lib.io_utils import readCsv
+        fieldnames, rows = readCsv(filename, columns=columns)
+        return getTable(rows, fieldnames)
+    fieldnames, tableColumns = readTableColumns(filename, columns=columns, mmap=True)
+    for name in fieldnames:
+        column = tableColumns[name]
+        kind = column["kind"]
+        if kind in ("int", "float") and name in keyExceptions:
+            # key exceptions are text in the rows readCsv returns
+            uniques, codes = np.unique(column["data"], return_inverse=True)
+            tableColumns[name] = {"kind": "values", "data": codes.reshape(-1), "values": [str(v) for v in uniques.tolist()]}
+        elif kind in ("str", "text"):
+            values = column["values"].tolist()
+            if kind == "text" and name not in keyExceptions:
+                values = [parseNumber(v) for v in values]
+            tableColumns[name] = {"kind": "values", "data": column["data"], "values": values}
+    print("Loaded table with %s rows from %s" % (len(tableColumns[fieldnames[0]]["data"]) if len(fieldnames) > 0 else 0, filename))
+    return Table(fieldnames, tableColumns)
+
+def matchesFilter(v, value, mode):
+    # the comparisons filterWhere makes for each mode
+    if mode == "<=":
+        return v <= value
+    elif mode == ">=":
+        return v >= value
+    elif mode == "<":
+        return v < value
+    elif mode == ">":
+        return v > value
+    elif mode == "~=":
+        return value in v
+    elif mode == "!=":
+        return v != value
+    elif mode == "!~=":
+        return value not in v
+    return v == value
+
+def readTable(filename, headings=False, doParseNumbers=True, readDict=True, verbose=True, columns=None, keyExceptions=['id', 'identifier']):
+    """Reads a table written by writeTable and returns (fieldnames, rows) like readCsv does for the same rows written as a csv"""
+    if not os.path.isfile(filename):
+        return ([], [])
+    fieldnames, tableColumns = readTableColumns(filename, columns=columns, mmap=False)
+    names = fieldnames
+    keys = fieldnames
+    # like parseHeadings, only the columns in headings are kept, under their new names
+    if headings and readDict:
+        names = [name for name in fieldnames if name in headings]
+        keys = [headings[name] for name in names]
+    # like parseNumbers, key exceptions stay as text in dicts
+    lists = [columnToList(tableColumns[name], doParseNumbers and not (readDict and key in keyExceptions)) for name, key in zip(names, keys)]
+    if readDict:
+        rows = [dict(zip(keys, values)) for values in zip(*lists)]
+    else:
+        # like csv.reader, the headings are the first row
+        rows = [fieldnames[:]] + [list(values) for values in zip(*lists)]
+        fieldnames = []
+    if verbose:
+        print("Read %s rows from %s" % (len(rows), filename))
+    return (fieldnames, rows)
+
+def readTableColumns(filename, columns=None, mmap=True):
+    """Returns (fieldnames, columns) where each column is a dict with its kind, its data array and, for strings, its unique values;
+    only the requested columns are read, and with mmap the arrays are read-only views of the file"""
+    with open(filename, "rb") as f:
+        f.seek(-16, os.SEEK_END)
+        footerLength = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        if f.read(8) != TABLE_MAGIC:
+            raise ValueError("%s is not a table file" % filename)
+        f.seek(-16-footerLength, os.SEEK_END)
+        footer = json.loads(f.read(footerLength).decode("utf-8"))
+
+    fieldnames = [c["name"] for c in footer["columns"]]
+    if columns is not None:
+        fieldnames = [name for name in fieldnames if name in columns]
+    tableColumns = {}
+    for c in footer["columns"]:
+        if c["name"] not in fieldnames:
+            continue
+        column = {"kind": c["kind"], "data": readTableArray(filename, c["data"], mmap)}
+        if "values" in c:
+            column["values"] = readTableArray(filename, c["values"], mmap)
+        tableColumns[c["name"]] = column
+    return (fieldnames, tableColumns)
+
+def readTableArray(filename, block, mmap=True):
+    dtype = np.dtype(block["dtype"])
+    if block["length"] <= 0:
+        return np.zeros(0, dtype=dtype)
+    if mmap:
+        return np.memmap(filename, dtype=dtype, mode="r", offset=block["offset"], shape=(block["length"],))
+    return np.fromfile(filename, dtype=dtype, count=block["length"], offset=block["offset"])
+
+def valueToText(value):
+    # what writeCsv writes for a value
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return ",".join(value)
+    return str(value)
+
+def writeTable(filename, arr, headings="auto", append=False, verbose=True):
+    """Writes a list of dicts as a table; tables are written in one go, so rows can't be appended to an existing table"""
+    if append and os.path.isfile(filename):
+        raise ValueError("Can't append to %s; write all of a table's rows at once" % filename)
+    if headings == "auto":
+        headings = list(arr[0].keys()) if len(arr) > 0 and type(arr[0]) is dict else []
+    headings = list(headings)
+
+    blocks = []
+    footer = {"rows": len(arr), "columns": []}
+    offset = 0
+    for h in headings:
+        column = getTableColumn([d[h] if h in d else "" for d in arr])
+        entry = {"name": h, "kind": column["kind"]}
+        for key in ("data", "values"):
+            if key not in column:
+                continue
+            data = np.ascontiguousarray(column[key])
+            # align each array so it can be memory-mapped
+            offset = int(np.ceil(1.0 * offset / TABLE_ALIGN) * TABLE_ALIGN)
+            entry[key] = {"dtype": data.dtype.newbyteorder("<").str, "offset": offset, "length": len(data)}
+            blocks.append((offset, data.astype(data.dtype.newbyteorder("<"), copy=False)))
+            offset += data.nbytes
+        footer["columns"].append(entry)
+    footer = json.dumps(footer).encode("utf-8")
+
+    dirname = os.path.dirname(filename)
+    if len(dirname) > 0 and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    # write to a temporary file first so an interrupted write never leaves a partial table
+    tmpFn = filename + ".tmp"
+    with open(tmpFn, "wb") as f:
+        for blockOffset, data in blocks:
+            f.write(b"\0" * (blockOffset - f.tell()))
+            f.write(data.tobytes())
+        f.write(footer)
+        f.write(np.array([len(footer)], dtype="<u8").tobytes())
+        f.write(TABLE_MAGIC)
+    os.replace(tmpFn, filename)
+    if verbose:
+        print("Wrote %s rows to %s" % (len(arr), filename))
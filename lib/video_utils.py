@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from functools import partial
+import hashlib
 from lib.cache_utils import *
 from lib.clip import *
 from lib.collection_utils import *
+from lib.cpu_utils import *
 from lib.gpu_utils import *
 from lib.math_utils import *
 from lib.processing_utils import *
 from moviepy.editor import VideoFileClip
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
 import multiprocessing
 from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
@@ -17,6 +20,64 @@ from PIL import Image, ImageDraw, ImageFilter
 from pprint import pprint
 import subprocess
 import sys
+import threading
+
+class FrameCollector:
+    """Holds rendered frames in a worker process until they're returned to the FrameStreamWriter in the main process"""
+
+    def __init__(self):
+        self.frames = []
+
+    def write(self, frame, im):
+        self.frames.append((frame, im.tobytes()))
+
+class FrameStreamWriter:
+    """Pipes raw RGB frames into ffmpeg in frame order; frames that finish early wait in a reorder buffer"""
+
+    def __init__(self, outfile, fps, width, height, firstFrame=1, audioFile=None, quality="high"):
+        self.width = width
+        self.height = height
+        self.nextFrame = firstFrame
+        self.buffer = {}
+        self.lock = threading.Lock()
+
+        preset, crf = getEncodingQuality(quality)
+        command = ['ffmpeg','-y',
+                    '-f','rawvideo',
+                    '-pix_fmt','rgb24',
+                    '-s','%sx%s' % (width, height),
+                    '-framerate',str(fps)+'/1',
+                    '-i','-']
+        if audioFile:
+            command += ['-i',audioFile]
+        command += ['-c:v','libx264',
+                    '-preset', preset,
+                    '-crf', crf,
+                    '-r',str(fps),
+                    '-pix_fmt','yuv420p']
+        if audioFile:
+            command += ['-c:a','aac',
+                        '-b:a', '192k']
+        command += [outfile]
+        print(" ".join(command))
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def close(self):
+        if len(self.buffer) > 0:
+            print("Warning: %s frames were never written because frame %s is missing" % (len(self.buffer), self.nextFrame))
+        self.process.stdin.close()
+        returnCode = self.process.wait()
+        if returnCode != 0:
+            raise subprocess.CalledProcessError(returnCode, "ffmpeg")
+        print("Done.")
+
+    def write(self, frame, im):
+        data = im if isinstance(im, bytes) else im.convert("RGB").tobytes()
+        with self.lock:
+            self.buffer[frame] = data
+            while self.nextFrame in self.buffer:
+                self.process.stdin.write(self.buffer.pop(self.nextFrame))
+                self.nextFrame += 1
 
 def addVideoArgs(parser):
     parser.add_argument('-in', dest="INPUT_FILE", default="tmp/samples.csv", help="Input file")
@@ -30,7 +91,11 @@ def addVideoArgs(parser):
     parser.add_argument('-outframe', dest="OUTPUT_FRAME", default="tmp/sample/frame.%s.png", help="Output frames pattern")
     parser.add_argument('-out', dest="OUTPUT_FILE", default="output/sample.mp4", help="Output media file")
     parser.add_argument('-threads', dest="THREADS", default=1, type=int, help="Amount of parallel frames to process (too many may result in too many open files)")
+    parser.add_argument('-segframes', dest="SEGMENT_FRAMES", default=0, type=int, help="Encode frames in segments of this many frames (e.g. 480), re-encoding only segments whose frames changed; 0 to encode all frames at once")
+    parser.add_argument('-stream', dest="STREAM_FRAMES", action="store_true", help="Pipe rendered frames straight into ffmpeg instead of saving and compiling frame images")
+    parser.add_argument('-procs', dest="PROCESSES", default=1, type=int, help="Amount of processes to render frames in, each rendering a contiguous range of frames; -1 for all cores")
     parser.add_argument('-overwrite', dest="OVERWRITE", action="store_true", help="Overwrite existing frames?")
+    parser.add_argument('-astream', dest="AUDIO_STREAM", action="store_true", help="Mix audio in windows that are written straight to the output file, so memory doesn't grow with the composition's duration")
     parser.add_argument('-ao', dest="AUDIO_ONLY", action="store_true", help="Render audio only?")
     parser.add_argument('-vo', dest="VIDEO_ONLY", action="store_true", help="Render video only?")
     parser.add_argument('-cache', dest="CACHE_VIDEO", action="store_true", help="Cache video clips?")
@@ -60,6 +125,7 @@ def addVideoArgs(parser):
     parser.add_argument('-probe', dest="PROBE", action="store_true", help="Just spit out duration info?")
     parser.add_argument('-frame', dest="OUTPUT_SINGLE_FRAME", default=-1, type=int, help="Output only a single frame (indicated frame number)")
     parser.add_argument('-frange', dest="FRAME_RANGE", default="1,0", help="Frame range to render")
+    parser.add_argument('-renderer', dest="RENDERER", default="auto", help="Frame renderer: auto, gpu, or cpu (auto uses the CPU if no OpenCL platform is found)")
 
 def alphaMask(im, mask):
     w, h = im.size
@@ -106,6 +172,7 @@ def clipsToFrame(p, clips, pixelData, precision=3, customClipToArrFunction=None,
     frameAlpha = getValue(globalArgs, "frameAlpha", None)
     isSequential = getValue(globalArgs, "isSequential", False)
     container = getValue(globalArgs, "container", None)
+    frameWriter = getValue(globalArgs, "frameWriter", None)
 
     im = None
     fileExists = filename and os.path.isfile(filename) and not overwrite
@@ -142,6 +209,8 @@ def clipsToFrame(p, clips, pixelData, precision=3, customClipToArrFunction=None,
         if saveFrame:
             im.save(filename)
             print("Saved frame %s" % filename)
+        elif frameWriter is not None:
+            frameWriter.write(frame, im)
         if frameAlpha is None:
             returnValue = im
 
@@ -288,26 +357,18 @@ def clipsToFrameGPU(clips, width, height, clipsPixelData, precision=3, baseImage
         pixelData[px0:px1] = pixels.reshape(-1)
         offset += int(h*w*c)
 
-    pixels = clipsToImageGPU(width, height, pixelData, properties, c, precision, gpuProgram=gpuProgram, baseImage=baseImage)
+    renderer = getValue(globalArgs, "renderer", "gpu")
+    if renderer == "cpu":
+        pixels = clipsToImageCPU(width, height, pixelData, properties, c, precision, baseImage=baseImage)
+    else:
+        pixels = clipsToImageGPU(width, height, pixelData, properties, c, precision, gpuProgram=gpuProgram, baseImage=baseImage)
     return Image.fromarray(pixels, mode="RGB")
 
 def compileFrames(infile, fps, outfile, padZeros, audioFile=None, quality="high"):
     print("Compiling frames...")
     padStr = '%0'+str(padZeros)+'d'
 
-    # https://trac.ffmpeg.org/wiki/Encode/H.264
-    # presets: veryfast, faster, fast, medium, slow, slower, veryslow
-    #   slower = better quality
-    # crf: 0 is lossless, 23 is the default, and 51 is worst possible quality
-    #   17 or 18 to be visually lossless or nearly so
-    preset = "veryslow"
-    crf = "18"
-    if quality=="medium":
-        preset = "medium"
-        crf = "23"
-    elif quality=="low":
-        preset = "medium"
-        crf = "28"
+    preset, crf = getEncodingQuality(quality)
 
     if audioFile:
         command = ['ffmpeg','-y',
@@ -339,6 +400,77 @@ def compileFrames(infile, fps, outfile, padZeros, audioFile=None, quality="high"
     finished = subprocess.check_call(command)
     print("Done.")
 
+def compileFrameSegments(infile, fps, outfile, frameCount, segmentFrames=480, audioFile=None, quality="high", threads=1):
+    print("Compiling frames in segments...")
+    preset, crf = getEncodingQuality(quality)
+    segmentDir = os.path.splitext(outfile)[0] + "_segments/"
+    makeDirectories(segmentDir)
+    manifestFn = segmentDir + "segments.json"
+    manifest = readJSON(manifestFn)
+    # re-encode everything if encoding settings changed
+    settings = {"fps": fps, "frameCount": frameCount, "segmentFrames": segmentFrames, "preset": preset, "crf": crf}
+    if getValue(manifest, "settings", None) != settings:
+        manifest = {"settings": settings, "segments": {}}
+
+    segmentCount = int(math.ceil(1.0 * frameCount / segmentFrames))
+    segments = []
+    for i in range(segmentCount):
+        start = i * segmentFrames + 1
+        end = min(start + segmentFrames - 1, frameCount)
+        filename = segmentDir + "segment.%s.mp4" % zeroPad(i, segmentCount)
+        frameFilenames = [infile % zeroPad(frame, frameCount) for frame in range(start, end+1)]
+        segments.append({"index": i, "start": start, "count": end-start+1, "filename": filename, "signature": getFilesSignature(frameFilenames)})
+
+    # only encode segments whose frames changed since they were last encoded
+    encodeSegments = [s for s in segments if not os.path.isfile(s["filename"]) or getValue(manifest["segments"], s["filename"], None) != s["signature"]]
+    print("Encoding %s of %s segments" % (len(encodeSegments), segmentCount))
+    padStr = '%0'+str(getZeroPadding(frameCount))+'d'
+    def encodeSegment(segment):
+        command = ['ffmpeg','-y',
+                    '-loglevel','error',
+                    '-framerate',str(fps)+'/1',
+                    '-start_number',str(segment["start"]),
+                    '-i',infile % padStr,
+                    '-frames:v',str(segment["count"]),
+                    '-c:v','libx264',
+                    '-preset', preset,
+                    '-crf', crf,
+                    '-r',str(fps),
+                    '-pix_fmt','yuv420p',
+                    segment["filename"]]
+        subprocess.check_call(command)
+        return segment
+    threads = getThreadCount(threads)
+    pool = ThreadPool(threads)
+    for i, segment in enumerate(pool.imap_unordered(encodeSegment, encodeSegments)):
+        # record each segment as it finishes so an interrupted encode can resume
+        manifest["segments"][segment["filename"]] = segment["signature"]
+        writeJSON(manifestFn, manifest, verbose=False)
+        printProgress(i+1, len(encodeSegments))
+    pool.close()
+    pool.join()
+
+    # stream-copy the segments into one file along with the audio
+    listFn = segmentDir + "segments.txt"
+    writeTextFile(listFn, "\n".join(["file '%s'" % os.path.basename(s["filename"]) for s in segments]) + "\n")
+    command = ['ffmpeg','-y',
+                '-f','concat',
+                '-safe','0',
+                '-i',listFn]
+    if audioFile:
+        command += ['-i',audioFile,
+                    '-map','0:v',
+                    '-map','1:a',
+                    '-c:v','copy',
+                    '-c:a','aac',
+                    '-b:a', '192k']
+    else:
+        command += ['-c:v','copy']
+    command += [outfile]
+    print(" ".join(command))
+    finished = subprocess.check_call(command)
+    print("Done.")
+
 def containImage(img, w, h, resampleType="default", bgcolor=[0,0,0]):
     resampleType = Image.LANCZOS if resampleType=="default" else resampleType
     vw, vh = img.size
@@ -447,6 +579,17 @@ def getCenter(clip):
     cy = clip["y"] + clip["height"] * 0.5
     return (cx, cy)
 
+# the timestamps of each frame that a clip will read from its source video
+def getClipFrameTimes(clip, msStep):
+    start = clip.props["start"]
+    end = start + clip.props["dur"]
+    ms = start
+    times = []
+    while ms < end:
+        times.append(roundInt(ms))
+        ms += msStep
+    return times
+
 def getDurationFromFile(filename, accurate=False):
     result = 0
     if os.path.isfile(filename):
@@ -478,6 +621,33 @@ def getEmptyVideoClipImage(clip):
     return clipImg
 
 # e.g. returns ['audio', 'video'] for a/v files
+def getEncodingQuality(quality="high"):
+    # https://trac.ffmpeg.org/wiki/Encode/H.264
+    # presets: veryfast, faster, fast, medium, slow, slower, veryslow
+    #   slower = better quality
+    # crf: 0 is lossless, 23 is the default, and 51 is worst possible quality
+    #   17 or 18 to be visually lossless or nearly so
+    preset = "veryslow"
+    crf = "18"
+    if quality=="medium":
+        preset = "medium"
+        crf = "23"
+    elif quality=="low":
+        preset = "medium"
+        crf = "28"
+    return (preset, crf)
+
+def getFilesSignature(filenames):
+    # changes if any of the files are added, removed, or modified
+    h = hashlib.md5()
+    for fn in filenames:
+        if os.path.isfile(fn):
+            stat = os.stat(fn)
+            h.update(("%s:%s:%s;" % (fn, stat.st_size, stat.st_mtime_ns)).encode("utf8"))
+        else:
+            h.update(("%s:missing;" % fn).encode("utf8"))
+    return h.hexdigest()
+
 def getMediaTypes(filename):
     result = []
     if os.path.isfile(filename):
@@ -499,13 +669,7 @@ def getVideoClipImage(video, videoDur, clip, t=None, resizeMode="fill", resample
     videoT = clip["t"] / 1000.0 if t is None else t / 1000.0
     cw = roundInt(clip["width"])
     ch = roundInt(clip["height"])
-    delta = videoDur - videoT
-    # check if we need to loop video clip
-    if delta < 0:
-        videoT = videoT % videoDur
-    # hack: ffmpeg sometimes has trouble reading the very end of the video; choose 500ms from end
-    elif delta < 0.5:
-        videoT = videoDur - 0.5
+    videoT = getVideoClipTime(videoT, videoDur)
     # a numpy array representing the RGB picture of the clip
     try:
         videoPixels = video.get_frame(videoT)
@@ -516,6 +680,86 @@ def getVideoClipImage(video, videoDur, clip, t=None, resizeMode="fill", resample
     clipImg = resizeImage(clipImg, cw, ch, resizeMode, resampleType)
     return clipImg
 
+def getVideoClipTime(videoT, videoDur):
+    delta = videoDur - videoT
+    # check if we need to loop video clip
+    if delta < 0:
+        videoT = videoT % videoDur
+    # hack: ffmpeg sometimes has trouble reading the very end of the video; choose 500ms from end
+    elif delta < 0.5:
+        videoT = videoDur - 0.5
+    return videoT
+
+# Yields a frame (as a numpy array) for each time in ms, in order. Instead of seeking for every frame, frames are read
+# forward from a single ffmpeg pipe for as long as the requested times keep moving forward by less than maxGap ms,
+# so pass times sorted for best performance. Frames are resized to width x height if given, by ffmpeg if scale is true
+def getVideoFrames(filename, times, width=None, height=None, resizeMode="fill", resampleType="default", scale=True, maxGap=2000):
+    info = ffmpeg_parse_infos(filename)
+    videoDur = info["duration"]
+    fps = info["video_fps"]
+    vw, vh = tuple(info["video_size"])
+    resize = width is not None and height is not None
+    scale = scale and resize
+    if resize:
+        width = roundInt(width)
+        height = roundInt(height)
+    fw, fh = (width, height) if scale else (vw, vh)
+    frameSize = fw * fh * 3
+    maxGapFrames = max(1, roundInt(maxGap / 1000.0 * fps))
+
+    vfilter = None
+    if scale:
+        flags = "neighbor" if resampleType == Image.NEAREST else "lanczos"
+        if resizeMode == "warp":
+            vfilter = "scale=%s:%s:flags=%s" % (width, height, flags)
+        elif resizeMode == "contain":
+            vfilter = "scale=%s:%s:force_original_aspect_ratio=decrease:flags=%s,pad=%s:%s:(ow-iw)/2:(oh-ih)/2" % (width, height, flags, width, height)
+        else:
+            vfilter = "scale=%s:%s:force_original_aspect_ratio=increase:flags=%s,crop=%s:%s" % (width, height, flags, width, height)
+
+    proc = None
+    pos = -1
+    lastFrame = None
+    for t in times:
+        videoT = getVideoClipTime(t / 1000.0, videoDur)
+        frameIndex = int(videoT * fps + 0.00001)
+
+        # start a new read if we need to go backwards or would skip too many frames
+        if proc is None or frameIndex < pos or (frameIndex - pos) > maxGapFrames:
+            if proc is not None:
+                proc.stdout.close()
+                proc.wait()
+            # seek to half a frame before so rounding can't skip the frame we want
+            ss = max(0.0, (frameIndex - 0.5) / fps)
+            command = ['ffmpeg', '-loglevel', 'error', '-ss', str(ss), '-i', filename, '-an']
+            if vfilter is not None:
+                command += ['-vf', vfilter]
+            command += ['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+            proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=frameSize*4)
+            pos = frameIndex - 1
+            lastFrame = None
+
+        while pos < frameIndex:
+            data = proc.stdout.read(frameSize)
+            # reached the end of the video; keep the last frame
+            if len(data) < frameSize:
+                break
+            lastFrame = data
+            pos += 1
+
+        if lastFrame is None:
+            print("Could not read pixels for %s at time %s" % (filename, videoT))
+            frame = np.zeros((height, width, 3) if resize else (fh, fw, 3), dtype=np.uint8)
+        else:
+            frame = np.frombuffer(lastFrame, dtype=np.uint8).reshape(fh, fw, 3)
+            if resize and not scale:
+                frame = np.array(resizeImage(Image.fromarray(frame, mode="RGB"), width, height, resizeMode, resampleType), dtype=np.uint8)
+        yield frame
+
+    if proc is not None:
+        proc.stdout.close()
+        proc.wait()
+
 def getRotation(clip):
     rotation = clip["rotation"] if "rotation" in clip else 0.0
     angle = normalizeAngle(rotation)
@@ -543,103 +787,72 @@ def loadVideoPixelData(clips, fps, cacheDir="tmp/", width=None, height=None, ver
 
     # only open one video at a time
     for i, fn in enumerate(filenames):
-        # check for cache fors filename
-        cacheFn = cacheDir + os.path.basename(fn) + ".p"
-        loaded = False
-        fileCacheData = []
-        if cache:
-            loaded, fileCacheData = loadCacheFile(cacheFn)
+        # check for frame stores for filename
+        manifestFn = getFrameStoreManifestFilename(cacheDir, fn)
+        manifest = loadFrameStoreManifest(manifestFn) if cache else {}
         vclips = [c for c in clips if fn==c.props["filename"]]
-        valid = True
-
-        # Verify loaded data
-        if loaded and verifyData:
-            print("Verifying cache data for %s..." % cacheFn)
-            clipTimesSet = set(fileCacheData[0])
-            for clip in vclips:
-                start = clip.props["start"]
-                end = start + clip.props["dur"]
-                ms = start
-                while ms < end:
-                    t = roundInt(ms)
-                    ms += msStep
-                    if t not in clipTimesSet:
-                        print("%s not found in %s. Resetting cache data" % (t, cacheFn))
-                        loaded = False
-                        break
-                    index = fileCacheData[0].index(t)
-                    clipH, clipW, _ = fileCacheData[1][index].shape
-                    if roundInt(clip.props["maxWidth"]) > clipW:
-                        print("Clip width is too small (%s > %s) for %s at %s. Resetting cache data" % (clip.props["maxWidth"], clipW, cacheFn, t))
-                        loaded = False
-                        break
-                    # TODO: Add check for aspect ratio?
-                if not loaded:
-                    break
-            print("Verified cache data for %s" % cacheFn)
-
-        if not loaded:
-            print("No cache for %s, rebuilding..." % fn)
-            video = VideoFileClip(fn, audio=False)
-            videoDur = video.duration
-            clipTimes = []
-            clipPixels = []
-
-            # Already loaded cache data; append to it rather than overwrite it
-            if len(fileCacheData) > 0:
-                clipTimes, clipPixels = fileCacheData
-
-            # extract frames from videos
-            vclipCount = len(vclips)
-            for j, clip in enumerate(vclips):
-                start = clip.props["start"]
-                end = start + clip.props["dur"]
-                ms = start
-                while ms < end:
-                    fclip = clip.props.copy()
-                    fclip["width"] = fclip["maxWidth"]
-                    fclip["height"] = fclip["maxHeight"]
-                    t = roundInt(ms)
-                    ms += msStep
-                    # already exists, check size
-                    existIndex = None
-                    if t in set(clipTimes):
-                        existIndex = clipTimes.index(t)
-                        clipH, clipW, _ = clipPixels[existIndex].shape
-                        if roundInt(fclip["width"]) <= clipW:
-                            continue
-                    clipResizeMode = getValue(clip.props, "resizeMode", resizeMode)
-                    clipImg = getVideoClipImage(video, videoDur, fclip, t, clipResizeMode)
-                    if existIndex is not None:
-                        clipPixels[existIndex] = np.array(clipImg, dtype=np.uint8)
-                    else:
-                        clipTimes.append(t)
-                        clipPixels.append(np.array(clipImg, dtype=np.uint8))
-                printProgress(j+1, vclipCount)
-
-            # save cache data
-            fileCacheData = (clipTimes, clipPixels)
-
-            if cache:
-                saveCacheFile(cacheFn, fileCacheData, overwrite=True)
-
-            # close video to free up memory
-            video.reader.close()
-            del video
-
-        # assign pixel data to clips
+
+        # group clips that share the same frame size
+        groups = {}
         for clip in vclips:
-            start = clip.props["start"]
-            end = start + clip.props["dur"]
-            ms = start
-            pixelData = []
-            while ms < end:
-                t = roundInt(ms)
-                ms += msStep
-                index = fileCacheData[0].index(t)
-                pixelData.append(fileCacheData[1][index])
-            clipsPixelData[clip.props["index"]] = pixelData
-            # clip.setProp("framePixelData", pixelData)
+            clipResizeMode = getValue(clip.props, "resizeMode", resizeMode)
+            storeW, storeH = getFrameStoreSize(clip.props["maxWidth"], clip.props["maxHeight"])
+            key = getFrameStoreKey(storeW, storeH, clipResizeMode)
+            if key not in groups:
+                groups[key] = {"width": storeW, "height": storeH, "resizeMode": clipResizeMode, "clips": [], "times": set()}
+            groups[key]["clips"].append(clip)
+            groups[key]["times"].update(getClipFrameTimes(clip, msStep))
+
+        # clips use the largest store that supersedes the one for their size, so when clips grow their frames go into
+        # the larger store and the smaller one is removed below instead of being left behind
+        if cache:
+            sizes = dict([(key, {"width": group["width"], "height": group["height"]}) for key, group in groups.items()])
+            for key, entry in manifest.items():
+                sizes.setdefault(key, entry)
+            merged = {}
+            for key, group in groups.items():
+                target = key
+                for otherKey, other in sizes.items():
+                    if isFrameStoreSuperseded(key, sizes[key], otherKey, other) and other["width"] > sizes[target]["width"]:
+                        target = otherKey
+                if target not in merged:
+                    merged[target] = {"width": sizes[target]["width"], "height": sizes[target]["height"], "resizeMode": group["resizeMode"], "clips": [], "times": set()}
+                merged[target]["clips"] += group["clips"]
+                merged[target]["times"].update(group["times"])
+            groups = merged
+
+        for key, group in groups.items():
+            times = sorted(group["times"])
+            store = loadFrameStore(manifestFn, key, manifest, verify=verifyData) if cache else None
+
+            # verify that every frame we need exists in the store
+            missingTimes = times
+            if store is not None:
+                missingTimes = [t for t, found in zip(times, np.isin(times, store["times"])) if not found]
+                if len(missingTimes) > 0:
+                    print("%s frames not found in %s. Appending to frame store" % (len(missingTimes), store["filename"]))
+
+            if store is None or len(missingTimes) > 0:
+                if store is None:
+                    print("No cache for %s at %s, rebuilding..." % (fn, key))
+                missingCount = len(missingTimes)
+                frames = getVideoFrames(fn, missingTimes, group["width"], group["height"], group["resizeMode"])
+                def getFrame(j):
+                    if (j+1) % 100 == 0 or j+1 >= missingCount:
+                        printProgress(j+1, missingCount)
+                    return next(frames)
+                # only decode and append the frames that are missing
+                store = updateFrameStore(manifestFn, key, missingTimes, group["width"], group["height"], getFrame, manifest=manifest, cache=cache)
+
+            # assign pixel data to clips
+            for clip in group["clips"]:
+                clipsPixelData[clip.props["index"]] = getFrameSequence(store, getClipFrameTimes(clip, msStep))
+
+        # remove stores that a store used here supersedes
+        if cache:
+            for key in list(manifest.keys()):
+                if key not in groups and any([isFrameStoreSuperseded(key, manifest[key], usedKey, manifest[usedKey]) for usedKey in groups if usedKey in manifest]):
+                    removeFrameStore(manifestFn, key, manifest)
 
         printProgress(i+1, fileCount)
 
@@ -679,14 +892,25 @@ def loadVideoPixelDataFromFrames(frames, clips, containerW, containerH, fps, cac
             ccfunction = None
         elif customClipToArrCalcFunction is not None:
             ccfunction = customClipToArrCalcFunction
-        for i, frame in enumerate(frames):
-            ms = frame["ms"]
-            # frameClips = clipsToDictsGPU(clips, ms, container, precision)
-            frameClips = clipsToNpArr(clips, ms, containerW, containerH, precision, customClipToArrFunction=ccfunction, globalArgs=globalArgs)
-            clipCompare[0] = clipWidthMaxes
-            clipCompare[1] = frameClips[:,2] # just take the width (2)
-            clipWidthMaxes = np.amax(clipCompare, axis=0)
-            printProgress(i+1, frameCount)
+        timeline = getValue(globalArgs, "timeline", None)
+        hasParent = clipCount > 0 and clips[0].vector.parent is not None
+        # evaluate the compiled timeline for a batch of frames at a time
+        if ccfunction is None and timeline is not None and not hasParent:
+            batchSize = 100
+            for i in range(0, frameCount, batchSize):
+                batchMs = [frame["ms"] for frame in frames[i:i+batchSize]]
+                batchClips = timeline.toNpArr(batchMs, containerW, containerH, precision)
+                clipWidthMaxes = np.maximum(clipWidthMaxes, np.amax(batchClips[:,:,2], axis=0)) # just take the width (2)
+                printProgress(min(i+batchSize, frameCount), frameCount)
+        else:
+            for i, frame in enumerate(frames):
+                ms = frame["ms"]
+                # frameClips = clipsToDictsGPU(clips, ms, container, precision)
+                frameClips = clipsToNpArr(clips, ms, containerW, containerH, precision, customClipToArrFunction=ccfunction, globalArgs=globalArgs)
+                clipCompare[0] = clipWidthMaxes
+                clipCompare[1] = frameClips[:,2] # just take the width (2)
+                clipWidthMaxes = np.amax(clipCompare, axis=0)
+                printProgress(i+1, frameCount)
         if cache:
             saveCacheFile(cacheDir+cacheFile, clipWidthMaxes, overwrite=True)
 
@@ -718,6 +942,7 @@ def msToFrame(ms, fps):
 def parseVideoArgs(args):
     d = vars(args)
     d["THREADS"] = min(args.THREADS, multiprocessing.cpu_count()) if args.THREADS > 0 else multiprocessing.cpu_count()
+    d["PROCESSES"] = getThreadCount(args.PROCESSES)
     d["AUDIO_OUTPUT_FILE"] = args.OUTPUT_FILE.replace(".mp4", ".mp3")
     d["MS_PER_FRAME"] = frameToMs(1, args.FPS, False)
     d["CACHE_VIDEO"] = args.CACHE_VIDEO
@@ -737,28 +962,119 @@ def pasteImage(im, clipImg, x, y):
     im = Image.alpha_composite(im, stagingImg)
     return im
 
-def processFrames(params, clips, clipsPixelData, threads=1, precision=3, verbose=True, customClipToArrFunction=None, postProcessingFunction=None, preProcessingFunction=None, globalArgs={}):
+# set right before forking, so worker processes share the clips and pixel data copy-on-write
+frameRenderState = {}
+
+def initFrameRenderWorker():
+    # OpenCL contexts don't survive a fork, so each worker loads its own program once and uses it for all of its frame ranges
+    state = frameRenderState
+    state["gpuProgram"] = None
+    if state["globalArgs"]["renderer"] == "gpu":
+        p0 = state["params"][0]
+        state["gpuProgram"] = loadMakeImageProgram(p0["width"], p0["height"], Clip.gpuPropertyCount, getValue(state["globalArgs"], "colors", 3), state["precision"])
+
+def processFrameRange(frameRange):
+    start, end, warmup = frameRange
+    state = frameRenderState
+    params = state["params"]
+    globalArgs = state["globalArgs"]
+    precision = state["precision"]
+    propagateFrames = state["propagateFrames"]
+    baseImage = state["baseImage"]
+    gpuProgram = state["gpuProgram"]
+
+    # streamed frames go back to the writer in the main process
+    frameCollector = None
+    if getValue(globalArgs, "frameWriter", None) is not None:
+        frameCollector = FrameCollector()
+        globalArgs = globalArgs.copy()
+        globalArgs["frameWriter"] = frameCollector
+
+    prevImage = None
+    for i in range(start-warmup, end):
+        p = params[i]
+        # warm-up frames only rebuild the trails of the previous frames
+        if i < start:
+            p = p.copy()
+            p["saveFrame"] = False
+        baseImage = prevImage if propagateFrames else baseImage
+        prevImage = clipsToFrame(p, clips=state["clips"], pixelData=state["pixelData"], precision=precision, customClipToArrFunction=state["customClipToArrFunction"], baseImage=baseImage, gpuProgram=gpuProgram, postProcessingFunction=state["postProcessingFunction"], preProcessingFunction=state["preProcessingFunction"], globalArgs=globalArgs)
+    return (end - start, frameCollector.frames if frameCollector is not None else [])
+
+def getFrameRanges(count, processes, warmup=0, maxRangeSize=-1):
+    # more ranges than processes to balance the load, unless every range needs warm-up frames
+    rangeCount = processes * 4 if warmup <= 0 else processes
+    # keep ranges small if their frames need to be buffered before they're written
+    if maxRangeSize > 0:
+        rangeCount = max(rangeCount, int(math.ceil(1.0 * count / maxRangeSize)))
+    rangeCount = max(1, min(count, rangeCount))
+    edges = np.linspace(0, count, rangeCount+1).round().astype(int)
+    return [(edges[i], edges[i+1], min(warmup, edges[i])) for i in range(rangeCount) if edges[i+1] > edges[i]]
+
+def processFrames(params, clips, clipsPixelData, threads=1, precision=3, verbose=True, customClipToArrFunction=None, postProcessingFunction=None, preProcessingFunction=None, globalArgs={}, processes=1):
     if len(params) < 1:
         return
 
     count = len(params)
     print("Processing %s frames" % count)
     threads = getThreadCount(threads)
+    processes = getThreadCount(processes)
 
     frameAlpha = getValue(globalArgs, "frameAlpha", 1.0)
     isSequential = getValue(globalArgs, "isSequential", False)
     baseImage = getValue(globalArgs, "baseImage", None)
     propagateFrames = (0.0 <= frameAlpha < 1.0)
-    if propagateFrames:
+
+    # frames that propagate into the next frame can still be split into ranges if the previous frames fade out:
+    # each range first re-renders enough frames for the earlier trails to fall below one color level
+    warmup = 0
+    if propagateFrames and not isSequential and processes > 1 and frameAlpha > 0.0:
+        warmup = int(math.ceil(math.log(0.5/255.0) / math.log(1.0-frameAlpha)))
+    if propagateFrames and warmup <= 0:
         isSequential = True
 
-    # load gpu program
-    p0 = params[0]
-    colorDimensions = getValue(globalArgs, "colors", 3)
-    pcount = Clip.gpuPropertyCount
-    gpuProgram = loadMakeImageProgram(p0["width"], p0["height"], pcount, colorDimensions, precision)
+    # streamed frames are buffered until all earlier frames are written, which would hold entire ranges in memory when they need warm-up
+    isStreaming = getValue(globalArgs, "frameWriter", None) is not None
+    if isStreaming and warmup > 0:
+        isSequential = True
 
-    if threads > 1 and not isSequential:
+    if processes > 1 and (isSequential or "fork" not in multiprocessing.get_all_start_methods()):
+        print("Frames must be rendered in a single process")
+        processes = 1
+
+    # load gpu program, or fall back to the cpu if there's no OpenCL platform
+    renderer = getRenderer(getValue(globalArgs, "renderer", "auto"))
+    globalArgs = globalArgs.copy()
+    globalArgs["renderer"] = renderer
+    gpuProgram = None
+    if renderer == "gpu" and processes <= 1:
+        p0 = params[0]
+        colorDimensions = getValue(globalArgs, "colors", 3)
+        pcount = Clip.gpuPropertyCount
+        gpuProgram = loadMakeImageProgram(p0["width"], p0["height"], pcount, colorDimensions, precision)
+    elif renderer != "gpu":
+        print("Rendering frames on the CPU")
+
+    if processes > 1:
+        frameRenderState.update({
+            "params": params, "clips": clips, "pixelData": clipsPixelData, "precision": precision,
+            "customClipToArrFunction": customClipToArrFunction, "postProcessingFunction": postProcessingFunction, "preProcessingFunction": preProcessingFunction,
+            "globalArgs": globalArgs, "baseImage": baseImage, "propagateFrames": propagateFrames
+        })
+        frameRanges = getFrameRanges(count, processes, warmup, maxRangeSize=(8 if isStreaming else -1))
+        print("Rendering %s frame ranges in %s processes" % (len(frameRanges), processes))
+        pool = multiprocessing.get_context("fork").Pool(processes, initializer=initFrameRenderWorker)
+        completed = 0
+        for rendered, frames in pool.imap_unordered(processFrameRange, frameRanges):
+            for frame, data in frames:
+                globalArgs["frameWriter"].write(frame, data)
+            completed += rendered
+            if verbose:
+                printProgress(completed, count)
+        pool.close()
+        pool.join()
+        frameRenderState.clear()
+    elif threads > 1 and not isSequential and not propagateFrames:
         pool = ThreadPool(threads)
         pclipsToFrame = partial(clipsToFrame, clips=clips, pixelData=clipsPixelData, precision=precision, customClipToArrFunction=customClipToArrFunction, baseImage=baseImage, gpuProgram=gpuProgram, postProcessingFunction=postProcessingFunction, preProcessingFunction=preProcessingFunction, globalArgs=globalArgs)
         pool.map(pclipsToFrame, params)
@@ -804,16 +1120,15 @@ def rotatePixels(pixels, angle, resize=None):
     return np.array(im)
 
 def samplesToPixels(f):
-    video = VideoFileClip(f["filename"], audio=False)
-    videoDur = video.duration
-    fclips = f["items"]
+    # read the frames in time order; each clip has its own size so resize after decoding
+    fclips = sorted(f["items"], key=lambda c: c["t"])
     pixelData = [0 for i in range(len(fclips))]
+    frames = getVideoFrames(f["filename"], [fclip["t"] for fclip in fclips])
     for i, fclip in enumerate(fclips):
-        clipImg = getVideoClipImage(video, videoDur, {"width": ceilInt(fclip["width"]), "height": ceilInt(fclip["height"]), "t": fclip["t"]})
+        frame = next(frames)
+        clipImg = resizeImage(Image.fromarray(frame, mode="RGB"), ceilInt(fclip["width"]), ceilInt(fclip["height"]))
         pixels = np.array(clipImg)
         pixelData[i] = (fclip["_index"], pixels)
-    video.reader.close()
-    del video
     return pixelData
 
 def saveBlankFrame(fn, width, height, bgColor="#000000", overwrite=False, verbose=True):
@@ -104,6 +104,7 @@ if not collection:
 # group samples by item
 samplesByItem = groupList(samples, 'filename')
 samplesByItemLookup = createLookup(samplesByItem, 'filename')
+sampleIndex = getIntervalIndex(samples)
 
 # filter items
 filenames = set(unique([s['filename'] for s in samples]))
@@ -117,15 +118,11 @@ for item in items:
     _, itemPhrases = readCsv(PHRASE_PATH % item['filename'])
     # filter phrases to just those that have samples
     validItemPhrases = []
-    itemSamples = samplesByItemLookup[item['filename']]['items']
-    itemSamples = sorted(itemSamples, key=lambda s: s['start'])
     for phrase in itemPhrases:
         pstart = phrase['start']
         pend = pstart + phrase['dur']
-        for sample in itemSamples:
-            if pstart <= sample['start'] < pend:
-                validItemPhrases.append(phrase)
-                break
+        if len(queryIntervalIndex(sampleIndex, item['filename'], pstart, pend, mode="starts")) > 0:
+            validItemPhrases.append(phrase)
     phraseLookup[item['filename']] = validItemPhrases
 
 # parse stuff for item
@@ -80,9 +80,10 @@ if len(a.FILTER) > 0:
     print("Found %s phrases after filtering" % phraseCount)
 
 print("Collecting samples...")
+sampleIndex = getIntervalIndex(samples)
 validSamples = []
 for i, p in enumerate(phrases):
-    psamples = [s for s in samples if s["filename"]==p["filename"] and s["start"] >= p["start"] and s["end"] <= p["end"]]
+    psamples = queryIntervalIndex(sampleIndex, p["filename"], p["start"], p["end"])
     if a.LIMIT_SAMPLES_PER_PHRASE > 0 and len(psamples) > a.LIMIT_SAMPLES_PER_PHRASE:
         psamples = sorted(psamples, key=lambda s: s['start'])
         psamples = psamples[:a.LIMIT_SAMPLES_PER_PHRASE]
@@ -105,8 +106,11 @@ validFileCount = len(unique([s["filename"] for s in validSamples]))
 print("Found %s unique files" % validFileCount)
 
 # get phrase counts
+filePhrases = {}
+for s in validSamples:
+    filePhrases.setdefault(s["filename"], set()).add(s["phrase"])
 for i, file in enumerate(files):
-    files[i]['phrases'] = len(unique([s["phrase"] for s in validSamples if s["filename"]==file["filename"]]))
+    files[i]['phrases'] = len(filePhrases.get(file["filename"], []))
 
 if a.PROBE:
     counts = getCounts(validSamples, "filename")
@@ -10,6 +10,7 @@ import sys
 from lib.collection_utils import *
 from lib.io_utils import *
 from lib.math_utils import *
+from lib.table_utils import *
 
 # input
 parser = argparse.ArgumentParser()
@@ -18,28 +19,42 @@ parser.add_argument('-display', dest="DISPLAY_PROPS", default="filename,title",
 parser.add_argument('-filter', dest="FILTER", default="duration>150&medianPower>0", help="Filter string")
 parser.add_argument('-sort', dest="SORT", default="samples=desc", help="Sort string")
 parser.add_argument('-count', dest="RESULT_COUNT", default=20, type=int, help="Number of results to display")
+parser.add_argument('-interactive', dest="INTERACTIVE", action="store_true", help="Keep prompting for filter and sort strings after the first query?")
 a = parser.parse_args()
 # Parse arguments
 DISPLAY_PROPS = [p for p in a.DISPLAY_PROPS.strip().split(",")]
 
-# Read files
-fieldNames, rows = readCsv(a.INPUT_FILE)
-rowCount = len(rows)
-
-if len(a.FILTER) > 0:
-    rows = filterByQueryString(rows, a.FILTER)
-    rowCount = len(rows)
-    print("%s rows after filtering" % rowCount)
-
-if len(a.SORT) > 0:
-    rows = sortByQueryString(rows, a.SORT)
-    rowCount = len(rows)
-    print("%s rows after sorting" % rowCount)
-
-print("========")
-for i, row in enumerate(rows):
-    if i >= a.RESULT_COUNT:
-        break
-    displayStr = " ".join([row[p] for p in DISPLAY_PROPS])
-    print("%s. %s" % (i+1, displayStr))
-print("========")
+# Read files; the table keeps each column's sort order, so later queries on the same columns are fast
+table = loadTable(a.INPUT_FILE)
+
+def runQuery(filterString, sortString):
+    indices = table.filter(filterString)
+    rowCount = len(indices)
+    if len(filterString) > 0:
+        print("%s rows after filtering" % rowCount)
+
+    if len(sortString) > 0:
+        indices = table.sort(sortString, indices)
+        rowCount = len(indices)
+        print("%s rows after sorting" % rowCount)
+
+    print("========")
+    rows = table.getRows(indices[:a.RESULT_COUNT], DISPLAY_PROPS)
+    for i, row in enumerate(rows):
+        displayStr = " ".join([str(row[p]) for p in DISPLAY_PROPS if p in row])
+        print("%s. %s" % (i+1, displayStr))
+    print("========")
+
+runQuery(a.FILTER, a.SORT)
+
+if a.INTERACTIVE:
+    while True:
+        try:
+            filterString = input("Filter [%s]: " % a.FILTER).strip() or a.FILTER
+            sortString = input("Sort [%s]: " % a.SORT).strip() or a.SORT
+        except (EOFError, KeyboardInterrupt):
+            print("")
+            break
+        runQuery(filterString, sortString)
+        a.FILTER = filterString
+        a.SORT = sortString
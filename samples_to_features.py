@@ -2,14 +2,14 @@
 
 import argparse
 import csv
+from lib.analysis_utils import *
 from lib.audio_utils import *
+from lib.collection_utils import *
 from lib.io_utils import *
 from lib.math_utils import *
 from lib.processing_utils import *
 import librosa
 from matplotlib import pyplot as plt
-from multiprocessing import Pool
-from multiprocessing.dummy import Pool as ThreadPool
 import os
 import numpy as np
 from pprint import pprint
@@ -23,7 +23,9 @@ parser.add_argument('-out', dest="OUTPUT_FILE", default="", help="CSV output fil
 parser.add_argument('-append', dest="APPEND", default=1, type=int, help="Append to existing data?")
 parser.add_argument('-overwrite', dest="OVERWRITE", action="store_true", help="Overwrite existing data?")
 parser.add_argument('-plot', dest="PLOT", action="store_true", help="Show plot?")
-parser.add_argument('-threads', dest="THREADS", default=4, type=int, help="Number of threads")
+parser.add_argument('-threads', dest="THREADS", default=4, type=int, help="Number of concurrent workers, -1 for all available")
+parser.add_argument('-threaded', dest="THREADED", action="store_true", help="Use threads instead of processes?")
+parser.add_argument('-store', dest="STORE_DIRECTORY", default="tmp/analysis/", help="Directory for storing per-file analysis")
 args = parser.parse_args()
 
 # Parse arguments
@@ -58,32 +60,34 @@ for i, row in enumerate(rows):
 # Make sure output dirs exist
 makeDirectories(OUTPUT_FILE)
 
-# find unique filepaths
-filepaths = list(set([row["path"] for row in rows]))
+# group samples by file
 params = [{
-    "samples": [row for row in rows if row["path"]==fp],
-    "path": fp
-} for fp in filepaths]
+    "samples": group["items"],
+    "indices": group["indices"],
+    "path": group["path"]
+} for group in groupItems(rows, "path")]
 fileCount = len(params)
 
 def samplesToFeatures(p):
     fn = p["path"]
     samples = p["samples"]
-    features = getFeaturesFromSamples(fn, samples)
-    return features
+    analysis = analyzeFile(fn, args.STORE_DIRECTORY, samples=samples, features=["features"])
+    features = []
+    for sample, sfeatures in zip(samples, analysis):
+        sample = sample.copy()
+        sample.update(dict([(key, sfeatures[key]) for key, dtype in FEATURE_COLUMNS]))
+        features.append(sample)
+    return (p["indices"], features)
 
 # files = files[:1]
 # for p in params:
 #     samplesToFeatures(p)
 # sys.exit(1)
-threads = getThreadCount(THREADS)
-pool = ThreadPool(threads)
-data = pool.map(samplesToFeatures, params)
-pool.close()
-pool.join()
-
-# flatten data
-data = [item for sublist in data for item in sublist]
+# put each file's samples back where they were in the input
+data = [None for row in rows]
+for indices, features in mapItems(samplesToFeatures, params, workers=getThreadCount(THREADS), useProcesses=(not args.THREADED)):
+    for i, sample in zip(indices, features):
+        data[i] = sample
 
 headings = fieldNames[:]
 for feature in FEATURES_TO_ADD:
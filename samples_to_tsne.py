@@ -4,15 +4,15 @@
 
 import argparse
 import csv
+from lib.analysis_utils import *
 from lib.audio_utils import *
 from lib.cache_utils import *
+from lib.collection_utils import *
 from lib.io_utils import *
 from lib.math_utils import *
 from lib.processing_utils import *
 import librosa
 from matplotlib import pyplot as plt
-from multiprocessing import Pool
-from multiprocessing.dummy import Pool as ThreadPool
 import os
 import numpy as np
 import pickle
@@ -35,7 +35,9 @@ parser.add_argument('-prefix', dest="PREFIX", default="tsne", help="Prefix for t
 parser.add_argument('-plot', dest="PLOT", action="store_true", help="Show plot?")
 parser.add_argument('-cache', dest="CACHE_FILE", default="", help="Cache file")
 parser.add_argument('-rcache', dest="REMOVE_CACHE", action="store_true", help="Remove cache file after finished?")
-parser.add_argument('-threads', dest="THREADS", default=4, type=int, help="Number of threads")
+parser.add_argument('-threads', dest="THREADS", default=4, type=int, help="Number of concurrent workers, -1 for all available")
+parser.add_argument('-threaded', dest="THREADED", action="store_true", help="Use threads instead of processes?")
+parser.add_argument('-store', dest="STORE_DIRECTORY", default="tmp/analysis/", help="Directory for storing per-file analysis")
 args = parser.parse_args()
 
 # Parse arguments
@@ -79,39 +81,24 @@ makeDirectories(OUTPUT_FILE)
 
 # find unique filepaths
 print("Matching samples to files...")
-filepaths = list(set([row["path"] for row in rows]))
 params = [{
-    "samples": [row for row in rows if row["path"]==fp],
-    "path": fp
-} for fp in filepaths]
+    "samples": group["items"],
+    "indices": group["indices"],
+    "path": group["path"]
+} for group in groupItems(rows, "path")]
 fileCount = len(params)
 
 progress = 0
 def doTSNE(p):
-    global progress
-    global rowCount
-
     fn = p["path"]
     samples = p["samples"]
     featureVectors = []
 
-    # load audio
-    fn = getAudioFile(fn)
-    y, sr = loadAudioData(fn)
-    for sample in samples:
-        featureVector = getFeatureVector(y, sr, sample["start"], sample["dur"])
-        featureVectors.append({
-            "index": sample["index"],
-            "filename": sample["filename"],
-            "start": sample["start"],
-            "dur": sample["dur"],
-            "featureVector": featureVector
-        })
-
-        progress += 1
-        printProgress(progress, rowCount)
+    analysis = analyzeFile(fn, args.STORE_DIRECTORY, samples=samples, features=["vectors"])
+    for sample, sanalysis in zip(samples, analysis):
+        featureVectors.append(sanalysis["featureVector"])
 
-    return featureVectors
+    return (p["indices"], featureVectors)
 
 # doTSNE(params[0])
 # sys.exit()
@@ -124,24 +111,20 @@ if CACHE_FILE:
 
 if not loaded:
     print("No cache, rebuilding features...")
-    threads = getThreadCount(args.THREADS)
-    pool = ThreadPool(threads)
-    data = pool.map(doTSNE, params)
-    pool.close()
-    pool.join()
+    # put each file's feature vectors back in sample order
+    featureVectors = [None for row in rows]
+    for indices, fileFeatureVectors in mapItems(doTSNE, params, workers=getThreadCount(args.THREADS), useProcesses=(not args.THREADED)):
+        for i, featureVector in zip(indices, fileFeatureVectors):
+            featureVectors[i] = featureVector
+        progress += len(fileFeatureVectors)
+        printProgress(progress, rowCount)
     # sys.exit(1)
 
-    # flatten data
-    data = [item for sublist in data for item in sublist]
-
     # replace NaN in feature vectors
-    for i, d in enumerate(data):
-        if True in np.isnan(d["featureVector"]):
+    for i, featureVector in enumerate(featureVectors):
+        if True in np.isnan(featureVector):
             print("Warning: index %s contains NaN in feature vector" % i)
-            data[i]["featureVector"] = np.nan_to_num(d["featureVector"])
-
-    data = sorted(data, key=lambda d: d["index"])
-    featureVectors = [d["featureVector"] for d in data]
+            featureVectors[i] = np.nan_to_num(featureVector)
     if CACHE_FILE:
         saveCacheFile(CACHE_FILE, featureVectors, overwrite=True)
 
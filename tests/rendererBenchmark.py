@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Compares frames per second of the CPU and OpenCL renderers on a synthetic grid of clips
+# python3 tests/rendererBenchmark.py -grid 32x32 -frames 24
+
+import argparse
+import inspect
+import math
+import numpy as np
+import os
+from pprint import pprint
+import sys
+import time
+
+# add parent directory to sys path to import relative modules
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+from lib.clip import *
+from lib.cpu_utils import *
+from lib.gpu_utils import *
+from lib.math_utils import *
+
+# input
+parser = argparse.ArgumentParser()
+parser.add_argument('-width', dest="WIDTH", default=1920, type=int, help="Output width")
+parser.add_argument('-height', dest="HEIGHT", default=1080, type=int, help="Output height")
+parser.add_argument('-grid', dest="GRID", default="32x32", help="Grid of clips")
+parser.add_argument('-frames', dest="FRAMES", default=24, type=int, help="Number of frames to render per renderer")
+parser.add_argument('-colors', dest="COLORS", default=3, type=int, help="Color dimensions (3 or 4)")
+parser.add_argument('-precision', dest="PRECISION", default=3, type=int, help="Precision for position and size")
+parser.add_argument('-out', dest="OUTPUT_FILE", default="", help="Optionally save the difference between renderers to this image")
+a = parser.parse_args()
+
+gridW, gridH = tuple([int(v) for v in a.GRID.strip().split("x")])
+precisionMultiplier = int(10 ** a.PRECISION)
+cellW = 1.0 * a.WIDTH / gridW
+cellH = 1.0 * a.HEIGHT / gridH
+srcW = roundInt(cellW * 1.5)
+srcH = roundInt(cellH * 1.5)
+c = a.COLORS
+
+# build one source frame per clip and pack it like clipsToFrameGPU does
+count = gridW * gridH
+pixelData = np.random.randint(0, 256, size=count*srcW*srcH*c, dtype=np.uint8)
+
+def getProperties(frame):
+    properties = np.zeros((count, Clip.gpuPropertyCount), dtype=np.int32)
+    for i in range(count):
+        col = i % gridW
+        row = int(i / gridW)
+        # drift and scale each clip a little so sampling isn't pixel-aligned
+        n = 1.0 * frame / max(1, a.FRAMES)
+        scale = 1.0 + 0.25 * math.sin((n + 1.0 * i / count) * math.pi * 2)
+        tw = cellW * scale
+        th = cellH * scale
+        x = col * cellW - (tw - cellW) * 0.5 + n * 3.0
+        y = row * cellH - (th - cellH) * 0.5 + n * 2.0
+        alpha = 0.5 + 0.5 * ((i % 7) / 6.0)
+        brightness = 0.5 + 0.5 * ((i % 5) / 4.0)
+        properties[i] = np.array([i*srcW*srcH*c, roundInt(x*precisionMultiplier), roundInt(y*precisionMultiplier), srcW, srcH, roundInt(tw*precisionMultiplier), roundInt(th*precisionMultiplier), roundInt(alpha*precisionMultiplier), i+1, roundInt(brightness*precisionMultiplier)])
+    return properties
+
+frameProperties = [getProperties(f) for f in range(a.FRAMES)]
+
+print("Rendering %s frames of %s clips at %sx%s" % (a.FRAMES, count, a.WIDTH, a.HEIGHT))
+
+startTime = time.time()
+for properties in frameProperties:
+    cpuPixels = clipsToImageCPU(a.WIDTH, a.HEIGHT, pixelData, properties, c, a.PRECISION)
+elapsed = time.time() - startTime
+print("CPU: %s frames/sec" % round(a.FRAMES / elapsed, 2))
+
+if not isOpenCLAvailable():
+    print("No OpenCL platform found; skipping GPU benchmark")
+    sys.exit()
+
+gpuProgram = loadMakeImageProgram(a.WIDTH, a.HEIGHT, Clip.gpuPropertyCount, c, a.PRECISION)
+startTime = time.time()
+for properties in frameProperties:
+    gpuPixels = clipsToImageGPU(a.WIDTH, a.HEIGHT, pixelData, properties, c, a.PRECISION, gpuProgram=gpuProgram)
+elapsed = time.time() - startTime
+print("GPU: %s frames/sec" % round(a.FRAMES / elapsed, 2))
+
+# compare the last frame of each renderer
+delta = np.abs(cpuPixels.astype(np.int32) - gpuPixels.astype(np.int32))
+print("Max channel difference: %s, mean: %s" % (np.max(delta), round(np.mean(delta), 4)))
+if len(a.OUTPUT_FILE) > 0:
+    from PIL import Image
+    Image.fromarray(np.clip(delta * 16, 0, 255).astype(np.uint8), mode="RGB").save(a.OUTPUT_FILE)
+    print("Saved %s" % a.OUTPUT_FILE)